@@ -0,0 +1,312 @@
+"""
+Benchmark of the update processing hot path.
+
+Drives `BotLab.process_new_updates` with a synthetic stream of messages and
+callback queries from `--sessions` users against a stubbed Bot API, for
+each storage backend, and reports updates/sec, p50/p99 update latency and
+storage requests per update. Results are saved as JSON, so that runs made
+at different commits can be compared with `--compare`.
+
+    python -m benchmarks.bench_updates --backends inmemory disk --sessions 1000 100000
+    python -m benchmarks.bench_updates --compare old.json new.json
+
+'mongo' uses the server at `--mongo-host`, `--kv redis` keeps the
+configuration in the Redis server at `--redis-host`; backends that cannot
+be reached are skipped.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest import mock
+
+import telebot
+
+from botlab import BotLab
+
+L10N_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example', 'l10n.json')
+STORAGE_METHODS = ['get_field', 'set_field', 'set_fields', 'bulk_set', 'get_object', 'set_object', 'remove_object']
+PREPOPULATE_BATCH_SIZE = 10000
+
+
+def make_settings(backend, kv, work_dir, args):
+    settings = {
+        'config': {
+            'sync_strategy': 'cold'
+        },
+        'bot': {
+            'token': '123:BENCHMARK',
+            'initial_state': 'main_menu',
+            'initial_inline_state': 'main_menu',
+            'suppress_exceptions': False
+        },
+        'l10n': {
+            'default_lang': 'en',
+            'file_path': L10N_FILE_PATH
+        }
+    }
+
+    if backend == 'inmemory':
+        settings['db_storage'] = {'type': 'inmemory', 'params': {}}
+    elif backend == 'disk':
+        settings['db_storage'] = {'type': 'disk', 'params': {'file_path': os.path.join(work_dir, 'storage.json'),
+                                                             'journal': True, 'write_behind': True}}
+    elif backend == 'paged':
+        settings['db_storage'] = {'type': 'paged', 'params': {'path': os.path.join(work_dir, 'storage')}}
+    elif backend == 'sqlite':
+        settings['db_storage'] = {'type': 'sqlite', 'params': {'file_path': os.path.join(work_dir, 'storage.db')}}
+    elif backend == 'mongo':
+        settings['db_storage'] = {'type': 'mongo', 'params': {'host': args.mongo_host, 'port': args.mongo_port,
+                                                              'database': 'botlab_benchmark'}}
+    else:
+        raise ValueError('Unknown backend: {0}'.format(backend))
+
+    if kv == 'redis':
+        settings['config']['sync_strategy'] = 'hot'
+        settings['kv_storage'] = {'type': 'redis', 'params': {'host': args.redis_host, 'port': args.redis_port,
+                                                              'db': 15}}
+
+    return settings
+
+
+def backend_available(backend, kv, args):
+    try:
+        if backend == 'mongo':
+            import pymongo
+
+            pymongo.MongoClient(args.mongo_host, args.mongo_port, serverSelectionTimeoutMS=1000).admin.command('ping')
+
+        if kv == 'redis':
+            import redis
+
+            redis.StrictRedis(host=args.redis_host, port=args.redis_port, socket_connect_timeout=1).ping()
+    except Exception as e:
+        print('Skipping {0}/{1}: {2}'.format(backend, kv, e))
+        return False
+
+    return True
+
+
+def make_message_update(update_id, chat_id, text):
+    return telebot.types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Max'}
+        }
+    })
+
+
+def make_callback_query_update(update_id, chat_id, data):
+    return telebot.types.Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'data': data,
+            'chat_instance': str(chat_id),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Max'},
+            'message': {
+                'message_id': update_id,
+                'date': 0,
+                'chat': {'id': chat_id, 'type': 'private'}
+            }
+        }
+    })
+
+
+def fake_make_request(token, method_name, method='get', params=None, files=None):
+    """
+    Bot API stand-in answering every request at once.
+    """
+    if method_name == 'answerCallbackQuery':
+        return True
+
+    return {'message_id': 1, 'date': 0, 'chat': {'id': (params or {}).get('chat_id', 0), 'type': 'private'}}
+
+
+def setup_handlers(bot):
+    @bot.message_handler(state='main_menu')
+    def main_menu(session, message):
+        session.reply_message(session._('msg_main_menu_welcome', name=message.from_user.first_name))
+        session.set_state('settings')
+
+    @bot.message_handler(state='settings')
+    def settings(session, message):
+        session.set_field('visits', (session.get_field('visits') or [0])[0] + 1)
+        session.set_state('main_menu')
+
+    @bot.callback_query_handler(inline_state='main_menu')
+    def inline_main_menu(session, callback_query):
+        bot.answer_callback_query(callback_query.id)
+        session.set_inline_state('main_menu')
+
+
+def count_storage_requests(storage, counter):
+    for name in STORAGE_METHODS:
+        func = getattr(storage, name)
+
+        def counted(*args, __func=func, **kwargs):
+            counter[0] += 1
+            return __func(*args, **kwargs)
+
+        setattr(storage, name, counted)
+
+
+def prepopulate(storage, sessions):
+    for first_chat_id in range(1, sessions + 1, PREPOPULATE_BATCH_SIZE):
+        last_chat_id = min(first_chat_id + PREPOPULATE_BATCH_SIZE, sessions + 1)
+
+        storage.bulk_set('sessions', [({'chat_id': chat_id}, {'lang': 'en', 'state': 'main_menu',
+                                                              'inline_state': 'main_menu'})
+                                      for chat_id in range(first_chat_id, last_chat_id)])
+
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) < 1:
+        return None
+
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_benchmark(backend, sessions, updates, kv='inmemory', callback_query_share=0.2, seed=0, args=None):
+    """
+    :return: dict with the results of one run
+    """
+    work_dir = tempfile.mkdtemp()
+    rnd = random.Random(seed)
+
+    try:
+        with mock.patch('telebot.apihelper._make_request', fake_make_request):
+            bot = BotLab(make_settings(backend, kv, work_dir, args), threaded=False)
+            setup_handlers(bot)
+
+            if backend == 'mongo':
+                bot._storage.db['sessions'].delete_many({})
+
+            prepopulate(bot._storage, sessions)
+
+            stream = []
+
+            for update_id in range(1, updates + 1):
+                chat_id = rnd.randint(1, sessions)
+
+                if rnd.random() < callback_query_share:
+                    stream.append(make_callback_query_update(update_id, chat_id, 'btn'))
+                else:
+                    stream.append(make_message_update(update_id, chat_id, 'hi'))
+
+            storage_requests = [0]
+            count_storage_requests(bot._storage, storage_requests)
+
+            latencies = []
+            started_at = time.perf_counter()
+
+            for update in stream:
+                update_started_at = time.perf_counter()
+                bot.process_new_updates([update])
+                latencies.append(time.perf_counter() - update_started_at)
+
+            elapsed = time.perf_counter() - started_at
+
+            bot._storage.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies.sort()
+
+    return {
+        'backend': backend,
+        'kv': kv,
+        'sessions': sessions,
+        'updates': updates,
+        'updates_per_sec': updates / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'storage_requests_per_update': storage_requests[0] / updates
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_file_path, new_file_path):
+    with open(old_file_path, encoding='utf-8') as f:
+        old = {(r['backend'], r['kv'], r['sessions']): r for r in json.load(f)['results']}
+
+    with open(new_file_path, encoding='utf-8') as f:
+        new = json.load(f)['results']
+
+    print('{0:<10} {1:<10} {2:>9} {3:>14} {4:>10} {5:>10}'.format('backend', 'kv', 'sessions', 'updates/sec',
+                                                                  'p50', 'p99'))
+
+    for result in new:
+        old_result = old.get((result['backend'], result['kv'], result['sessions']))
+
+        if old_result is None:
+            continue
+
+        print('{0:<10} {1:<10} {2:>9} {3:>+13.1%} {4:>+9.1%} {5:>+9.1%}'.format(
+            result['backend'], result['kv'], result['sessions'],
+            result['updates_per_sec'] / old_result['updates_per_sec'] - 1,
+            result['p50_ms'] / old_result['p50_ms'] - 1,
+            result['p99_ms'] / old_result['p99_ms'] - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of BotLab update processing')
+    parser.add_argument('--backends', nargs='+', default=['inmemory', 'disk'],
+                        choices=['inmemory', 'disk', 'paged', 'sqlite', 'mongo'])
+    parser.add_argument('--kv', nargs='+', default=['inmemory'], choices=['inmemory', 'redis'])
+    parser.add_argument('--sessions', nargs='+', type=int, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--updates', type=int, default=10000)
+    parser.add_argument('--mongo-host', default='localhost')
+    parser.add_argument('--mongo-port', type=int, default=27017)
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--output', help='file to save the results to, benchmark-<commit>.json by default')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved results')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        return compare(*args.compare)
+
+    commit = get_commit()
+    results = []
+
+    for backend in args.backends:
+        for kv in args.kv:
+            if not backend_available(backend, kv, args):
+                continue
+
+            for sessions in args.sessions:
+                result = run_benchmark(backend, sessions, args.updates, kv=kv, args=args)
+                results.append(result)
+
+                print('{backend:<10} {kv:<10} {sessions:>9} sessions: {updates_per_sec:>9.0f} updates/sec, '
+                      'p50 {p50_ms:.3f}ms, p99 {p99_ms:.3f}ms, '
+                      '{storage_requests_per_update:.2f} storage requests/update'.format(**result))
+
+    output = args.output or 'benchmark-{0}.json'.format(commit or 'unknown')
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'commit': commit, 'python': platform.python_version(), 'time': time.time(),
+                   'results': results}, f, indent=2)
+
+    print('Saved to {0}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,15 @@
+import collections.abc
+import heapq
 import json
+import string
+import threading
+import time
 
 import telebot
 
-from botlab import storage
+from botlab import backends, storage
 from botlab.configuration_manager import ConfigurationManager
-from botlab.exceptions import UnknownStorageException, NoConfigurationProvidedException
+from botlab.exceptions import NoConfigurationProvidedException
 
 
 class BotLab(telebot.TeleBot):
@@ -14,25 +19,75 @@ class BotLab(telebot.TeleBot):
 
         config_manager = ConfigurationManager(config_dict)
 
-        super().__init__(config_manager.get('bot').get('token'), threaded=threaded,
+        # telebot's shared pool is replaced by the sharded one, see `_exec_task`
+        super().__init__(config_manager.get('bot').get('token'), threaded=False,
                          skip_pending=skip_pending)
 
+        self.threaded = threaded
+
+        if threaded:
+            from botlab.scheduling import ShardedWorkerPool
+
+            self.worker_pool = ShardedWorkerPool(
+                config_manager.get('bot').get('workers', ShardedWorkerPool.DEFAULT_WORKERS),
+                config_manager.get('bot').get('worker_queue_size', ShardedWorkerPool.DEFAULT_QUEUE_SIZE))
+
         self._config_manager = config_manager
+        # id of handlers list -> (its length when indexed, index), see `_candidate_handlers`
+        self._handlers_indexes = {}
         self._suppress_exceptions = config_manager.get('bot').get('suppress_exceptions')
 
         self.l10n = L10n(config_manager)
 
+        metrics_config = config_manager.get('metrics') or {}
+
+        # None when disabled, so that the hot path only pays for a check
+        self.metrics = None
+
+        if metrics_config.get('enabled'):
+            from botlab.metrics import Metrics
+
+            self.metrics = Metrics(metrics_config)
+
+        outbox_config = config_manager.get('outbox') or {}
+
+        # see `_deliver`; requests and urllib3 are only imported when it is enabled
+        self.outbox = None
+
+        if outbox_config.get('enabled'):
+            from botlab.outbox import Outbox
+
+            self.outbox = Outbox(outbox_config)
+        self._wait_outbox = outbox_config.get('wait', True)
+
         storage_type = config_manager.get('db_storage').get('type')
         storage_params = config_manager.get('db_storage').get('params')
 
-        if storage_type == 'mongo':
-            self._storage = storage.MongoStorage(storage_params)
-        elif storage_type == 'inmemory':
-            self._storage = storage.InMemoryStorage(storage_params)
-        elif storage_type == 'disk':
-            self._storage = storage.DiskStorage(storage_params)
-        else:
-            raise UnknownStorageException()
+        # only the selected backend is imported, see `backends`
+        self._storage = backends.storages.get(storage_type)(storage_params)
+
+        if self.metrics is not None:
+            from botlab.metrics import InstrumentedStorage
+
+            self._storage = InstrumentedStorage(self._storage, storage_type, self.metrics)
+            config_manager.metrics = self.metrics
+            self.metrics.add_collector(self._collect_metrics)
+
+        storage_cache_config = config_manager.get('db_storage').get('cache') or {}
+
+        # in front of the instrumented backend, so that only the requests reaching it are timed
+        self._storage_cache = None
+
+        if storage_cache_config.get('enabled'):
+            from botlab.caching import CachingStorage
+
+            self._storage_cache = CachingStorage(self._storage, storage_cache_config)
+            self._storage = self._storage_cache
+
+        from botlab.broadcast import Broadcaster
+
+        self._broadcaster = Broadcaster(self, self._storage, Session.SESSIONS_COLLECTION,
+                                        config_manager.get('broadcast'))
 
     def process_new_updates(self, updates):
         if updates is None:
@@ -40,31 +95,89 @@ class BotLab(telebot.TeleBot):
 
         super().process_new_updates(updates)
 
-    def _get_session(self, chat_id):
-        return Session(self, chat_id, self.l10n, self._storage, self._config_manager)
+    def webhook_server(self):
+        """
+        Server receiving the updates through a webhook instead of polling,
+        configured by the `webhook` section. Call `serve_forever()` or
+        `start()` on it; the webhook itself is registered with `set_webhook`.
+
+        :return: WebhookServer
+        """
+        from botlab.webhook import WebhookServer
+
+        return WebhookServer(self.process_new_updates, self._config_manager.get('webhook'), metrics=self.metrics)
+
+    def stop_polling(self):
+        super().stop_polling()
+
+        # write out whatever the storage still holds back
+        self._storage.flush()
+
+    def _get_session(self, chat_id, autosave=True):
+        # the fields most handlers need may be listed to save reading whole profiles
+        return Session(self, chat_id, self.l10n, self._storage, self._config_manager, autosave=autosave,
+                       fields=self._config_manager.get('bot').get('session_fields'))
 
     def _get_session_from_any(self, any):
+        """
+        Get the session of the user an update came from.
+
+        The session is built once per update and then reused by all the
+        filter tests and the handler. It keeps the changes made to it until
+        the handler is done(see `_run_task`).
+
+        :param any: Message, CallbackQuery, InlineQuery or ChosenInlineResult
+        :return: session or None if the update has no user to bind it to
+        """
+        session = getattr(any, '_botlab_session', None)
+
+        if session is None:
+            session = self._build_session_from_any(any)
+
+            if session is not None:
+                if session.is_new():
+                    # let new users show up in storage(e.g. for broadcasts) even if no handler matches
+                    session.save()
+
+                setattr(any, '_botlab_session', session)
+
+        return session
+
+    def _build_session_from_any(self, any):
+        chat_id = self._get_chat_id(any)
+
+        if chat_id is None:
+            return None
+
+        return self._get_session(chat_id, autosave=False)
+
+    @staticmethod
+    def _get_chat_id(any):
+        """
+        :param any: Message, CallbackQuery, InlineQuery or ChosenInlineResult
+        :return: id of the chat the session of the update is bound to or None
+        """
         if isinstance(any, telebot.types.Message):
-            return self._get_session(any.chat.id)
+            return any.chat.id
         elif isinstance(any, telebot.types.CallbackQuery):
             callback_query = any
 
             if callback_query.message is not None and callback_query.message.chat is not None:
-                return self._get_session(callback_query.message.chat.id)
+                return callback_query.message.chat.id
             else:
-                return self._get_session(callback_query.from_user.id)
+                return callback_query.from_user.id
         elif isinstance(any, telebot.types.InlineQuery):
             inline_query = any
 
             if inline_query.from_user is not None:
-                return self._get_session(inline_query.from_user.id)
+                return inline_query.from_user.id
             else:
                 return None
         elif isinstance(any, telebot.types.ChosenInlineResult):
             chosen_inline_result = any
 
             if chosen_inline_result.from_user is not None:
-                return self._get_session(chosen_inline_result.from_user.id)
+                return chosen_inline_result.from_user.id
             else:
                 return None
         else:
@@ -87,16 +200,47 @@ class BotLab(telebot.TeleBot):
         else:
             return func(*args, **kwargs)
 
-    def _exec_task(self, task, *args, **kwargs):
-        args = list(args)
-        session = self._get_session_from_any(args[0])
+    def _deliver(self, func, *args, **kwargs):
+        """
+        Make a request sending something to a chat(`chat_id` argument), through the outbox if it is enabled.
+
+        :param func: function making the request
+        :return: result of the request(None if exception was suppressed) or,
+            if the outbox is not to be waited for, Future of the result
+        """
+        if self.metrics is not None:
+            func = self.metrics.timed('botlab_api_request_seconds', func, {'method': func.__name__})
+
+        if self.outbox is None:
+            return self._remit(func, *args, **kwargs)
+
+        future = self.outbox.submit(kwargs.get('chat_id'), func, *args, **kwargs)
 
-        args.insert(0, session)
+        if not self._wait_outbox:
+            return future
 
+        return self._remit(future.result)
+
+    def _exec_task(self, task, *args, **kwargs):
+        """
+        Run a task on the worker of the chat the update came from, so the
+        tasks of one chat never overlap and run in the order of the updates.
+        """
         if self.threaded:
-            self.worker_pool.put(task, *args, **kwargs)
+            self.worker_pool.put(self._get_chat_id(args[0]), self._run_task, task, *args, **kwargs)
         else:
-            task(*args, ** kwargs)
+            self._run_task(task, *args, **kwargs)
+
+    def _run_task(self, task, *args, **kwargs):
+        # the session is read here, after the previous tasks of the chat are done
+        session = self._get_session_from_any(args[0])
+
+        try:
+            task(session, *args, **kwargs)
+        finally:
+            if session is not None:
+                # write back everything the handler has changed at once
+                session.save()
 
     def message_handler(self, state=None, commands=None, regexp=None, func=None, content_types=['text']):
         return super().message_handler(commands=commands, regexp=regexp,
@@ -106,6 +250,145 @@ class BotLab(telebot.TeleBot):
     def callback_query_handler(self, inline_state=None, func=None, state=None):
         return super().callback_query_handler(func=func, inline_state=inline_state, state=state)
 
+    @staticmethod
+    def _build_handlers_index(handlers):
+        """
+        Split handlers into state-bound and generic ones.
+
+        A handler with both `state` and `inline_state` filters is indexed by
+        its `state` only; `inline_state` is then checked by its filter.
+
+        :param handlers: list of handler dicts in registration order
+        :return: dict with 'generic' list and 'state'/'inline_state' maps of
+            filter value -> list, all of (registration position, handler)
+        """
+        index = {'generic': [], 'state': {}, 'inline_state': {}}
+
+        for position, handler in enumerate(handlers):
+            filters = handler['filters']
+
+            for filter in ['state', 'inline_state']:
+                filter_value = filters.get(filter)
+
+                if filter_value is not None and isinstance(filter_value, collections.abc.Hashable):
+                    index[filter].setdefault(filter_value, []).append((position, handler))
+                    break
+            else:
+                index['generic'].append((position, handler))
+
+        return index
+
+    def _candidate_handlers(self, handlers, message):
+        """
+        Pick the handlers that may match a message without testing the state-bound ones one by one.
+
+        :param handlers: list of handler dicts in registration order
+        :param message: update to dispatch
+        :return: generic handlers and the handlers bound to the current state(s)
+            of the session, in registration order
+        """
+        index = self._get_handlers_index(handlers)
+
+        if len(index['state']) < 1 and len(index['inline_state']) < 1:
+            return handlers
+
+        return self._select_handlers(index, self._get_session_from_any(message))
+
+    def _get_handlers_index(self, handlers):
+        cached = self._handlers_indexes.get(id(handlers))
+
+        if cached is None or cached[0] != len(handlers):
+            cached = (len(handlers), self._build_handlers_index(handlers))
+            self._handlers_indexes[id(handlers)] = cached
+
+        return cached[1]
+
+    @staticmethod
+    def _select_handlers(index, session):
+        if session is None:
+            return [handler for _, handler in index['generic']]
+
+        candidates = [index['generic']]
+
+        if len(index['state']) > 0:
+            candidates.append(index['state'].get(session.get_state(), []))
+
+        if len(index['inline_state']) > 0:
+            candidates.append(index['inline_state'].get(session.get_inline_state(), []))
+
+        return [handler for _, handler in heapq.merge(*candidates, key=lambda candidate: candidate[0])]
+
+    def _notify_command_handlers(self, handlers, new_messages):
+        for message in new_messages:
+            # state filters have to see the state left by the previous updates of the chat,
+            # so handlers are picked on the chat's worker too
+            if self.threaded:
+                self.worker_pool.put(self._get_chat_id(message), self._dispatch, handlers, message)
+            else:
+                self._dispatch(handlers, message)
+
+    def _dispatch(self, handlers, message):
+        if self.metrics is not None:
+            return self._dispatch_measured(handlers, message)
+
+        for message_handler in self._candidate_handlers(handlers, message):
+            if self._test_message_handler(message_handler, message):
+                self._run_task(message_handler['function'], message)
+                break
+
+    def _dispatch_measured(self, handlers, message):
+        started_at = time.perf_counter()
+
+        for message_handler in self._candidate_handlers(handlers, message):
+            if self._test_message_handler(message_handler, message):
+                handler_started_at = time.perf_counter()
+                self.metrics.observe('botlab_dispatch_seconds', handler_started_at - started_at)
+
+                session = self._get_session_from_any(message)
+                state = None
+
+                if session is not None:
+                    # read as it is, the initial state is left for the handler to set
+                    states = session.get_field('inline_state' if isinstance(message, telebot.types.CallbackQuery)
+                                               else 'state')
+                    state = states[0] if len(states) > 0 else None
+
+                try:
+                    self._run_task(message_handler['function'], message)
+                finally:
+                    self.metrics.observe('botlab_handler_seconds', time.perf_counter() - handler_started_at,
+                                         {'handler': message_handler['function'].__name__, 'state': state})
+                break
+        else:
+            self.metrics.observe('botlab_dispatch_seconds', time.perf_counter() - started_at)
+
+    def _collect_metrics(self, metrics):
+        if self.threaded:
+            for shard, depth in enumerate(self.worker_pool.queue_depths()):
+                metrics.set_gauge('botlab_worker_queue_depth', depth, {'worker': shard})
+
+        if self.outbox is not None:
+            metrics.set_gauge('botlab_outbox_queue_depth', self.outbox.metrics()['queued'])
+
+        if self._storage_cache is not None:
+            stats = self._storage_cache.stats()
+
+            metrics.set_counter('botlab_storage_cache_requests_total', stats['hits'], {'result': 'hit'})
+            metrics.set_counter('botlab_storage_cache_requests_total', stats['misses'], {'result': 'miss'})
+            metrics.set_counter('botlab_storage_cache_evictions_total', stats['evictions'], {'reason': 'size'})
+            metrics.set_counter('botlab_storage_cache_evictions_total', stats['expirations'], {'reason': 'ttl'})
+            metrics.set_gauge('botlab_storage_cache_size', stats['size'])
+
+    def worker_pool_metrics(self):
+        """
+        :return: queue depths and counters of the worker pool(see `ShardedWorkerPool.metrics`)
+            or None if the bot is not threaded
+        """
+        if not self.threaded:
+            return None
+
+        return self.worker_pool.metrics()
+
     def _test_filter(self, filter, filter_value, message):
         test_result = super()._test_filter(filter, filter_value, message)
 
@@ -125,10 +408,25 @@ class BotLab(telebot.TeleBot):
         return False
 
     def broadcast_message(self, filter_options, text, **kwargs):
-        recipients = self._storage.collection(Session.SESSIONS_COLLECTION).get_field('chat_id', **filter_options)
+        """
+        Send a message to every user whose session conforms to the filter.
+
+        The message is sent in background(see `Broadcaster`).
+
+        :param filter_options: session filter, e.g. {'lang': 'en'}
+        :param text: message text
+        :param kwargs: other `send_message` arguments
+        :return: BroadcastJob to follow the progress with
+        """
+        return self._broadcaster.start(filter_options, text, **kwargs)
+
+    def resume_broadcasts(self):
+        """
+        Continue the broadcasts interrupted by a restart.
 
-        for recipient in recipients:
-            self.send_message(recipient, text, **kwargs)
+        :return: list of BroadcastJob
+        """
+        return [self._broadcaster.resume(job_id) for job_id in self._broadcaster.unfinished_jobs()]
 
     # override api methods in order to implement exceptions suppression
 
@@ -136,7 +434,7 @@ class BotLab(telebot.TeleBot):
         return self._remit(super().set_webhook, url=url, certificate=certificate)
 
     def get_updates(self, offset=None, limit=None, timeout=20):
-        return self._remit(super().get_updates, offset=offset, limit=limit)
+        return self._remit(super().get_updates, offset=offset, limit=limit, timeout=timeout)
 
     def get_me(self):
         return self._remit(super().get_me)
@@ -164,76 +462,76 @@ class BotLab(telebot.TeleBot):
 
     def send_message(self, chat_id, text, disable_web_page_preview=None, reply_to_message_id=None, reply_markup=None,
                      parse_mode=None, disable_notification=None):
-        return self._remit(super().send_message, chat_id=chat_id, text=text,
-                           disable_web_page_preview=disable_web_page_preview,
-                           reply_to_message_id=reply_to_message_id,
-                           reply_markup=reply_markup,
-                           parse_mode=parse_mode,
-                           disable_notification=disable_notification)
+        return self._deliver(super().send_message, chat_id=chat_id, text=text,
+                             disable_web_page_preview=disable_web_page_preview,
+                             reply_to_message_id=reply_to_message_id,
+                             reply_markup=reply_markup,
+                             parse_mode=parse_mode,
+                             disable_notification=disable_notification)
 
     def forward_message(self, chat_id, from_chat_id, message_id, disable_notification=None):
-        return self._remit(super().forward_message, chat_id=chat_id, from_chat_id=from_chat_id,
-                           message_id=message_id, disable_notification=disable_notification)
+        return self._deliver(super().forward_message, chat_id=chat_id, from_chat_id=from_chat_id,
+                             message_id=message_id, disable_notification=disable_notification)
 
     def send_photo(self, chat_id, photo, caption=None, reply_to_message_id=None, reply_markup=None,
                    disable_notification=None):
-        return self._remit(super().send_photo, chat_id=chat_id, photo=photo, caption=caption,
-                           reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
-                           disable_notification=disable_notification)
+        return self._deliver(super().send_photo, chat_id=chat_id, photo=photo, caption=caption,
+                             reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                             disable_notification=disable_notification)
 
     def send_audio(self, chat_id, audio, duration=None, performer=None, title=None, reply_to_message_id=None,
                    reply_markup=None, disable_notification=None, timeout=None):
-        return self._remit(super().send_audio, chat_id=chat_id, audio=audio, duration=duration,
-                           performer=performer, title=title, reply_to_message_id=reply_to_message_id,
-                           reply_markup=reply_markup, disable_notification=disable_notification,
-                           timeout=timeout)
+        return self._deliver(super().send_audio, chat_id=chat_id, audio=audio, duration=duration,
+                             performer=performer, title=title, reply_to_message_id=reply_to_message_id,
+                             reply_markup=reply_markup, disable_notification=disable_notification,
+                             timeout=timeout)
 
     def send_voice(self, chat_id, voice, duration=None, reply_to_message_id=None, reply_markup=None,
                    disable_notification=None, timeout=None):
-        return self._remit(super().send_voice, chat_id=chat_id, voice=voice, duration=duration,
-                           reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
-                           disable_notification=disable_notification, timeout=timeout)
+        return self._deliver(super().send_voice, chat_id=chat_id, voice=voice, duration=duration,
+                             reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                             disable_notification=disable_notification, timeout=timeout)
 
     def send_document(self, chat_id, data, reply_to_message_id=None, caption=None, reply_markup=None,
                       disable_notification=None, timeout=None):
-        return self._remit(super().send_document, chat_id=chat_id, data=data, reply_to_message_id=reply_to_message_id,
-                           caption=caption, reply_markup=reply_markup, disable_notification=disable_notification,
-                           timeout=timeout)
+        return self._deliver(super().send_document, chat_id=chat_id, data=data,
+                             reply_to_message_id=reply_to_message_id, caption=caption, reply_markup=reply_markup,
+                             disable_notification=disable_notification, timeout=timeout)
 
     def send_sticker(self, chat_id, data, reply_to_message_id=None, reply_markup=None, disable_notification=None,
                      timeout=None):
-        return self._remit(super().send_sticker, chat_id=chat_id, data=data, reply_to_message_id=reply_to_message_id,
-                           reply_markup=reply_markup, disable_notification=disable_notification,
-                           timeout=timeout)
+        return self._deliver(super().send_sticker, chat_id=chat_id, data=data,
+                             reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                             disable_notification=disable_notification, timeout=timeout)
 
     def send_video(self, chat_id, data, duration=None, caption=None, reply_to_message_id=None, reply_markup=None,
                    disable_notification=None, timeout=None):
-        return self._remit(super().send_video, chat_id=chat_id, data=data, duration=duration,
-                           caption=caption, reply_to_message_id=reply_to_message_id,
-                           reply_markup=reply_markup, disable_notification=disable_notification,
-                           timeout=timeout)
+        return self._deliver(super().send_video, chat_id=chat_id, data=data, duration=duration,
+                             caption=caption, reply_to_message_id=reply_to_message_id,
+                             reply_markup=reply_markup, disable_notification=disable_notification,
+                             timeout=timeout)
 
     def send_location(self, chat_id, latitude, longitude, reply_to_message_id=None, reply_markup=None,
                       disable_notification=None):
-        return self._remit(super().send_location, chat_id=chat_id, latitude=latitude,
-                           longitude=longitude, reply_to_message_id=reply_to_message_id,
-                           reply_markup=reply_markup, disable_notification=disable_notification)
+        return self._deliver(super().send_location, chat_id=chat_id, latitude=latitude,
+                             longitude=longitude, reply_to_message_id=reply_to_message_id,
+                             reply_markup=reply_markup, disable_notification=disable_notification)
 
     def send_venue(self, chat_id, latitude, longitude, title, address, foursquare_id=None, disable_notification=None,
                    reply_to_message_id=None, reply_markup=None):
-        return self._remit(super().send_venue, chat_id=chat_id, latitude=latitude, longitude=longitude,
-                           title=title, address=address, foursquare_id=foursquare_id,
-                           disable_notification=disable_notification, reply_to_message_id=reply_to_message_id,
-                           reply_markup=reply_markup)
+        return self._deliver(super().send_venue, chat_id=chat_id, latitude=latitude, longitude=longitude,
+                             title=title, address=address, foursquare_id=foursquare_id,
+                             disable_notification=disable_notification, reply_to_message_id=reply_to_message_id,
+                             reply_markup=reply_markup)
 
     def send_contact(self, chat_id, phone_number, first_name, last_name=None, disable_notification=None,
                      reply_to_message_id=None, reply_markup=None):
-        return self._remit(super().send_contact, chat_id=chat_id, phone_number=phone_number,
-                           first_name=first_name, last_name=last_name, disable_notification=disable_notification,
-                           reply_to_message_id=reply_to_message_id, reply_markup=reply_markup)
+        return self._deliver(super().send_contact, chat_id=chat_id, phone_number=phone_number,
+                             first_name=first_name, last_name=last_name, disable_notification=disable_notification,
+                             reply_to_message_id=reply_to_message_id, reply_markup=reply_markup)
 
     def send_chat_action(self, chat_id, action):
-        return self._remit(super().send_chat_action, chat_id=chat_id, action=action)
+        return self._deliver(super().send_chat_action, chat_id=chat_id, action=action)
 
     def kick_chat_member(self, chat_id, user_id):
         return self._remit(super().kick_chat_member, chat_id=chat_id, user_id=user_id)
@@ -243,55 +541,151 @@ class BotLab(telebot.TeleBot):
 
     def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, parse_mode=None,
                           disable_web_page_preview=None, reply_markup=None):
-        return self._remit(super().edit_message_text, text=text, chat_id=chat_id, message_id=message_id,
-                           inline_message_id=inline_message_id, parse_mode=parse_mode,
-                           disable_web_page_preview=disable_web_page_preview,
-                           reply_markup=reply_markup)
+        return self._deliver(super().edit_message_text, text=text, chat_id=chat_id, message_id=message_id,
+                             inline_message_id=inline_message_id, parse_mode=parse_mode,
+                             disable_web_page_preview=disable_web_page_preview,
+                             reply_markup=reply_markup)
 
     def edit_message_reply_markup(self, chat_id=None, message_id=None, inline_message_id=None, reply_markup=None):
-        return self._remit(super().edit_message_reply_markup, chat_id=chat_id, message_id=message_id,
-                           inline_message_id=inline_message_id, reply_markup=reply_markup)
+        return self._deliver(super().edit_message_reply_markup, chat_id=chat_id, message_id=message_id,
+                             inline_message_id=inline_message_id, reply_markup=reply_markup)
 
     def edit_message_caption(self, caption, chat_id=None, message_id=None, inline_message_id=None, reply_markup=None):
-        return self._remit(super().edit_message_caption, caption=caption, chat_id=chat_id, message_id=message_id,
-                           inline_message_id=inline_message_id, reply_markup=reply_markup)
+        return self._deliver(super().edit_message_caption, caption=caption, chat_id=chat_id,
+                             message_id=message_id, inline_message_id=inline_message_id, reply_markup=reply_markup)
 
     def reply_to(self, message, text, **kwargs):
-        return self._remit(super().reply_to, message, text, **kwargs)
+        return self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
 
     def answer_callback_query(self, callback_query_id, text=None, show_alert=None):
-        return self._remit(super().answer_callback_query, callback_query_id=callback_query_id,
-                           text=text, show_alert=show_alert)
+        return self._deliver(super().answer_callback_query, callback_query_id=callback_query_id,
+                             text=text, show_alert=show_alert)
 
     # --
 
 
 class Session(object):
+    """
+        User profile kept in the `sessions` collection.
+
+        The profile document is read from storage once, by `load()` or on
+        first access, and then served from memory. `fields` limits the read
+        to the fields listed(a projection); any other field is read when it
+        is first asked for. With `autosave` on, every change is written
+        through to storage right away; otherwise changes are collected and
+        written back in one update by `save()`.
+
+        A profile document read beforehand may be passed as `document`
+        ({} if there is none yet), then the session does not read storage.
+    """
     SESSIONS_COLLECTION = 'sessions'
 
-    def __init__(self, bot, chat_id, l10n, session_storage, config_manager):
+    def __init__(self, bot, chat_id, l10n, session_storage, config_manager, autosave=True, document=None,
+                 fields=None):
         self._bot = bot
         self.chat_id = chat_id
         self._storage = session_storage
         self._l10n = l10n
         self._config_manager = config_manager
+        self._autosave = autosave
+        self._fields = fields
+
+        # profile document as it is known to the session
+        self._document = None if document is None else dict(document)
+        # fields read into the document, None - all of them
+        self._loaded_fields = None
+        # fields changed since the last save
+        self._dirty = {}
+        self._is_new = document is not None and len(document) < 1
 
         self._translator = l10n.translator(self.get_lang())
 
     def profile(self):
         return self._storage.collection(Session.SESSIONS_COLLECTION)
 
+    def load(self, fields=None):
+        """
+        Read the profile from storage in one request. Changes not saved yet are kept.
+
+        :param fields: list of the fields to read, None - the fields the
+            session was created with(all of them by default)
+        :return: the session
+        """
+        if fields is None:
+            fields = self._fields
+
+        projection = None if fields is None else list(set(fields) | {'chat_id'})
+        found_document = self.profile().get_object({'chat_id': self.chat_id}, projection=projection)
+
+        self._is_new = found_document is None
+        self._document = {} if found_document is None else dict(found_document)
+        self._document.update(self._dirty)
+        self._loaded_fields = None if projection is None else set(projection)
+
+        return self
+
+    def _load(self, key=None):
+        if self._document is None:
+            self.load()
+        elif self._loaded_fields is not None and key is not None and key not in self._loaded_fields:
+            # the field was left out by the projection
+            found_document = self.profile().get_object({'chat_id': self.chat_id}, projection=[key])
+
+            if found_document is not None and key in found_document and key not in self._dirty:
+                self._document[key] = found_document[key]
+
+            self._loaded_fields.add(key)
+
+        return self._document
+
+    def is_new(self):
+        """
+        :return: True if the profile has never been written to storage
+        """
+        self._load()
+
+        return self._is_new
+
+    def save(self):
+        """
+        Write the fields changed since the last save back to storage in one update.
+
+        :return: True if anything was written
+        """
+        if len(self._dirty) < 1:
+            return False
+
+        dirty, self._dirty = self._dirty, {}
+        self._is_new = False
+
+        return self.profile().set_fields(dirty, multi=False, chat_id=self.chat_id)
+
     def get_field(self, key):
-        return self.profile().get_field(key, chat_id=self.chat_id)
+        value = self._load(key).get(key)
+
+        if value is None:
+            return []
+
+        return [value]
 
     def set_field(self, key, value):
-        return self.profile().set_field(key, value, multi=False, chat_id=self.chat_id)
+        self._load()[key] = value
+
+        if self._loaded_fields is not None:
+            self._loaded_fields.add(key)
+
+        if self._autosave:
+            return self.profile().set_field(key, value, multi=False, chat_id=self.chat_id)
+
+        self._dirty[key] = value
+
+        return True
 
     def _(self, key, **kwargs):
         return self._translator(key, **kwargs)
 
     def get_lang(self):
-        found_lang_values = self.profile().get_field('lang', chat_id=self.chat_id)
+        found_lang_values = self.get_field('lang')
         found_lang = None
 
         if len(found_lang_values) < 1:
@@ -345,6 +739,15 @@ class Session(object):
 
 
 class L10n(object):
+    """
+        Translations are compiled into flat per-language tables: strings
+        without placeholders are kept as they are, the rest are parsed once
+        into literal and field parts. Tables are kept in sync with
+        `set_translation`, with hot updates of the `l10n` config and with
+        changes noticed when the cached config is re-read.
+    """
+    _formatter = string.Formatter()
+
     def __init__(self, config_manager):
         self._config_manager = config_manager
 
@@ -361,27 +764,128 @@ class L10n(object):
             for translation_key in hot_translations.keys():
                 translations[translation_key] = hot_translations.get(translation_key)
 
+        # lang -> key -> translation value the table entry was compiled from
+        self._sources = {}
+        # lang -> key -> compiled translation
+        self._tables = {}
+        # serializes the changes of the tables, made by both bot and config notification threads
+        self._lock = threading.Lock()
+
         l10n['translations'] = translations
         config_manager.set('l10n', l10n)
 
+        self._rebuild(translations)
+
+        config_manager.add_listener(self._on_config_change)
+
+    @staticmethod
+    def _compile(template):
+        """
+        Parse a translation value once so that it is cheap to render.
+
+        :param template: translation value in `str.format` syntax
+        :return: the ready string if there are no placeholders,
+            otherwise a function rendering the value from a dict of arguments
+        """
+        try:
+            parts = list(L10n._formatter.parse(template))
+        except ValueError:
+            # malformed template: let str.format raise on use, as it always did
+            return lambda kwargs: template.format(**kwargs)
+
+        if all(field_name is None for _, field_name, _, _ in parts):
+            return ''.join(literal for literal, _, _, _ in parts)
+
+        if not all(field_name is None or field_name.isidentifier() for _, field_name, _, _ in parts) or \
+                any(format_spec and '{' in format_spec for _, _, format_spec, _ in parts):
+            # positional, attribute and item fields and nested format specs(`{count:>{width}}`) are left to str.format
+            return lambda kwargs: template.format(**kwargs)
+
+        conversions = {None: None, 'r': repr, 's': str, 'a': ascii}
+
+        compiled_parts = [(literal, field_name, format_spec, conversions[conversion])
+                          for literal, field_name, format_spec, conversion in parts]
+
+        def render(kwargs):
+            rendered = []
+
+            for literal, field_name, format_spec, convert in compiled_parts:
+                rendered.append(literal)
+
+                if field_name is None:
+                    continue
+
+                value = kwargs[field_name]
+
+                if convert is not None:
+                    value = convert(value)
+
+                rendered.append(format(value, format_spec))
+
+            return ''.join(rendered)
+
+        return render
+
+    def _rebuild(self, translations):
+        """
+        Compile new tables from the translations, reusing the entries of unchanged values,
+        and swap them in at once, so that translators never see a half-built table.
+
+        :param translations: dict of translation key -> dict of lang -> translation value
+        """
+        if translations is None:
+            translations = {}
+
+        with self._lock:
+            sources = {}
+            tables = {}
+
+            for key, translation_pair in translations.items():
+                if translation_pair is None:
+                    continue
+
+                for lang, value in translation_pair.items():
+                    if value is None:
+                        continue
+
+                    lang_sources = self._sources.get(lang, {})
+
+                    if key in lang_sources and lang_sources[key] == value:
+                        compiled = self._tables[lang][key]
+                    else:
+                        compiled = self._compile(value)
+
+                    sources.setdefault(lang, {})[key] = value
+                    tables.setdefault(lang, {})[key] = compiled
+
+            self._sources = sources
+            self._tables = tables
+
+    def _on_config_change(self, key):
+        if key != 'l10n':
+            return
+
+        l10n = self._config_manager.get('l10n')
+
+        if l10n is not None:
+            self._rebuild(l10n.get('translations'))
+
     def translator(self, lang):
         def translate(key, **kwargs):
-            translations = self._config_manager.get('l10n').get('translations')
-
-            if translations is None:
-                return None
+            # a cache hit as a rule; a stale `l10n` changed by others is re-read and the tables rebuilt
+            self._config_manager.get('l10n')
 
-            translation_pair = translations.get(key)
+            table = self._tables.get(lang)
 
-            if translation_pair is None:
+            if table is None:
                 return None
 
-            translation_value = translation_pair.get(lang)
+            translation = table.get(key)
 
-            if translation_value is None:
-                return None
+            if translation is None or translation.__class__ is str:
+                return translation
 
-            return translation_value.format(**kwargs)
+            return translation(kwargs)
 
         return translate
 
@@ -390,5 +894,12 @@ class L10n(object):
 
         l10n['translations'][key][lang] = value
 
-        self._config_manager.set('l10n', l10n)
+        with self._lock:
+            if value is None:
+                self._tables.get(lang, {}).pop(key, None)
+                self._sources.get(lang, {}).pop(key, None)
+            else:
+                self._tables.setdefault(lang, {})[key] = self._compile(value)
+                self._sources.setdefault(lang, {})[key] = value
 
+        self._config_manager.set('l10n', l10n)
@@ -0,0 +1,392 @@
+import asyncio
+import inspect
+import logging
+import re
+
+import telebot
+
+from botlab import BotLab, Session, L10n, backends
+from botlab.aio.api import AsyncBotApi
+from botlab.aio.configuration_manager import AsyncConfigurationManager
+from botlab.exceptions import NoConfigurationProvidedException
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBotLab(object):
+    """
+        BotLab counterpart running on asyncio.
+
+        Handlers are coroutines taking an AsyncSession and the update, the
+        same way BotLab handlers take a Session. States, inline states, l10n
+        and broadcasts work the same way and use the same configuration, so
+        a bot can be moved over handler by handler.
+
+        Nothing is read or connected to until `setup()`, which `polling()`
+        and `process_new_updates()` await on their own.
+
+        Updates of different chats are processed concurrently, those of one
+        chat - one after another, in the order they came in, so that
+        a handler always sees the state saved by the previous one.
+
+        :param config_dict: configuration, the same as for BotLab
+        :param concurrency: max number of updates processed at the same time
+    """
+    DEFAULT_CONCURRENCY = 1000
+
+    # dispatching helpers shared with BotLab
+    _build_handlers_index = staticmethod(BotLab._build_handlers_index)
+    _get_handlers_index = BotLab._get_handlers_index
+    _select_handlers = staticmethod(BotLab._select_handlers)
+    _get_chat_id = staticmethod(BotLab._get_chat_id)
+
+    def __init__(self, config_dict, concurrency=DEFAULT_CONCURRENCY):
+        if config_dict is None:
+            raise NoConfigurationProvidedException()
+
+        self._config_manager = AsyncConfigurationManager(config_dict)
+        self._concurrency = concurrency
+        self._ready = False
+        self._stopped = False
+        self._running_tasks = set()
+        # chat id -> [lock, number of updates holding or waiting for it], see `_process_update`
+        self._chat_locks = {}
+
+        self.api = None
+        self.l10n = None
+        self.last_update_id = 0
+
+        self.message_handlers = []
+        self.callback_query_handlers = []
+
+        # see `BotLab._candidate_handlers`
+        self._handlers_indexes = {}
+
+    async def setup(self):
+        if self._ready:
+            return
+
+        config_manager = self._config_manager
+
+        await config_manager.load()
+
+        self.api = AsyncBotApi(config_manager.get('bot').get('token'),
+                               config_manager.get('bot').get('pool_size', AsyncBotApi.DEFAULT_POOL_SIZE))
+        self._suppress_exceptions = config_manager.get('bot').get('suppress_exceptions')
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+
+        self.l10n = L10n(config_manager)
+
+        storage_type = config_manager.get('db_storage').get('type')
+        storage_params = config_manager.get('db_storage').get('params')
+
+        self._storage = backends.async_storages.get(storage_type)(storage_params)
+
+        await self._storage.setup()
+
+        from botlab.aio.broadcast import AsyncBroadcaster
+
+        self._broadcaster = AsyncBroadcaster(self, self._storage, Session.SESSIONS_COLLECTION,
+                                             config_manager.get('broadcast'))
+
+        self._ready = True
+
+    # handlers
+
+    def message_handler(self, state=None, commands=None, regexp=None, func=None, content_types=['text']):
+        def decorator(handler):
+            self.message_handlers.append({
+                'function': handler,
+                'filters': {'state': state, 'commands': commands, 'regexp': regexp, 'func': func,
+                            'content_types': content_types}
+            })
+
+            return handler
+
+        return decorator
+
+    def callback_query_handler(self, inline_state=None, func=None, state=None):
+        def decorator(handler):
+            self.callback_query_handlers.append({
+                'function': handler,
+                'filters': {'inline_state': inline_state, 'func': func, 'state': state}
+            })
+
+            return handler
+
+        return decorator
+
+    # dispatching
+
+    async def polling(self, timeout=20):
+        await self.setup()
+
+        self._stopped = False
+        error_interval = 0.25
+
+        while not self._stopped:
+            try:
+                updates = await self.api.get_updates(offset=self.last_update_id + 1, timeout=timeout)
+                error_interval = 0.25
+            except Exception as e:
+                if not self._suppress_exceptions:
+                    raise
+
+                # the same backoff as ShardSupervisor.polling, so that an outage doesn't turn into a busy loop
+                logger.error(e)
+                await asyncio.sleep(error_interval)
+                error_interval = min(error_interval * 2, 30)
+                continue
+
+            if not updates:
+                continue
+
+            self._start_processing(updates)
+
+    def stop_polling(self):
+        self._stopped = True
+
+    async def close(self):
+        """
+        Wait for the updates being processed and release connections.
+        """
+        self.stop_polling()
+
+        if len(self._running_tasks) > 0:
+            await asyncio.gather(*list(self._running_tasks))
+
+        if self._ready:
+            await self._config_manager.close()
+            await self._storage.close()
+            await self.api.close()
+
+    def _start_processing(self, updates):
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+
+            task = asyncio.ensure_future(self._process_update(update))
+
+            self._running_tasks.add(task)
+            task.add_done_callback(self._running_tasks.discard)
+
+    async def process_new_updates(self, updates):
+        if updates is None:
+            return
+
+        await self.setup()
+
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+
+        await asyncio.gather(*[self._process_update(update) for update in updates])
+
+    async def _process_update(self, update):
+        if update.message is not None:
+            handlers, message = self.message_handlers, update.message
+        elif update.callback_query is not None:
+            handlers, message = self.callback_query_handlers, update.callback_query
+        else:
+            return
+
+        chat_id = self._get_chat_id(message)
+
+        if chat_id is None:
+            async with self._semaphore:
+                await self._notify_handlers(handlers, message, None)
+
+            return
+
+        # taken before anything is awaited, so the updates of a chat queue up in the order they came in
+        chat_lock = self._chat_locks.get(chat_id)
+
+        if chat_lock is None:
+            chat_lock = [asyncio.Lock(), 0]
+            self._chat_locks[chat_id] = chat_lock
+
+        chat_lock[1] += 1
+
+        try:
+            async with chat_lock[0], self._semaphore:
+                session = await self._get_session(chat_id)
+
+                try:
+                    await self._notify_handlers(handlers, message, session)
+                finally:
+                    # the handler changes and the profile of a new user go in one write
+                    await session.save()
+        finally:
+            chat_lock[1] -= 1
+
+            if chat_lock[1] < 1:
+                del self._chat_locks[chat_id]
+
+    async def _notify_handlers(self, handlers, message, session):
+        index = self._get_handlers_index(handlers)
+
+        if len(index['state']) < 1 and len(index['inline_state']) < 1:
+            candidates = handlers
+        else:
+            candidates = self._select_handlers(index, session)
+
+        for handler in candidates:
+            if await self._test_handler(handler, message, session):
+                await handler['function'](session, message)
+                return
+
+    async def _test_handler(self, handler, message, session):
+        for filter, filter_value in handler['filters'].items():
+            if filter_value is None:
+                continue
+
+            if not await self._test_filter(filter, filter_value, message, session):
+                return False
+
+        return True
+
+    @staticmethod
+    async def _test_filter(filter, filter_value, message, session):
+        if filter == 'content_types':
+            return message.content_type in filter_value
+        elif filter == 'regexp':
+            return message.content_type == 'text' and re.search(filter_value, message.text, re.IGNORECASE)
+        elif filter == 'commands':
+            return message.content_type == 'text' and telebot.util.extract_command(message.text) in filter_value
+        elif filter == 'func':
+            test_result = filter_value(message)
+
+            if inspect.isawaitable(test_result):
+                test_result = await test_result
+
+            return test_result
+        elif filter == 'state':
+            return session is not None and session.get_state() == filter_value
+        elif filter == 'inline_state':
+            return session is not None and session.get_inline_state() == filter_value
+        else:
+            return False
+
+    async def _get_session_from_any(self, any):
+        chat_id = self._get_chat_id(any)
+
+        if chat_id is None:
+            return None
+
+        return await self._get_session(chat_id)
+
+    async def _get_session(self, chat_id):
+        document = await self._storage.get_object(Session.SESSIONS_COLLECTION, {'chat_id': chat_id})
+
+        return AsyncSession(self, chat_id, self.l10n, self._storage, self._config_manager,
+                            autosave=False, document={} if document is None else document)
+
+    # broadcasting
+
+    async def broadcast_message(self, filter_options, text, **kwargs):
+        """
+        :return: AsyncBroadcastJob, see `BotLab.broadcast_message`
+        """
+        return await self._broadcaster.start(filter_options, text, **kwargs)
+
+    async def resume_broadcasts(self):
+        return [await self._broadcaster.resume(job_id) for job_id in await self._broadcaster.unfinished_jobs()]
+
+    # api methods with exceptions suppression
+
+    async def _remit(self, coroutine):
+        """
+        Prevent a coroutine from throwing an exception.
+
+        :param coroutine: api call to await
+        :return: its result or None if exception was thrown
+        """
+        if self._suppress_exceptions:
+            try:
+                return await coroutine
+            except Exception:
+                return None
+        else:
+            return await coroutine
+
+    async def get_me(self):
+        return await self._remit(self.api.get_me())
+
+    async def set_webhook(self, url=None, certificate=None):
+        return await self._remit(self.api.set_webhook(url=url, certificate=certificate))
+
+    async def send_message(self, chat_id, text, disable_web_page_preview=None, reply_to_message_id=None,
+                           reply_markup=None, parse_mode=None, disable_notification=None):
+        return await self._remit(self.api.send_message(chat_id, text,
+                                                       disable_web_page_preview=disable_web_page_preview,
+                                                       reply_to_message_id=reply_to_message_id,
+                                                       reply_markup=reply_markup, parse_mode=parse_mode,
+                                                       disable_notification=disable_notification))
+
+    async def send_chat_action(self, chat_id, action):
+        return await self._remit(self.api.send_chat_action(chat_id, action))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, parse_mode=None,
+                                disable_web_page_preview=None, reply_markup=None):
+        return await self._remit(self.api.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                                            inline_message_id=inline_message_id,
+                                                            parse_mode=parse_mode,
+                                                            disable_web_page_preview=disable_web_page_preview,
+                                                            reply_markup=reply_markup))
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, inline_message_id=None,
+                                        reply_markup=None):
+        return await self._remit(self.api.edit_message_reply_markup(chat_id=chat_id, message_id=message_id,
+                                                                    inline_message_id=inline_message_id,
+                                                                    reply_markup=reply_markup))
+
+    async def answer_callback_query(self, callback_query_id, text=None, show_alert=None):
+        return await self._remit(self.api.answer_callback_query(callback_query_id, text=text, show_alert=show_alert))
+
+
+class AsyncSession(Session):
+    """
+        Session of AsyncBotLab. The profile is read before the handlers are
+        tested, so getters and setters work in memory exactly as in Session;
+        the changes are saved after the handler is done.
+
+        Storage cannot be read on first access here: a session is made with
+        its profile `document`, `await load()` re-reads it.
+    """
+    async def load(self, fields=None):
+        """
+        See `Session.load`.
+        """
+        if fields is None:
+            fields = self._fields
+
+        projection = None if fields is None else list(set(fields) | {'chat_id'})
+        found_document = await self.profile().get_object({'chat_id': self.chat_id}, projection=projection)
+
+        self._is_new = found_document is None
+        self._document = {} if found_document is None else dict(found_document)
+        self._document.update(self._dirty)
+        self._loaded_fields = None if projection is None else set(projection)
+
+        return self
+
+    def _load(self, key=None):
+        if self._document is None:
+            raise RuntimeError('The profile of chat {0} is not read yet, await load() first'.format(self.chat_id))
+
+        if self._loaded_fields is not None and key is not None and key not in self._loaded_fields:
+            raise RuntimeError('Field {0} was not read by load(), list it in `fields`'.format(key))
+
+        return self._document
+
+    async def save(self):
+        if len(self._dirty) < 1:
+            return False
+
+        dirty, self._dirty = self._dirty, {}
+        self._is_new = False
+
+        return await self.profile().set_fields(dirty, multi=False, chat_id=self.chat_id)
+
+    async def reply_message(self, text, *args, **kwargs):
+        return await self._bot.send_message(self.chat_id, text, **kwargs)
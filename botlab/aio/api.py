@@ -0,0 +1,140 @@
+import aiohttp
+from telebot import types
+from telebot.apihelper import ApiException
+
+
+class ApiResponse(object):
+    """
+        The part of an HTTP response `ApiException.result` is expected to
+        provide(see `botlab.rate_limiting.get_retry_after`).
+    """
+    def __init__(self, status_code, result_json):
+        self.status_code = status_code
+        self._result_json = result_json
+
+    def json(self):
+        return self._result_json
+
+
+class AsyncBotApi(object):
+    """
+        Bot API client on top of a pooled keep-alive aiohttp session.
+
+        :param token: bot token
+        :param pool_size: max number of simultaneous connections
+    """
+    API_URL = 'https://api.telegram.org/bot{0}/{1}'
+
+    DEFAULT_POOL_SIZE = 100
+
+    def __init__(self, token, pool_size=DEFAULT_POOL_SIZE):
+        self._token = token
+        self._pool_size = pool_size
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._pool_size))
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _convert_params(params):
+        converted = {}
+
+        for key, value in params.items():
+            if value is None:
+                continue
+
+            if isinstance(value, types.JsonSerializable):
+                value = value.to_json()
+            elif isinstance(value, bool):
+                value = 'true' if value else 'false'
+            elif not isinstance(value, (str, bytes)):
+                value = str(value)
+
+            converted[key] = value
+
+        return converted
+
+    async def call(self, method_name, request_timeout=None, **params):
+        """
+        Make a Bot API request.
+
+        :param method_name: Bot API method, e.g. 'sendMessage'
+        :param request_timeout: request timeout in seconds
+        :param params: method parameters; None values are skipped, markups are serialized
+        :return: `result` field of the response
+        :raises ApiException: if the request was unsuccessful
+        """
+        url = AsyncBotApi.API_URL.format(self._token, method_name)
+
+        if request_timeout is not None:
+            request_timeout = aiohttp.ClientTimeout(total=request_timeout)
+
+        async with self._get_session().post(url, data=self._convert_params(params),
+                                            timeout=request_timeout) as response:
+            try:
+                result_json = await response.json(content_type=None)
+            except (ValueError, aiohttp.ContentTypeError):
+                raise ApiException('The server returned an invalid JSON response.', method_name,
+                                   ApiResponse(response.status, {}))
+
+        if response.status != 200 or not result_json.get('ok'):
+            msg = 'Error code: {0} Description: {1}'.format(result_json.get('error_code'),
+                                                            result_json.get('description'))
+            raise ApiException(msg, method_name, ApiResponse(response.status, result_json))
+
+        return result_json['result']
+
+    async def get_updates(self, offset=None, limit=None, timeout=20):
+        result = await self.call('getUpdates', request_timeout=timeout + 10, offset=offset, limit=limit,
+                                 timeout=timeout)
+        return [types.Update.de_json(update) for update in result]
+
+    async def send_message(self, chat_id, text, disable_web_page_preview=None, reply_to_message_id=None,
+                           reply_markup=None, parse_mode=None, disable_notification=None):
+        result = await self.call('sendMessage', chat_id=chat_id, text=text,
+                                 disable_web_page_preview=disable_web_page_preview,
+                                 reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                                 parse_mode=parse_mode, disable_notification=disable_notification)
+        return types.Message.de_json(result)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, parse_mode=None,
+                                disable_web_page_preview=None, reply_markup=None):
+        result = await self.call('editMessageText', text=text, chat_id=chat_id, message_id=message_id,
+                                 inline_message_id=inline_message_id, parse_mode=parse_mode,
+                                 disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
+
+        if type(result) == bool:
+            return result
+
+        return types.Message.de_json(result)
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, inline_message_id=None,
+                                        reply_markup=None):
+        result = await self.call('editMessageReplyMarkup', chat_id=chat_id, message_id=message_id,
+                                 inline_message_id=inline_message_id, reply_markup=reply_markup)
+
+        if type(result) == bool:
+            return result
+
+        return types.Message.de_json(result)
+
+    async def answer_callback_query(self, callback_query_id, text=None, show_alert=None):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id, text=text,
+                               show_alert=show_alert)
+
+    async def send_chat_action(self, chat_id, action):
+        return await self.call('sendChatAction', chat_id=chat_id, action=action)
+
+    async def set_webhook(self, url=None, certificate=None):
+        return await self.call('setWebhook', url=url, certificate=certificate)
+
+    async def get_me(self):
+        return types.User.de_json(await self.call('getMe'))
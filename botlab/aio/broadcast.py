@@ -0,0 +1,148 @@
+import asyncio
+import uuid
+
+import telebot
+
+from botlab.broadcast import BroadcastJob, Broadcaster, _Progress
+from botlab.rate_limiting import get_retry_after
+
+
+class AsyncBroadcastJob(BroadcastJob):
+    def __init__(self, job_id):
+        super().__init__(job_id)
+
+        self._finished_future = asyncio.get_running_loop().create_future()
+
+    async def wait(self, timeout=None):
+        try:
+            await asyncio.wait_for(asyncio.shield(self._finished_future), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+    def _finish(self):
+        self._finished.set()
+
+        if not self._finished_future.done():
+            self._finished_future.set_result(True)
+
+
+class AsyncBroadcaster(Broadcaster):
+    """
+        Broadcaster counterpart for AsyncBotLab: workers are tasks, storage
+        and the Bot API are awaited. Takes the same configuration and keeps
+        progress in the same `broadcasts` collection.
+    """
+    async def start(self, filter_options, text, **kwargs):
+        job_id = uuid.uuid4().hex
+
+        # markups are saved as json, `send_message` takes them in that form too
+        kwargs = {key: value.to_json() if isinstance(value, telebot.types.JsonSerializable) else value
+                  for key, value in kwargs.items()}
+
+        await self._jobs().set_fields({'filter': filter_options, 'text': text, 'kwargs': kwargs,
+                                       'last_chat_id': None, 'sent': 0, 'failed': 0, 'finished': False,
+                                       'cancelled': False},
+                                      job_id=job_id)
+
+        return self._run(AsyncBroadcastJob(job_id), filter_options, text, kwargs, None)
+
+    async def resume(self, job_id):
+        saved_job = await self._jobs().get_object({'job_id': job_id})
+
+        if saved_job is None or saved_job.get('finished') or saved_job.get('cancelled'):
+            return None
+
+        job = AsyncBroadcastJob(job_id)
+        job.sent = saved_job.get('sent', 0)
+        job.failed = saved_job.get('failed', 0)
+
+        return self._run(job, saved_job['filter'], saved_job['text'], saved_job.get('kwargs') or {},
+                         saved_job.get('last_chat_id'))
+
+    async def unfinished_jobs(self):
+        return [saved_job['job_id'] for saved_job in await self._jobs().get_object({'finished': False}, multi=True)
+                if not saved_job.get('cancelled')]
+
+    def _run(self, job, filter_options, text, kwargs, last_chat_id):
+        tasks = asyncio.Queue(maxsize=self._workers * 2)
+        progress = _Progress(last_chat_id)
+
+        async def produce():
+            recipients = self._storage.collection(self._sessions_collection).iter_field_sorted(
+                'chat_id', after=last_chat_id, batch_size=Broadcaster.RECIPIENTS_BATCH_SIZE, **filter_options)
+            position = 0
+
+            async for recipient in recipients:
+                if job._cancelled.is_set():
+                    break
+
+                job.pending += 1
+                await tasks.put((position, recipient))
+                position += 1
+
+            for _ in range(self._workers):
+                await tasks.put(None)
+
+        async def work():
+            while True:
+                task = await tasks.get()
+
+                if task is None:
+                    return
+
+                position, recipient = task
+
+                if job._cancelled.is_set():
+                    delivered = None
+                else:
+                    delivered = await self._send(recipient, text, kwargs)
+
+                job.pending -= 1
+
+                if delivered is None:
+                    continue
+
+                if delivered:
+                    job.sent += 1
+                else:
+                    job.failed += 1
+
+                progress.complete(position, recipient)
+
+                if progress.completed % self._checkpoint_every == 0:
+                    await self._checkpoint(job, progress.last_chat_id, False)
+
+        async def supervise():
+            await asyncio.gather(produce(), *[work() for _ in range(self._workers)])
+            await self._checkpoint(job, progress.last_chat_id, not job._cancelled.is_set())
+
+            job._finish()
+
+        asyncio.ensure_future(supervise())
+
+        return job
+
+    async def _checkpoint(self, job, last_chat_id, finished):
+        await self._jobs().set_fields({'last_chat_id': last_chat_id, 'sent': job.sent, 'failed': job.failed,
+                                       'finished': finished, 'cancelled': job._cancelled.is_set()},
+                                      job_id=job.job_id)
+
+    async def _send(self, chat_id, text, kwargs):
+        for attempt in range(self._max_retries + 1):
+            await asyncio.sleep(max(self._rate_limiter.reserve(), self._chat_rate_limiter.reserve(chat_id)))
+
+            try:
+                await self._bot.api.send_message(chat_id, text, **kwargs)
+                return True
+            except Exception as e:
+                retry_after = get_retry_after(e)
+
+                if retry_after is None:
+                    return False
+
+                self._rate_limiter.pause(retry_after)
+                self._chat_rate_limiter.pause(chat_id, retry_after)
+
+        return False
@@ -0,0 +1,118 @@
+import asyncio
+
+from botlab import backends
+from botlab.configuration_manager import ConfigurationManager
+
+
+class AsyncConfigurationManager(ConfigurationManager):
+    """
+        ConfigurationManager counterpart for the event loop.
+
+        `load()` has to be awaited before use: it synchronizes kv-storage
+        with the configuration the same way ConfigurationManager does and
+        reads every top-level key into memory. After that `get` is a dict
+        lookup, and `set` updates memory at once and writes to kv-storage in
+        background(`flush()` waits for the writes to finish). Changes made
+        by others are picked up through kv-storage notifications and, in
+        case some are missed, by re-reading the values every
+        `config.max_staleness` seconds. `close()` stops both and waits for
+        the writes.
+    """
+    def __init__(self, config_dict, *args, **kwargs):
+        self._config_dict = None
+        self._pending_writes = set()
+        self._pending_reloads = set()
+        self._refresh_task = None
+
+        super().__init__(config_dict, *args, **kwargs)
+
+    def _create_kv_storage(self, kv_storage_type, params):
+        return backends.async_kv_storages.get(kv_storage_type)(params)
+
+    def _start(self, config_dict):
+        # nothing can be awaited here, see `load`
+        self._config_dict = config_dict
+
+    async def load(self):
+        kv_storage = self._kv_storage
+
+        found_vals = await kv_storage.get_many(self._config_dict.keys())
+        missing_vals = {key: value for key, value in self._config_dict.items() if key not in found_vals}
+
+        if len(missing_vals) > 0:
+            await kv_storage.set_many(missing_vals)
+
+        for key, value in self._config_dict.items():
+            self._cache[key] = (found_vals.get(key, value), None)
+
+        # values are re-read every `max_staleness` seconds even with notifications, see ConfigurationManager
+        await kv_storage.subscribe(self._on_change)
+
+        if self._max_staleness is not None:
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+
+    async def _reload(self, key):
+        found_val = await self._kv_storage.get(key)
+
+        if found_val is not None and found_val != self._cache.get(key, (None, None))[0]:
+            self._cache[key] = (found_val, None)
+
+            for listener in self._listeners:
+                listener(key)
+
+    def _on_change(self, key):
+        reload = asyncio.ensure_future(self._reload(key))
+
+        self._pending_reloads.add(reload)
+        reload.add_done_callback(self._pending_reloads.discard)
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(self._max_staleness)
+
+            for key in list(self._cache.keys()):
+                await self._reload(key)
+
+    def get(self, key, default=None):
+        cached = self._cache.get(key)
+
+        if cached is None:
+            return default
+
+        return cached[0]
+
+    def get_many(self, keys):
+        return {key: self._cache[key][0] for key in keys if key in self._cache}
+
+    def set(self, key, value):
+        self._cache[key] = (value, None)
+
+        write = asyncio.ensure_future(self._kv_storage.set(key, value))
+
+        self._pending_writes.add(write)
+        write.add_done_callback(self._pending_writes.discard)
+
+        for listener in self._listeners:
+            listener(key)
+
+    async def flush(self):
+        if len(self._pending_writes) > 0:
+            await asyncio.gather(*list(self._pending_writes))
+
+    async def close(self):
+        """
+        Wait for the writes to kv-storage and stop following its changes.
+        """
+        await self.flush()
+
+        tasks = list(self._pending_reloads)
+
+        if self._refresh_task is not None:
+            tasks.append(self._refresh_task)
+            self._refresh_task = None
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._kv_storage.close()
@@ -0,0 +1,256 @@
+import asyncio
+import uuid
+from abc import abstractmethod
+
+from botlab.kv_storage import KVStorage, RedisKVStorage, _change_message, _parse_change_message
+from botlab.serialization import Serializer
+
+
+class AsyncKVStorage(KVStorage):
+    @abstractmethod
+    async def get(self, key):
+        pass
+
+    @abstractmethod
+    async def set(self, key, value):
+        pass
+
+    @abstractmethod
+    async def exists(self, key):
+        pass
+
+    async def get_many(self, keys):
+        found_vals = {}
+
+        for key in keys:
+            found_val = await self.get(key)
+
+            if found_val is not None:
+                found_vals[key] = found_val
+
+        return found_vals
+
+    async def set_many(self, values):
+        for key, value in values.items():
+            await self.set(key, value)
+
+    async def exists_many(self, keys):
+        return {key for key in keys if await self.exists(key)}
+
+    async def subscribe(self, callback):
+        return False
+
+    async def close(self):
+        pass
+
+
+async def _cancel(task):
+    """
+    Cancel the task and wait for it to finish.
+    """
+    if task is None:
+        return
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+class AsyncInMemoryKVStorage(AsyncKVStorage):
+    def __init__(self, config=None):
+        super().__init__(config)
+        self._kv_storage = {}
+
+    async def get(self, key):
+        return self._kv_storage.get(key)
+
+    async def exists(self, key):
+        return key in self._kv_storage.keys()
+
+    async def set(self, key, value):
+        self._kv_storage[key] = value
+
+    async def get_many(self, keys):
+        return {key: self._kv_storage[key] for key in keys if key in self._kv_storage}
+
+    async def set_many(self, values):
+        self._kv_storage.update(values)
+
+    async def exists_many(self, keys):
+        return {key for key in keys if key in self._kv_storage}
+
+    async def subscribe(self, callback):
+        # nobody else can see the storage
+        return True
+
+
+class AsyncRedisKVStorage(AsyncKVStorage):
+    """
+        RedisKVStorage counterpart on top of redis.asyncio; uses the same
+        change notification channel, so sync and async bots can share
+        a configuration.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+
+        import redis.asyncio
+
+        self._redis = redis.asyncio.StrictRedis(host=config['host'], port=config['port'], db=config['db'])
+        self._channel = config.get('channel', RedisKVStorage.DEFAULT_CHANNEL)
+        self._serializer = Serializer(config.get('serialization'))
+        self._client_id = uuid.uuid4().hex
+        self._pubsub = None
+        self._listener_task = None
+
+    async def get(self, key):
+        found_val = await self._redis.get(key)
+
+        if found_val is None:
+            return None
+
+        return self._serializer.loads(found_val)
+
+    async def set(self, key, value):
+        await self._redis.set(key, self._serializer.dumps(value))
+        await self._redis.publish(self._channel, _change_message(self._client_id, key))
+
+    async def exists(self, key):
+        return await self._redis.exists(key)
+
+    async def get_many(self, keys):
+        keys = list(keys)
+
+        if len(keys) < 1:
+            return {}
+
+        return {key: self._serializer.loads(found_val)
+                for key, found_val in zip(keys, await self._redis.mget(keys)) if found_val is not None}
+
+    async def set_many(self, values):
+        if len(values) < 1:
+            return
+
+        pipeline = self._redis.pipeline(transaction=False)
+
+        for key, value in values.items():
+            pipeline.set(key, self._serializer.dumps(value))
+
+        for key in values.keys():
+            pipeline.publish(self._channel, _change_message(self._client_id, key))
+
+        await pipeline.execute()
+
+    async def exists_many(self, keys):
+        keys = list(keys)
+
+        if len(keys) < 1:
+            return set()
+
+        pipeline = self._redis.pipeline(transaction=False)
+
+        for key in keys:
+            pipeline.exists(key)
+
+        return {key for key, found in zip(keys, await pipeline.execute()) if found}
+
+    async def subscribe(self, callback):
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self._channel)
+
+        async def listen():
+            async for message in self._pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+
+                client_id, key = _parse_change_message(message['data'].decode('utf-8'))
+
+                if client_id != self._client_id:
+                    callback(key)
+
+        self._listener_task = asyncio.ensure_future(listen())
+
+        return True
+
+    async def close(self):
+        await _cancel(self._listener_task)
+        self._listener_task = None
+
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+        await self._redis.aclose()
+
+
+class AsyncMongoKVStorage(AsyncKVStorage):
+    """
+        MongoKVStorage counterpart on top of motor.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+
+        import motor.motor_asyncio
+
+        self._client = motor.motor_asyncio.AsyncIOMotorClient(host=config['host'], port=config['port'])
+        self._collection = self._client[config['db']][config['collection']]
+        self._watch_task = None
+
+    async def get(self, key):
+        return await self._collection.find_one({'key': key})
+
+    async def set(self, key, value):
+        await self._collection.update_one({'key': key}, {'$set': value}, upsert=True)
+
+    async def exists(self, key):
+        return await self._collection.count_documents({'key': key}, limit=1) > 0
+
+    async def get_many(self, keys):
+        return {found_val['key']: found_val
+                for found_val in await self._collection.find({'key': {'$in': list(keys)}}).to_list(None)}
+
+    async def set_many(self, values):
+        if len(values) < 1:
+            return
+
+        from pymongo import UpdateOne
+
+        await self._collection.bulk_write([UpdateOne({'key': key}, {'$set': value}, upsert=True)
+                                           for key, value in values.items()], ordered=False)
+
+    async def exists_many(self, keys):
+        return {found_val['key']
+                for found_val in await self._collection.find({'key': {'$in': list(keys)}}, {'key': 1}).to_list(None)}
+
+    async def subscribe(self, callback):
+        from pymongo.errors import PyMongoError
+
+        change_stream = self._collection.watch(full_document='updateLookup')
+
+        try:
+            # change streams are only available on replica sets and sharded clusters
+            first_change = await change_stream.try_next()
+        except PyMongoError:
+            return False
+
+        def notify(change):
+            document = change.get('fullDocument')
+
+            if document is not None:
+                callback(document.get('key'))
+
+        async def watch():
+            async with change_stream:
+                if first_change is not None:
+                    notify(first_change)
+
+                async for change in change_stream:
+                    notify(change)
+
+        self._watch_task = asyncio.ensure_future(watch())
+
+        return True
+
+    async def close(self):
+        await _cancel(self._watch_task)
+        self._watch_task = None
+
+        self._client.close()
@@ -0,0 +1,250 @@
+import heapq
+import logging
+from abc import abstractmethod
+
+from botlab import storage
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStorage(storage.Storage):
+    """
+        Storage interface with coroutine methods. `collection()` works the
+        same way as for `Storage`, its methods return awaitables.
+    """
+    @abstractmethod
+    async def get_field(self, collection_name, key, **filter_options):
+        pass
+
+    @abstractmethod
+    async def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
+        pass
+
+    async def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        for key, new_value in new_values.items():
+            await self.set_field(collection_name, key, new_value, multi=multi, **filter_options)
+
+        return True
+
+    async def bulk_set(self, collection_name, updates):
+        for filter_options, new_values in updates:
+            await self.set_fields(collection_name, new_values, **filter_options)
+
+        return True
+
+    @abstractmethod
+    async def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        pass
+
+    @abstractmethod
+    async def set_object(self, collection_name, new_object, filter_options, multi=False):
+        pass
+
+    @abstractmethod
+    async def remove_object(self, collection_name, filter_options, multi=False):
+        pass
+
+    async def iter_field(self, collection_name, key, batch_size=None, **filter_options):
+        async for obj in self.iter_objects(collection_name, filter_options, batch_size=batch_size, projection=[key]):
+            value = obj.get(key)
+
+            if value is not None:
+                yield value
+
+    async def iter_field_sorted(self, collection_name, key, after=None, batch_size=None, **filter_options):
+        """
+        :return: async iterator over the distinct field values in ascending order, see `Storage.iter_field_sorted`
+        """
+        batch_size = batch_size or storage.Storage.SORTED_BATCH_SIZE
+
+        while True:
+            batch = []
+
+            async for value in self.iter_field(collection_name, key, **filter_options):
+                if after is None or value > after:
+                    batch.append(value)
+
+                    # the smallest values only, a batch of them at most twice
+                    if len(batch) >= batch_size * 2:
+                        batch = heapq.nsmallest(batch_size, batch)
+
+            batch = heapq.nsmallest(batch_size, batch)
+
+            for value in batch:
+                if after is None or value > after:
+                    after = value
+                    yield value
+
+            if len(batch) < batch_size:
+                return
+
+    @abstractmethod
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        """
+        :return: async iterator over the conforming objects, see `Storage.iter_objects`
+        """
+        pass
+
+    async def setup(self):
+        """
+        Prepare the storage for use, e.g. create indexes.
+        """
+        pass
+
+    async def flush(self):
+        pass
+
+    async def sync(self):
+        return await self.flush()
+
+    async def close(self):
+        pass
+
+
+class AsyncInMemoryStorage(AsyncStorage):
+    """
+        Runs a synchronous in-process storage(InMemoryStorage by default)
+        right on the event loop: its operations never wait for I/O.
+    """
+    def __init__(self, config, backend=None):
+        super().__init__(config)
+
+        self._backend = backend if backend is not None else storage.InMemoryStorage(config)
+
+    async def get_field(self, collection_name, key, **filter_options):
+        return self._backend.get_field(collection_name, key, **filter_options)
+
+    async def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
+        return self._backend.set_field(collection_name, key, new_value, multi, **filter_options)
+
+    async def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        return self._backend.set_fields(collection_name, new_values, multi, **filter_options)
+
+    async def bulk_set(self, collection_name, updates):
+        return self._backend.bulk_set(collection_name, updates)
+
+    async def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        return self._backend.get_object(collection_name, filter_options, multi, projection)
+
+    async def set_object(self, collection_name, new_object, filter_options, multi=False):
+        return self._backend.set_object(collection_name, new_object, filter_options, multi)
+
+    async def remove_object(self, collection_name, filter_options, multi=False):
+        return self._backend.remove_object(collection_name, filter_options, multi)
+
+    async def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        for obj in self._backend.iter_objects(collection_name, filter_options, batch_size, projection):
+            yield obj
+
+    async def flush(self):
+        self._backend.flush()
+
+    async def close(self):
+        self._backend.close()
+
+
+class AsyncDiskStorage(AsyncInMemoryStorage):
+    """
+        DiskStorage run on the event loop. File writes are made on the loop
+        as well, so consider `write_behind`.
+    """
+    def __init__(self, config):
+        super().__init__(config, storage.DiskStorage(config))
+
+
+class AsyncMongoStorage(AsyncStorage):
+    """
+        MongoStorage counterpart on top of motor.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+
+        import motor.motor_asyncio
+
+        mongo_client = motor.motor_asyncio.AsyncIOMotorClient(config['host'], config['port'])
+
+        self.db = mongo_client[config['database']]
+        self._indexes = config.get('indexes', storage.MongoStorage.DEFAULT_INDEXES)
+
+    async def setup(self):
+        from pymongo.errors import OperationFailure
+
+        for collection_name, fields in self._indexes.items():
+            for field in fields:
+                if isinstance(field, str):
+                    field = {'key': field}
+
+                try:
+                    await self.db[collection_name].create_index(field['key'], unique=field.get('unique', False))
+                except OperationFailure as e:
+                    logger.error('Failed to create index on %s.%s: %s', collection_name, field['key'], e)
+
+    async def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
+        return await self.set_fields(collection_name, {key: new_value}, multi, **filter_options)
+
+    async def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        if multi:
+            return await self.db[collection_name].update_many(filter_options, {'$set': new_values}, upsert=True)
+        else:
+            return await self.db[collection_name].update_one(filter_options, {'$set': new_values}, upsert=True)
+
+    async def bulk_set(self, collection_name, updates):
+        from pymongo import UpdateOne
+
+        operations = [UpdateOne(filter_options, {'$set': new_values}, upsert=True)
+                      for filter_options, new_values in updates]
+
+        if len(operations) < 1:
+            return True
+
+        return await self.db[collection_name].bulk_write(operations, ordered=False)
+
+    async def get_field(self, collection_name, key, **filter_options):
+        found_values = []
+
+        async for found_object in self.db[collection_name].find(filter_options, {key: 1, '_id': 0}):
+            found_value = storage.MongoStorage._field_value(found_object, key)
+
+            if found_value is not None:
+                found_values.append(found_value)
+
+        return found_values
+
+    async def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        if multi:
+            return await self.db[collection_name].find(filter_options, projection).to_list(None)
+        else:
+            return await self.db[collection_name].find_one(filter_options, projection)
+
+    async def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        cursor = self.db[collection_name].find(filter_options, projection).sort('_id', 1)
+
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+
+        async for obj in cursor:
+            yield obj
+
+    async def iter_field_sorted(self, collection_name, key, after=None, batch_size=None, **filter_options):
+        cursor = self.db[collection_name].find(storage.MongoStorage._sorted_field_query(key, after, filter_options),
+                                               {key: 1, '_id': 0}).sort(key, 1)
+        cursor = cursor.batch_size(batch_size or storage.Storage.SORTED_BATCH_SIZE)
+
+        async for obj in cursor:
+            value = obj.get(key)
+
+            if value is not None and (after is None or value > after):
+                after = value
+                yield value
+
+    async def set_object(self, collection_name, new_object, filter_options, multi=False):
+        if multi:
+            await self.db[collection_name].delete_many(filter_options)
+
+        return await self.db[collection_name].replace_one(filter_options, new_object, upsert=True)
+
+    async def remove_object(self, collection_name, filter_options, multi=False):
+        if multi:
+            return await self.db[collection_name].delete_many(filter_options)
+        else:
+            return await self.db[collection_name].delete_one(filter_options)
@@ -0,0 +1,105 @@
+import importlib
+
+from botlab.exceptions import UnknownStorageException, UnsupportedKVStorageException
+
+
+class BackendRegistry(object):
+    """
+        Storage types by name. A backend is kept as 'module:attribute' path
+        and only imported when it is selected, so that `import botlab` loads
+        no client library(pymongo, redis, ...) of a backend nobody uses.
+
+        Other packages add backends either by `register` or through the
+        `entry_point_group` of their distribution, e.g. in setup.py:
+
+            entry_points={
+                'botlab.storages': ['dynamo = botlab_dynamo:DynamoStorage']
+            }
+
+        Entry points are only looked through for the names that are not
+        registered. A backend is called with the `params` of its section of
+        the configuration.
+
+        :param entry_point_group: name of the entry point group
+        :param exception_class: exception raised for an unknown name
+        :param backends: dict, name -> class or 'module:attribute' path
+    """
+    def __init__(self, entry_point_group, exception_class, backends=None):
+        self.entry_point_group = entry_point_group
+        self._exception_class = exception_class
+        self._backends = dict(backends or {})
+
+    def register(self, name, backend):
+        """
+        :param name: storage type, as in the `type` of the configuration
+        :param backend: class(or any callable taking the params) or 'module:attribute' path
+        """
+        self._backends[name] = backend
+
+    def names(self):
+        """
+        :return: names of the registered backends, without those of the entry points
+        """
+        return sorted(self._backends.keys())
+
+    def get(self, name):
+        """
+        :return: backend class, imported if needed
+        """
+        backend = self._backends.get(name)
+
+        if backend is None:
+            backend = self._load_entry_point(name)
+
+        if isinstance(backend, str):
+            module_name, _, attribute = backend.partition(':')
+            backend = getattr(importlib.import_module(module_name), attribute)
+
+        self._backends[name] = backend
+
+        return backend
+
+    def _load_entry_point(self, name):
+        # not needed on the way of the built-in backends
+        import importlib.metadata
+
+        entry_points = importlib.metadata.entry_points()
+
+        if hasattr(entry_points, 'select'):
+            found = entry_points.select(group=self.entry_point_group, name=name)
+        else:
+            # python < 3.10
+            found = [entry_point for entry_point in entry_points.get(self.entry_point_group, [])
+                     if entry_point.name == name]
+
+        for entry_point in found:
+            return entry_point.load()
+
+        raise self._exception_class('Unknown storage type: {0}'.format(name))
+
+
+storages = BackendRegistry('botlab.storages', UnknownStorageException, {
+    'inmemory': 'botlab.storage:InMemoryStorage',
+    'disk': 'botlab.storage:DiskStorage',
+    'mongo': 'botlab.storage:MongoStorage',
+    'paged': 'botlab.paged_storage:PagedStorage',
+    'sqlite': 'botlab.sqlite_storage:SqliteStorage'
+})
+
+kv_storages = BackendRegistry('botlab.kv_storages', UnsupportedKVStorageException, {
+    'inmemory': 'botlab.kv_storage:InMemoryKVStorage',
+    'redis': 'botlab.kv_storage:RedisKVStorage',
+    'mongo': 'botlab.kv_storage:MongoKVStorage'
+})
+
+async_storages = BackendRegistry('botlab.aio.storages', UnknownStorageException, {
+    'inmemory': 'botlab.aio.storage:AsyncInMemoryStorage',
+    'disk': 'botlab.aio.storage:AsyncDiskStorage',
+    'mongo': 'botlab.aio.storage:AsyncMongoStorage'
+})
+
+async_kv_storages = BackendRegistry('botlab.aio.kv_storages', UnsupportedKVStorageException, {
+    'inmemory': 'botlab.aio.kv_storage:AsyncInMemoryKVStorage',
+    'redis': 'botlab.aio.kv_storage:AsyncRedisKVStorage',
+    'mongo': 'botlab.aio.kv_storage:AsyncMongoKVStorage'
+})
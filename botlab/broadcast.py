@@ -0,0 +1,258 @@
+import queue
+import threading
+import uuid
+
+import telebot
+
+from botlab.rate_limiting import TokenBucket, KeyedRateLimiter, get_retry_after
+
+
+class BroadcastJob(object):
+    """
+        Handle of a running broadcast.
+
+        * sent - number of recipients the message was delivered to
+        * failed - number of recipients the message could not be delivered to
+        * pending - number of recipients taken from storage but not
+            processed yet
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.sent = 0
+        self.failed = 0
+        self.pending = 0
+
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the broadcast to finish.
+
+        :param timeout: seconds to wait for, None - as long as it takes
+        :return: True if the broadcast has finished
+        """
+        return self._finished.wait(timeout)
+
+
+class Broadcaster(object):
+    """
+        Sends a message to every session conforming to a filter.
+
+        Chat ids of the recipients are read from storage in batches by
+        a producer thread, and the message is sent by a bounded pool of
+        workers, rate limited both globally and per chat.
+        Sends rejected by flood control(429) are retried after the time
+        Telegram asks for.
+
+        Progress is saved to the `broadcasts` collection, so a broadcast
+        interrupted by a restart can be picked up again with `resume`.
+        A cancelled broadcast is saved as such and is not resumed.
+        Recipients are streamed from storage in the order of their chat ids
+        (`Storage.iter_field_sorted`), and the saved cursor is the chat id
+        up to which all of them have been processed, so sessions removed,
+        rewritten or changed meanwhile don't shift it.
+
+        Configuration(the `broadcast` section, all optional):
+            * workers - number of sending threads, 8 by default
+            * rate - messages per second in total, 25 by default
+            * per_chat_rate - messages per second to a single chat, 1 by default
+            * max_retries - attempts after a 429 before giving up, 3 by default
+            * checkpoint_every - processed recipients between saves of the cursor, 100 by default
+    """
+    BROADCASTS_COLLECTION = 'broadcasts'
+
+    DEFAULT_WORKERS = 8
+    DEFAULT_RATE = 25
+    DEFAULT_PER_CHAT_RATE = 1
+    DEFAULT_MAX_RETRIES = 3
+    DEFAULT_CHECKPOINT_EVERY = 100
+
+    RECIPIENTS_BATCH_SIZE = 1000
+
+    def __init__(self, bot, storage, sessions_collection, config=None):
+        config = config or {}
+
+        self._bot = bot
+        self._storage = storage
+        self._sessions_collection = sessions_collection
+
+        self._workers = config.get('workers', Broadcaster.DEFAULT_WORKERS)
+        self._max_retries = config.get('max_retries', Broadcaster.DEFAULT_MAX_RETRIES)
+        self._checkpoint_every = config.get('checkpoint_every', Broadcaster.DEFAULT_CHECKPOINT_EVERY)
+
+        self._rate_limiter = TokenBucket(config.get('rate', Broadcaster.DEFAULT_RATE))
+        self._chat_rate_limiter = KeyedRateLimiter(config.get('per_chat_rate', Broadcaster.DEFAULT_PER_CHAT_RATE))
+
+    def _jobs(self):
+        return self._storage.collection(Broadcaster.BROADCASTS_COLLECTION)
+
+    def start(self, filter_options, text, **kwargs):
+        """
+        Start a broadcast.
+
+        :param filter_options: filter the recipient sessions must conform to
+        :param text: message text
+        :param kwargs: other `send_message` arguments
+        :return: BroadcastJob
+        """
+        job_id = uuid.uuid4().hex
+
+        # markups are saved as json, `send_message` takes them in that form too
+        kwargs = {key: value.to_json() if isinstance(value, telebot.types.JsonSerializable) else value
+                  for key, value in kwargs.items()}
+
+        self._jobs().set_fields({'filter': filter_options, 'text': text, 'kwargs': kwargs,
+                                 'last_chat_id': None, 'sent': 0, 'failed': 0, 'finished': False,
+                                 'cancelled': False}, job_id=job_id)
+
+        return self._run(BroadcastJob(job_id), filter_options, text, kwargs, None)
+
+    def resume(self, job_id):
+        """
+        Continue an interrupted broadcast from its saved cursor.
+
+        :param job_id: id of the broadcast
+        :return: BroadcastJob or None if there is no such unfinished broadcast
+        """
+        saved_job = self._jobs().get_object({'job_id': job_id})
+
+        if saved_job is None or saved_job.get('finished') or saved_job.get('cancelled'):
+            return None
+
+        job = BroadcastJob(job_id)
+        job.sent = saved_job.get('sent', 0)
+        job.failed = saved_job.get('failed', 0)
+
+        return self._run(job, saved_job['filter'], saved_job['text'], saved_job.get('kwargs') or {},
+                         saved_job.get('last_chat_id'))
+
+    def unfinished_jobs(self):
+        """
+        :return: ids of the broadcasts interrupted before they finished, except the cancelled ones
+        """
+        return [saved_job['job_id'] for saved_job in self._jobs().get_object({'finished': False}, multi=True)
+                if not saved_job.get('cancelled')]
+
+    def _run(self, job, filter_options, text, kwargs, last_chat_id):
+        tasks = queue.Queue(maxsize=self._workers * 2)
+        progress = _Progress(last_chat_id)
+
+        def produce():
+            recipients = self._storage.collection(self._sessions_collection).iter_field_sorted(
+                'chat_id', after=last_chat_id, batch_size=Broadcaster.RECIPIENTS_BATCH_SIZE, **filter_options)
+
+            for position, recipient in enumerate(recipients):
+                if job._cancelled.is_set():
+                    break
+
+                with progress.lock:
+                    job.pending += 1
+
+                tasks.put((position, recipient))
+
+            for _ in range(self._workers):
+                tasks.put(None)
+
+        def work():
+            while True:
+                task = tasks.get()
+
+                if task is None:
+                    return
+
+                position, recipient = task
+
+                if job._cancelled.is_set():
+                    delivered = None
+                else:
+                    delivered = self._send(recipient, text, kwargs)
+
+                with progress.lock:
+                    job.pending -= 1
+
+                    if delivered:
+                        job.sent += 1
+                    elif delivered is not None:
+                        job.failed += 1
+
+                    if delivered is not None:
+                        progress.complete(position, recipient)
+
+                        if progress.completed % self._checkpoint_every == 0:
+                            self._checkpoint(job, progress.last_chat_id, False)
+
+        def supervise():
+            workers = [threading.Thread(target=work, daemon=True) for _ in range(self._workers)]
+
+            for worker in workers:
+                worker.start()
+
+            produce()
+
+            for worker in workers:
+                worker.join()
+
+            self._checkpoint(job, progress.last_chat_id, not job._cancelled.is_set())
+            job._finished.set()
+
+        threading.Thread(target=supervise, daemon=True).start()
+
+        return job
+
+    def _checkpoint(self, job, last_chat_id, finished):
+        self._jobs().set_fields({'last_chat_id': last_chat_id, 'sent': job.sent, 'failed': job.failed,
+                                 'finished': finished, 'cancelled': job._cancelled.is_set()}, job_id=job.job_id)
+
+    def _send(self, chat_id, text, kwargs):
+        """
+        :return: True if the message was delivered, False otherwise
+        """
+        for attempt in range(self._max_retries + 1):
+            self._rate_limiter.acquire()
+            self._chat_rate_limiter.acquire(chat_id)
+
+            try:
+                # bypass exceptions suppression: failures have to be seen here
+                telebot.TeleBot.send_message(self._bot, chat_id, text, **kwargs)
+                return True
+            except Exception as e:
+                retry_after = get_retry_after(e)
+
+                if retry_after is None:
+                    return False
+
+                self._rate_limiter.pause(retry_after)
+                self._chat_rate_limiter.pause(chat_id, retry_after)
+
+        return False
+
+
+class _Progress(object):
+    """
+        Tracks the chat id up to which all the recipients have been
+        processed, while workers finish them out of order.
+    """
+    def __init__(self, last_chat_id):
+        self.lock = threading.Lock()
+        self.last_chat_id = last_chat_id
+        self.completed = 0
+        # position of the first recipient not processed yet
+        self._next_position = 0
+        # position -> chat id of the recipients processed after it
+        self._completed_ahead = {}
+
+    def complete(self, position, chat_id):
+        self.completed += 1
+        self._completed_ahead[position] = chat_id
+
+        while self._next_position in self._completed_ahead:
+            self.last_chat_id = self._completed_ahead.pop(self._next_position)
+            self._next_position += 1
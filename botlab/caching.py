@@ -0,0 +1,409 @@
+import atexit
+import collections
+import logging
+import threading
+import time
+
+from botlab.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class CachingStorage(Storage):
+    """
+        Storage keeping the recently used objects of another one in memory.
+
+        Objects looked up by their key field alone(`keys`, collection name ->
+        field, {'sessions': 'chat_id'} by default), the way sessions are
+        read, are cached: at most `max_size` of them per collection, the
+        least recently used ones evicted first, each trusted for `ttl`
+        seconds after it was read(None - until evicted). The key field is
+        expected to be unique, as `chat_id` of sessions is. Any other request
+        is passed on to the backend; a change made by any other filter drops
+        the cached objects of the collection.
+
+        Changes are written through to the backend right away. With
+        `write_behind` set, changes made by the key field are applied to the
+        cache and queued instead, and a background thread writes them out in
+        one `bulk_set` per collection every `flush_interval_ms` milliseconds
+        or every `flush_every` changes, whichever comes first. Requests the
+        cache cannot serve write the queued changes of their collection out
+        first. Changes the backend failed to write stay queued for the next
+        attempt.
+
+        :param storage: storage to cache the objects of
+        :param config: dict with `max_size`, `ttl`, `keys`, `write_behind`,
+            `flush_interval_ms` and `flush_every`
+    """
+    DEFAULT_MAX_SIZE = 10000
+    DEFAULT_TTL = 60
+    DEFAULT_KEYS = {
+        'sessions': 'chat_id'
+    }
+    DEFAULT_FLUSH_INTERVAL_MS = 1000
+    DEFAULT_FLUSH_EVERY = 1000
+
+    def __init__(self, storage, config=None):
+        config = config or {}
+
+        super().__init__(storage.config)
+
+        self.storage = storage
+        self._max_size = config.get('max_size', CachingStorage.DEFAULT_MAX_SIZE)
+        self._ttl = config.get('ttl', CachingStorage.DEFAULT_TTL)
+        self._keys = config.get('keys', CachingStorage.DEFAULT_KEYS)
+
+        self._write_behind = config.get('write_behind', False)
+        self._flush_interval = config.get('flush_interval_ms', CachingStorage.DEFAULT_FLUSH_INTERVAL_MS) / 1000
+        self._flush_every = config.get('flush_every', CachingStorage.DEFAULT_FLUSH_EVERY)
+
+        self._lock = threading.RLock()
+        # serializes writing queued changes out
+        self._flush_lock = threading.Lock()
+
+        # collection name -> key value -> (object or None if there is none, time it expires at), LRU first
+        self._cache = {}
+        # collection name -> key value -> changes not written out yet
+        self._pending = {}
+        self._pending_count = 0
+        # changes being written out by `flush`, still newer than what the backend has
+        self._flushing = {}
+        # (collection name, key value) of the objects being read -> whether they were changed meanwhile,
+        # so that reads racing with writes are not cached
+        self._loading = {}
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        self._flusher_thread = None
+
+        if self._write_behind:
+            self._flusher_thread = threading.Thread(target=self._flusher, daemon=True)
+            self._flusher_thread.start()
+
+            atexit.register(self.close)
+
+    def _cache_key(self, collection_name, filter_options):
+        """
+        :return: value of the key field if the filter is by the key field alone, otherwise None
+        """
+        key_field = self._keys.get(collection_name)
+
+        if key_field is None or len(filter_options) != 1 or key_field not in filter_options:
+            return None
+
+        key_value = filter_options[key_field]
+
+        try:
+            hash(key_value)
+        except TypeError:
+            return None
+
+        return key_value
+
+    def _get_cached(self, collection_name, key_value):
+        """
+        :return: cached object(shared, do not modify) or None if there is none, reading it on a miss
+        """
+        with self._lock:
+            cache = self._cache.setdefault(collection_name, collections.OrderedDict())
+            entry = cache.get(key_value)
+
+            if entry is not None:
+                if entry[1] is None or entry[1] > time.monotonic():
+                    cache.move_to_end(key_value)
+                    self._hits += 1
+
+                    return entry[0]
+
+                del cache[key_value]
+                self._expirations += 1
+
+            self._misses += 1
+            self._loading.setdefault((collection_name, key_value), False)
+
+        key_field = self._keys[collection_name]
+
+        try:
+            obj = self.storage.get_object(collection_name, {key_field: key_value})
+        finally:
+            with self._lock:
+                # a concurrent read of the same object may have finished first
+                changed = self._loading.pop((collection_name, key_value), True)
+
+        with self._lock:
+            # changes the backend has not got yet
+            for changes in [self._flushing, self._pending]:
+                new_values = changes.get(collection_name, {}).get(key_value)
+
+                if new_values is not None:
+                    obj = dict(obj) if obj is not None else {key_field: key_value}
+                    obj.update(new_values)
+
+            if not changed:
+                self._put(collection_name, key_value, obj)
+
+        return obj
+
+    def _put(self, collection_name, key_value, obj):
+        cache = self._cache.setdefault(collection_name, collections.OrderedDict())
+        cache[key_value] = (obj, None if self._ttl is None else time.monotonic() + self._ttl)
+        cache.move_to_end(key_value)
+
+        while len(cache) > self._max_size:
+            cache.popitem(last=False)
+            self._evictions += 1
+
+    def _mark_changed(self, collection_name, key_value=None):
+        for loading_key in self._loading:
+            if loading_key[0] == collection_name and (key_value is None or loading_key[1] == key_value):
+                self._loading[loading_key] = True
+
+    def _update_cached(self, collection_name, key_value, new_values):
+        if len(self._loading) > 0:
+            self._mark_changed(collection_name, key_value)
+
+        entry = self._cache.get(collection_name, {}).get(key_value)
+
+        if entry is None:
+            return
+
+        # cached objects are shared with the callers, so they are replaced instead of changed
+        obj = dict(entry[0]) if entry[0] is not None else {self._keys[collection_name]: key_value}
+        obj.update(new_values)
+
+        self._cache[collection_name][key_value] = (obj, entry[1])
+
+    def _invalidate(self, collection_name, key_value=None):
+        with self._lock:
+            self._mark_changed(collection_name, key_value)
+
+            if key_value is None:
+                self._cache.pop(collection_name, None)
+            else:
+                self._cache.get(collection_name, {}).pop(key_value, None)
+
+    def _queue(self, collection_name, key_value, new_values):
+        with self._lock:
+            self._update_cached(collection_name, key_value, new_values)
+            self._pending.setdefault(collection_name, {}).setdefault(key_value, {}).update(new_values)
+            self._pending_count += 1
+
+            if self._pending_count >= self._flush_every:
+                self._flush_requested.set()
+
+    def _flush_pending(self, collection_name=None):
+        """
+        Write the queued changes(of one collection or all of them) out to the backend.
+        """
+        if not self._write_behind:
+            return
+
+        with self._flush_lock:
+            with self._lock:
+                if collection_name is None:
+                    self._flushing, self._pending = self._pending, {}
+                    self._pending_count = 0
+                elif collection_name in self._pending:
+                    self._flushing = {collection_name: self._pending.pop(collection_name)}
+                    self._pending_count = sum(len(pending) for pending in self._pending.values())
+                else:
+                    return
+
+            try:
+                for flushing_collection_name, changes in self._flushing.items():
+                    key_field = self._keys[flushing_collection_name]
+
+                    self.storage.bulk_set(flushing_collection_name, [({key_field: key_value}, new_values)
+                                                                     for key_value, new_values in changes.items()])
+            except BaseException:
+                with self._lock:
+                    self._requeue(self._flushing)
+
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _requeue(self, changes):
+        """
+        Queue the changes that failed to be written out again, under the ones made meanwhile.
+        """
+        for collection_name, collection_changes in changes.items():
+            pending = self._pending.setdefault(collection_name, {})
+
+            for key_value, new_values in collection_changes.items():
+                requeued = dict(new_values)
+                requeued.update(pending.get(key_value, {}))
+                pending[key_value] = requeued
+
+        self._pending_count = sum(len(pending) for pending in self._pending.values())
+
+    def _flusher(self):
+        while not self._closed.is_set():
+            self._flush_requested.wait(self._flush_interval)
+            self._flush_requested.clear()
+
+            try:
+                self._flush_pending()
+            except Exception:
+                # the changes are queued again, the next round retries them
+                logger.exception('Failed to write out the queued changes')
+
+    def get_field(self, collection_name, key, **filter_options):
+        key_value = self._cache_key(collection_name, filter_options)
+
+        if key_value is None:
+            self._flush_pending(collection_name)
+            return self.storage.get_field(collection_name, key, **filter_options)
+
+        obj = self._get_cached(collection_name, key_value)
+
+        if obj is None or obj.get(key) is None:
+            return []
+
+        return [obj[key]]
+
+    def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
+        return self.set_fields(collection_name, {key: new_value}, multi=multi, **filter_options)
+
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        key_value = self._cache_key(collection_name, filter_options)
+
+        if key_value is None:
+            self._flush_pending(collection_name)
+            result = self.storage.set_fields(collection_name, new_values, multi=multi, **filter_options)
+            self._invalidate(collection_name)
+
+            return result
+
+        if self._write_behind:
+            self._queue(collection_name, key_value, new_values)
+            return True
+
+        result = self.storage.set_fields(collection_name, new_values, multi=multi, **filter_options)
+
+        with self._lock:
+            self._update_cached(collection_name, key_value, new_values)
+
+        return result
+
+    def bulk_set(self, collection_name, updates):
+        cached_updates = []
+        other_updates = []
+
+        for filter_options, new_values in updates:
+            key_value = self._cache_key(collection_name, filter_options)
+
+            if key_value is None:
+                other_updates.append((filter_options, new_values))
+            else:
+                cached_updates.append((key_value, filter_options, new_values))
+
+        if self._write_behind:
+            for key_value, _, new_values in cached_updates:
+                self._queue(collection_name, key_value, new_values)
+        elif len(cached_updates) > 0:
+            self.storage.bulk_set(collection_name, [(filter_options, new_values)
+                                                    for _, filter_options, new_values in cached_updates])
+
+            with self._lock:
+                for key_value, _, new_values in cached_updates:
+                    self._update_cached(collection_name, key_value, new_values)
+
+        if len(other_updates) > 0:
+            self._flush_pending(collection_name)
+            self.storage.bulk_set(collection_name, other_updates)
+            self._invalidate(collection_name)
+
+        return True
+
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        key_value = None if multi else self._cache_key(collection_name, filter_options)
+
+        if key_value is None:
+            self._flush_pending(collection_name)
+            return self.storage.get_object(collection_name, filter_options, multi=multi, projection=projection)
+
+        obj = self._get_cached(collection_name, key_value)
+
+        if obj is None:
+            return None
+
+        if projection is None:
+            return dict(obj)
+
+        return {field: obj[field] for field in projection if field in obj}
+
+    def iter_field(self, collection_name, key, batch_size=None, **filter_options):
+        self._flush_pending(collection_name)
+        return self.storage.iter_field(collection_name, key, batch_size=batch_size, **filter_options)
+
+    def iter_field_sorted(self, collection_name, key, after=None, batch_size=None, **filter_options):
+        self._flush_pending(collection_name)
+        return self.storage.iter_field_sorted(collection_name, key, after=after, batch_size=batch_size,
+                                              **filter_options)
+
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        self._flush_pending(collection_name)
+        return self.storage.iter_objects(collection_name, filter_options, batch_size=batch_size,
+                                         projection=projection)
+
+    def set_object(self, collection_name, new_object, filter_options, multi=False):
+        self._flush_pending(collection_name)
+        result = self.storage.set_object(collection_name, new_object, filter_options, multi=multi)
+        key_value = self._cache_key(collection_name, filter_options)
+
+        if key_value is not None and new_object.get(self._keys[collection_name]) == key_value:
+            self._invalidate(collection_name, key_value)
+        else:
+            # the object may have moved to another key
+            self._invalidate(collection_name)
+
+        return result
+
+    def remove_object(self, collection_name, filter_options, multi=False):
+        self._flush_pending(collection_name)
+        result = self.storage.remove_object(collection_name, filter_options, multi=multi)
+        self._invalidate(collection_name, self._cache_key(collection_name, filter_options))
+
+        return result
+
+    def stats(self):
+        """
+        :return: dict with the numbers of `hits`, `misses`, `evictions`(to stay
+            within `max_size`), `expirations`(after `ttl`) and objects cached(`size`)
+        """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'size': sum(len(cache) for cache in self._cache.values())
+            }
+
+    def flush(self):
+        self._flush_pending()
+        self.storage.flush()
+
+    def close(self):
+        self._closed.set()
+        self._flush_requested.set()
+
+        if self._flusher_thread is not None and self._flusher_thread is not threading.current_thread():
+            self._flusher_thread.join()
+
+        self._flush_pending()
+        self.storage.close()
+
+    def __getattr__(self, name):
+        # anything backend-specific, e.g. `db` of MongoStorage
+        if name == 'storage':
+            raise AttributeError(name)
+
+        return getattr(self.storage, name)
@@ -1,8 +1,9 @@
 import json
+import time
 
+from botlab import backends
 from botlab.exceptions import NoConfigurationProvidedException, NoKVStorageProvidedException, \
-    WrongConfigurationException, UnsupportedKVStorageException
-from botlab.kv_storage import RedisKVStorage, InMemoryKVStorage, MongoKVStorage
+    WrongConfigurationException
 
 
 class ConfigurationManager(object):
@@ -20,7 +21,17 @@ class ConfigurationManager(object):
                 file is checked against kv-storage keys. Only those keys absent
                 in kv-storage are taken from the original configuration,
                 others - from kv-storage.
+
+        Values read from kv-storage are cached in process. A cached value is
+        dropped as soon as the kv-storage reports it changed('redis' through
+        pub/sub, 'mongo' through a change stream where the deployment
+        supports it), and in any case once it is older than
+        `config.max_staleness` seconds(5 by default, None - never).
+        Values returned by `get` are shared, so do not modify them
+        without passing them to `set` afterwards.
     """
+    DEFAULT_MAX_STALENESS = 5
+
     def __init__(self, config_dict, *args, **kwargs):
         if config_dict is None:
             raise NoConfigurationProvidedException()
@@ -29,6 +40,13 @@ class ConfigurationManager(object):
             raise WrongConfigurationException('config and/or config.sync_strategy is not set')
 
         self._sync_strategy = config_dict['config']['sync_strategy']
+        self._max_staleness = config_dict['config'].get('max_staleness', ConfigurationManager.DEFAULT_MAX_STALENESS)
+
+        # key -> (value, time it was read at)
+        self._cache = {}
+        self._listeners = []
+        # Metrics counting the cache hits, set by the bot when enabled
+        self.metrics = None
 
         if self._sync_strategy == 'hot':
             if 'kv_storage' not in config_dict.keys():
@@ -40,21 +58,24 @@ class ConfigurationManager(object):
             if 'params' not in config_dict['kv_storage'].keys():
                 raise WrongConfigurationException('kv_storage.params is not set')
 
-            kv_storage_type = config_dict['kv_storage']['type']
-
-            if kv_storage_type == 'redis':
-                self._kv_storage = RedisKVStorage(config_dict['kv_storage']['params'])
-            elif kv_storage_type == 'mongo':
-                self._kv_storage = MongoKVStorage(config_dict['kv_storage']['params'])
-            elif kv_storage_type == 'inmemory':
-                self._kv_storage = InMemoryKVStorage()
-            else:
-                raise UnsupportedKVStorageException()
+            self._kv_storage = self._create_kv_storage(config_dict['kv_storage']['type'],
+                                                       config_dict['kv_storage']['params'])
         elif self._sync_strategy == 'cold':
-            self._kv_storage = InMemoryKVStorage()
+            self._kv_storage = self._create_kv_storage('inmemory', None)
         else:
             raise WrongConfigurationException('Unknown config.sync_strategy value')
 
+        self._start(config_dict)
+
+    def _create_kv_storage(self, kv_storage_type, params):
+        # only the selected kv-storage is imported, see `backends`
+        return backends.kv_storages.get(kv_storage_type)(params)
+
+    def _start(self, config_dict):
+        # the staleness bound stays in force: notifications are missed if the listening thread dies,
+        # and values written to kv-storage by anything but a ConfigurationManager are not announced at all
+        self._kv_storage.subscribe(self._on_change)
+
         # load config from the dictionary provided
         self._setup_from_dictionary_(config_dict)
 
@@ -67,18 +88,107 @@ class ConfigurationManager(object):
         if kv_storage is None:
             raise NoKVStorageProvidedException()
 
-        for key in config_dict.keys():
-            if not kv_storage.exists(key):
-                kv_storage.set(key, config_dict[key])
+        # one round trip for the keys already in kv-storage, which also warms up the cache
+        found_vals = kv_storage.get_many(config_dict.keys())
+        read_at = time.monotonic()
+
+        for key, found_val in found_vals.items():
+            self._cache[key] = (found_val, read_at)
+
+        missing_vals = {key: value for key, value in config_dict.items() if key not in found_vals}
+
+        if len(missing_vals) > 0:
+            kv_storage.set_many(missing_vals)
+
+    def _on_change(self, key):
+        self._cache.pop(key, None)
+        self._notify_listeners(key)
+
+    def _notify_listeners(self, key):
+        for listener in self._listeners:
+            listener(key)
+
+    def add_listener(self, listener):
+        """
+        Subscribe to changes of configuration values, both local and made by other processes.
+
+        :param listener: function called with the changed top-level key
+        """
+        self._listeners.append(listener)
 
     def get(self, key, default=None):
+        cached = self._cache.get(key)
+
+        if cached is not None:
+            found_val, read_at = cached
+
+            if self._max_staleness is None or time.monotonic() - read_at < self._max_staleness:
+                if self.metrics is not None:
+                    self.metrics.inc('botlab_config_cache_requests_total', labels={'result': 'hit'})
+
+                return found_val
+
+        if self.metrics is not None:
+            self.metrics.inc('botlab_config_cache_requests_total', labels={'result': 'miss'})
+
         found_val = self._kv_storage.get(key)
 
         if found_val is None:
             return None
-        else:
-            return found_val
+
+        self._cache[key] = (found_val, time.monotonic())
+
+        if cached is not None and found_val != cached[0]:
+            # changed by others and not announced, noticed once the cached value got stale
+            self._notify_listeners(key)
+
+        return found_val
+
+    def get_many(self, keys):
+        """
+        Read several values at once, in a single kv-storage request for the ones not in cache.
+
+        :param keys: list of top-level keys
+        :return: dict key -> value of the keys found
+        """
+        found_vals = {}
+        missing_keys = []
+        now = time.monotonic()
+
+        for key in keys:
+            cached = self._cache.get(key)
+
+            if cached is not None and (self._max_staleness is None or now - cached[1] < self._max_staleness):
+                found_vals[key] = cached[0]
+            else:
+                missing_keys.append(key)
+
+        if self.metrics is not None:
+            self.metrics.inc('botlab_config_cache_requests_total', len(found_vals), {'result': 'hit'})
+            self.metrics.inc('botlab_config_cache_requests_total', len(missing_keys), {'result': 'miss'})
+
+        if len(missing_keys) > 0:
+            read_vals = self._kv_storage.get_many(missing_keys)
+            read_at = time.monotonic()
+            changed_keys = []
+
+            for key, found_val in read_vals.items():
+                cached = self._cache.get(key)
+
+                if cached is not None and found_val != cached[0]:
+                    changed_keys.append(key)
+
+                self._cache[key] = (found_val, read_at)
+
+            found_vals.update(read_vals)
+
+            for key in changed_keys:
+                self._notify_listeners(key)
+
+        return found_vals
 
     def set(self, key, value):
         self._kv_storage.set(key, value)
+        self._cache[key] = (value, time.monotonic())
+        self._notify_listeners(key)
 
@@ -17,3 +17,7 @@ class WrongConfigurationException(Exception):
 
 class UnsupportedKVStorageException(Exception):
     pass
+
+
+class UnsupportedCodecException(Exception):
+    pass
@@ -1,8 +1,28 @@
-import json
+import threading
+import uuid
 from abc import abstractmethod
 
-from pymongo import MongoClient
-import redis
+from botlab.serialization import Serializer
+
+
+def _change_message(client_id, key):
+    """
+    :return: notification about the key changed by the client, see `_parse_change_message`
+    """
+    return '{0} {1}'.format(client_id, key)
+
+
+def _parse_change_message(message):
+    """
+    :param message: notification as received from the channel
+    :return: (id of the client that made the change or None if unknown, changed key)
+    """
+    client_id, separator, key = message.partition(' ')
+
+    if not separator:
+        return None, message
+
+    return client_id, key
 
 
 class KVStorage(object):
@@ -21,8 +41,57 @@ class KVStorage(object):
     def exists(self, key):
         pass
 
+    def get_many(self, keys):
+        """
+        :param keys: list of keys
+        :return: dict key -> value of the keys found
+        """
+        found_vals = {}
+
+        for key in keys:
+            found_val = self.get(key)
+
+            if found_val is not None:
+                found_vals[key] = found_val
+
+        return found_vals
+
+    def set_many(self, values):
+        """
+        :param values: dict key -> value
+        """
+        for key, value in values.items():
+            self.set(key, value)
+
+    def exists_many(self, keys):
+        """
+        :param keys: list of keys
+        :return: set of the keys found
+        """
+        return {key for key in keys if self.exists(key)}
+
+    def subscribe(self, callback):
+        """
+        Get notified about values changed by other clients of the storage.
+
+        :param callback: function called with the changed key
+        :return: True if the storage is able to notify about changes
+        """
+        return False
+
 
 class RedisKVStorage(KVStorage):
+    """
+        Every `set` publishes the changed key to the `channel`
+        (`botlab:config` by default), which is how other clients learn
+        about changes. Notifications are tagged with the id of the
+        publishing storage, which skips its own ones: they are already
+        known to its client.
+
+        Values are encoded as configured by `serialization`(see `Serializer`).
+    """
+    DEFAULT_CHANNEL = 'botlab:config'
+
     def __init__(self, config):
         super().__init__(config)
 
@@ -30,7 +99,14 @@ class RedisKVStorage(KVStorage):
         redis_port = config['port']
         redis_db = config['db']
 
+        # imported here, so that the other kv-storages don't load redis
+        import redis
+
         self._redis = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db)
+        self._channel = config.get('channel', RedisKVStorage.DEFAULT_CHANNEL)
+        self._serializer = Serializer(config.get('serialization'))
+        self._client_id = uuid.uuid4().hex
+        self._pubsub_thread = None
 
     def get(self, key):
         found_val = self._redis.get(key)
@@ -38,21 +114,70 @@ class RedisKVStorage(KVStorage):
         if found_val is None:
             return None
 
-        result = found_val.decode('utf-8')
-
-        return json.loads(result, encoding='utf-8')
+        return self._serializer.loads(found_val)
 
     def set(self, key, value):
-        str_value = json.dumps(value)
-        self._redis.set(key, str_value)
+        self._redis.set(key, self._serializer.dumps(value))
+        self._redis.publish(self._channel, _change_message(self._client_id, key))
 
     def exists(self, key):
         return self._redis.exists(key)
 
+    def get_many(self, keys):
+        keys = list(keys)
+
+        if len(keys) < 1:
+            return {}
+
+        return {key: self._serializer.loads(found_val)
+                for key, found_val in zip(keys, self._redis.mget(keys)) if found_val is not None}
+
+    def set_many(self, values):
+        if len(values) < 1:
+            return
+
+        # one round trip for all the values and notifications
+        pipeline = self._redis.pipeline(transaction=False)
+
+        for key, value in values.items():
+            pipeline.set(key, self._serializer.dumps(value))
+
+        for key in values.keys():
+            pipeline.publish(self._channel, _change_message(self._client_id, key))
+
+        pipeline.execute()
+
+    def exists_many(self, keys):
+        keys = list(keys)
+
+        if len(keys) < 1:
+            return set()
+
+        pipeline = self._redis.pipeline(transaction=False)
+
+        for key in keys:
+            pipeline.exists(key)
+
+        return {key for key, found in zip(keys, pipeline.execute()) if found}
+
+    def subscribe(self, callback):
+        def on_message(message):
+            client_id, key = _parse_change_message(message['data'].decode('utf-8'))
+
+            if client_id != self._client_id:
+                callback(key)
+
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self._channel: on_message})
+
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+        return True
+
 
 class InMemoryKVStorage(KVStorage):
-    def __init__(self):
-        super().__init__(None)
+    def __init__(self, config=None):
+        super().__init__(config)
         self._kv_storage = {}
 
     def get(self, key):
@@ -64,6 +189,19 @@ class InMemoryKVStorage(KVStorage):
     def set(self, key, value):
         self._kv_storage[key] = value
 
+    def get_many(self, keys):
+        return {key: self._kv_storage[key] for key in keys if key in self._kv_storage}
+
+    def set_many(self, values):
+        self._kv_storage.update(values)
+
+    def exists_many(self, keys):
+        return {key for key in keys if key in self._kv_storage}
+
+    def subscribe(self, callback):
+        # nobody else can see the storage
+        return True
+
 
 class MongoKVStorage(KVStorage):
     def __init__(self, config):
@@ -74,6 +212,9 @@ class MongoKVStorage(KVStorage):
         mongo_db_name = config['db']
         mongo_collection = config['collection']
 
+        # imported here, so that the other kv-storages don't load pymongo
+        from pymongo import MongoClient
+
         self._collection = MongoClient(host=mongo_host, port=mongo_port)[mongo_db_name][mongo_collection]
 
     def get(self, key):
@@ -85,4 +226,40 @@ class MongoKVStorage(KVStorage):
         self._collection.update_one({'key': key}, {'$set': value}, upsert=True)
 
     def exists(self, key):
-        return self._collection.count({'key': key}) > 0
+        return self._collection.count_documents({'key': key}, limit=1) > 0
+
+    def get_many(self, keys):
+        return {found_val['key']: found_val for found_val in self._collection.find({'key': {'$in': list(keys)}})}
+
+    def set_many(self, values):
+        if len(values) < 1:
+            return
+
+        from pymongo import UpdateOne
+
+        self._collection.bulk_write([UpdateOne({'key': key}, {'$set': value}, upsert=True)
+                                     for key, value in values.items()], ordered=False)
+
+    def exists_many(self, keys):
+        return {found_val['key'] for found_val in self._collection.find({'key': {'$in': list(keys)}}, {'key': 1})}
+
+    def subscribe(self, callback):
+        from pymongo.errors import PyMongoError
+
+        try:
+            # change streams are only available on replica sets and sharded clusters
+            change_stream = self._collection.watch(full_document='updateLookup')
+        except PyMongoError:
+            return False
+
+        def watch():
+            with change_stream:
+                for change in change_stream:
+                    document = change.get('fullDocument')
+
+                    if document is not None:
+                        callback(document.get('key'))
+
+        threading.Thread(target=watch, daemon=True).start()
+
+        return True
@@ -0,0 +1,311 @@
+import bisect
+import functools
+import math
+import threading
+import time
+
+from botlab.storage import Storage
+
+DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+DESCRIPTIONS = {
+    'botlab_dispatch_seconds': 'Time from an update to its handler: session loading and filter tests',
+    'botlab_handler_seconds': 'Time spent in handlers, by the state they were called in',
+    'botlab_storage_seconds': 'Latency of storage operations',
+    'botlab_api_request_seconds': 'Latency of Bot API requests sending something to a chat',
+    'botlab_config_cache_requests_total': 'Configuration reads, by whether they were served from the cache',
+    'botlab_storage_cache_requests_total': 'Storage reads by key, by whether they were served from the cache',
+    'botlab_storage_cache_evictions_total': 'Objects dropped from the storage cache, by reason',
+    'botlab_storage_cache_size': 'Objects in the storage cache',
+    'botlab_worker_queue_depth': 'Tasks waiting for a worker',
+    'botlab_outbox_queue_depth': 'Requests waiting in the outbox'
+}
+
+
+class Metrics(object):
+    """
+        Counters, histograms and gauges of a bot, exported in Prometheus text
+        format by `render`. Every series is identified by its name and
+        a dict of labels.
+
+        Every value recorded is also passed to the hooks(`add_hook`), so the
+        timings can be sent elsewhere, e.g. to statsd or a tracer. Gauges
+        that are cheaper to read when asked for(queue depths) are set by
+        collectors(`add_collector`) right before the export.
+
+        Nothing is recorded when the `metrics` section of the configuration
+        is not `enabled`: the bot then has no Metrics at all and the hot path
+        only checks for None.
+
+        :param config: dict with `buckets`(upper bounds of the histogram
+            buckets, in seconds)
+    """
+    def __init__(self, config=None):
+        config = config or {}
+
+        self._buckets = sorted(config.get('buckets') or DEFAULT_BUCKETS)
+        self._lock = threading.Lock()
+        # (name, labels) -> value
+        self._counters = {}
+        self._gauges = {}
+        # (name, labels) -> [count per bucket..., count above all the buckets, sum]
+        self._histograms = {}
+        self._hooks = []
+        self._collectors = []
+
+    def add_hook(self, hook):
+        """
+        :param hook: function called as hook(kind, name, labels, value) with
+            every value recorded; kind is 'counter', 'histogram' or 'gauge'
+        """
+        self._hooks.append(hook)
+
+    def add_collector(self, collector):
+        """
+        :param collector: function called with the Metrics before every export
+        """
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _labels_key(labels):
+        if labels is None:
+            return ()
+
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def _notify_hooks(self, kind, name, labels, value):
+        for hook in self._hooks:
+            hook(kind, name, labels or {}, value)
+
+    def inc(self, name, value=1, labels=None):
+        key = (name, self._labels_key(labels))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+        if self._hooks:
+            self._notify_hooks('counter', name, labels, value)
+
+    def set_counter(self, name, value, labels=None):
+        """
+        Set a counter kept elsewhere, e.g. by a collector.
+        """
+        with self._lock:
+            self._counters[(name, self._labels_key(labels))] = value
+
+    def set_gauge(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[(name, self._labels_key(labels))] = value
+
+        if self._hooks:
+            self._notify_hooks('gauge', name, labels, value)
+
+    def observe(self, name, value, labels=None):
+        key = (name, self._labels_key(labels))
+        bucket = bisect.bisect_left(self._buckets, value)
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                histogram = [0] * (len(self._buckets) + 2)
+                self._histograms[key] = histogram
+
+            histogram[bucket] += 1
+            histogram[-1] += value
+
+        if self._hooks:
+            self._notify_hooks('histogram', name, labels, value)
+
+    def timed(self, name, func, labels=None):
+        """
+        :return: function calling `func` and observing how long it took
+        """
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            started_at = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - started_at, labels)
+
+        return timed_func
+
+    def get(self, name, labels=None):
+        """
+        :return: value of a counter or a gauge, (count, sum) of a histogram, None if nothing was recorded
+        """
+        key = (name, self._labels_key(labels))
+
+        with self._lock:
+            if key in self._histograms:
+                histogram = self._histograms[key]
+                return sum(histogram[:-1]), histogram[-1]
+
+            return self._counters.get(key, self._gauges.get(key))
+
+    def render(self):
+        """
+        :return: all the metrics in Prometheus text exposition format
+        """
+        for collector in self._collectors:
+            collector(self)
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+
+                if name in DESCRIPTIONS:
+                    lines.append('# HELP {0} {1}'.format(name, DESCRIPTIONS[name]))
+
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append('{0}{1} {2}'.format(name, self._format_labels(labels), self._format_value(value)))
+
+        for (name, labels), value in gauges:
+            describe(name, 'gauge')
+            lines.append('{0}{1} {2}'.format(name, self._format_labels(labels), self._format_value(value)))
+
+        for (name, labels), histogram in histograms:
+            describe(name, 'histogram')
+
+            count = 0
+
+            for upper_bound, bucket_count in zip(self._buckets + [math.inf], histogram[:-1]):
+                count += bucket_count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, self._format_labels(labels + (('le', self._format_value(upper_bound)),)), count))
+
+            lines.append('{0}_sum{1} {2}'.format(name, self._format_labels(labels), self._format_value(histogram[-1])))
+            lines.append('{0}_count{1} {2}'.format(name, self._format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_labels(labels):
+        if len(labels) < 1:
+            return ''
+
+        return '{' + ','.join('{0}="{1}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')
+                                                 .replace('\n', '\\n'))
+                              for name, value in labels) + '}'
+
+    @staticmethod
+    def _format_value(value):
+        if value == math.inf:
+            return '+Inf'
+
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class InstrumentedStorage(Storage):
+    """
+        Storage passing every operation to another one and observing its
+        latency as `botlab_storage_seconds` by backend, collection and
+        operation.
+
+        :param storage: storage to instrument
+        :param backend: name of the storage type, for the label
+        :param metrics: Metrics
+    """
+    def __init__(self, storage, backend, metrics):
+        super().__init__(storage.config)
+
+        self.storage = storage
+        self._backend = backend
+        self._metrics = metrics
+
+    def _observe(self, operation, collection_name, started_at):
+        self._metrics.observe('botlab_storage_seconds', time.perf_counter() - started_at,
+                              {'backend': self._backend, 'collection': collection_name, 'operation': operation})
+
+    def get_field(self, collection_name, key, **filter_options):
+        started_at = time.perf_counter()
+
+        try:
+            return self.storage.get_field(collection_name, key, **filter_options)
+        finally:
+            self._observe('get_field', collection_name, started_at)
+
+    def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
+        started_at = time.perf_counter()
+
+        try:
+            return self.storage.set_field(collection_name, key, new_value, multi=multi, **filter_options)
+        finally:
+            self._observe('set_field', collection_name, started_at)
+
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        started_at = time.perf_counter()
+
+        try:
+            return self.storage.set_fields(collection_name, new_values, multi=multi, **filter_options)
+        finally:
+            self._observe('set_fields', collection_name, started_at)
+
+    def bulk_set(self, collection_name, updates):
+        started_at = time.perf_counter()
+
+        try:
+            return self.storage.bulk_set(collection_name, updates)
+        finally:
+            self._observe('bulk_set', collection_name, started_at)
+
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        started_at = time.perf_counter()
+
+        try:
+            return self.storage.get_object(collection_name, filter_options, multi=multi, projection=projection)
+        finally:
+            self._observe('get_object', collection_name, started_at)
+
+    def iter_field(self, collection_name, key, batch_size=None, **filter_options):
+        return self.storage.iter_field(collection_name, key, batch_size=batch_size, **filter_options)
+
+    def iter_field_sorted(self, collection_name, key, after=None, batch_size=None, **filter_options):
+        return self.storage.iter_field_sorted(collection_name, key, after=after, batch_size=batch_size,
+                                              **filter_options)
+
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        return self.storage.iter_objects(collection_name, filter_options, batch_size=batch_size,
+                                         projection=projection)
+
+    def set_object(self, collection_name, new_object, filter_options, multi=False):
+        started_at = time.perf_counter()
+
+        try:
+            return self.storage.set_object(collection_name, new_object, filter_options, multi=multi)
+        finally:
+            self._observe('set_object', collection_name, started_at)
+
+    def remove_object(self, collection_name, filter_options, multi=False):
+        started_at = time.perf_counter()
+
+        try:
+            return self.storage.remove_object(collection_name, filter_options, multi=multi)
+        finally:
+            self._observe('remove_object', collection_name, started_at)
+
+    def flush(self):
+        return self.storage.flush()
+
+    def close(self):
+        return self.storage.close()
+
+    def __getattr__(self, name):
+        # anything backend-specific, e.g. `db` of MongoStorage
+        if name == 'storage':
+            raise AttributeError(name)
+
+        return getattr(self.storage, name)
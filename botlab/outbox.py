@@ -0,0 +1,179 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+import requests
+import urllib3
+
+from botlab.rate_limiting import TokenBucket, KeyedRateLimiter, get_retry_after
+from botlab.scheduling import ShardedWorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """
+        Sends Bot API requests from a pool of threads of its own instead of
+        the threads of the handlers.
+
+        The requests for one chat are sent one after another, in the order
+        they were submitted, at most `per_chat_rate` per second and at most
+        `rate` per second in total. A request Telegram answers with 429 is
+        sent again after the `retry_after` it asked for, up to `max_retries`
+        times. So, after a short backoff, is one answered with a 5xx error
+        and one that failed to connect. A request that may have reached
+        Telegram without an answer(e.g. read timeout, connection reset) is
+        not sent again: delivery is at least once only for the retried
+        failures, and a 5xx retry may still duplicate a message Telegram
+        has sent anyway. Every sender thread keeps its HTTP connection alive
+        between the requests(telebot keeps a session per thread).
+
+        :param config: dict with `workers`, `queue_size`, `rate`,
+            `per_chat_rate` and `max_retries`
+    """
+    DEFAULT_WORKERS = 16
+    DEFAULT_QUEUE_SIZE = 10000
+    DEFAULT_RATE = 30
+    DEFAULT_PER_CHAT_RATE = 1
+    DEFAULT_MAX_RETRIES = 3
+    CONNECTION_RETRY_INTERVAL = 0.5
+
+    def __init__(self, config=None):
+        config = config or {}
+
+        self._pool = ShardedWorkerPool(config.get('workers', Outbox.DEFAULT_WORKERS),
+                                       config.get('queue_size', Outbox.DEFAULT_QUEUE_SIZE))
+        self._rate_limiter = TokenBucket(config.get('rate', Outbox.DEFAULT_RATE))
+        self._chat_rate_limiter = KeyedRateLimiter(config.get('per_chat_rate', Outbox.DEFAULT_PER_CHAT_RATE))
+        self._max_retries = config.get('max_retries', Outbox.DEFAULT_MAX_RETRIES)
+
+        self._lock = threading.Lock()
+        self._delivered = 0
+        self._failed = 0
+        self._retried = 0
+        self._rate_limited = 0
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queue an api call. Blocks while the queue of the chat's sender is full.
+
+        :param key: id of the chat the request is for, None if it is not for a chat
+        :param func: function making the request
+        :return: concurrent.futures.Future with the result of the call
+        """
+        future = concurrent.futures.Future()
+
+        self._pool.put(key, self._send, future, key, func, args, kwargs)
+
+        return future
+
+    def _send(self, future, chat_id, func, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        attempt = 0
+
+        while True:
+            delay = self._rate_limiter.reserve()
+
+            if chat_id is not None:
+                delay = max(delay, self._chat_rate_limiter.reserve(chat_id))
+
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retry_after = self._get_retry_after(e, attempt)
+
+                if retry_after is None or attempt >= self._max_retries:
+                    self._count('_failed')
+                    logger.warning('Failed to send a request to chat %s: %s', chat_id, e)
+
+                    future.set_exception(e)
+                    return
+
+                self._count('_retried')
+                attempt += 1
+
+                # flood control applies to everybody
+                self._rate_limiter.pause(retry_after)
+
+                if chat_id is not None:
+                    self._chat_rate_limiter.pause(chat_id, retry_after)
+
+                continue
+
+            self._count('_delivered')
+            future.set_result(result)
+            return
+
+    def _get_retry_after(self, exception, attempt):
+        retry_after = get_retry_after(exception)
+
+        if retry_after is not None:
+            self._count('_rate_limited')
+            return retry_after
+
+        if self._is_connect_error(exception) or self._is_server_error(exception):
+            return Outbox.CONNECTION_RETRY_INTERVAL * 2 ** attempt
+
+        return None
+
+    @staticmethod
+    def _is_connect_error(exception):
+        """
+        :return: True if the request failed before it could reach Telegram, so it is safe to repeat
+        """
+        if isinstance(exception, requests.exceptions.ConnectTimeout):
+            return True
+
+        # also raised when the connection is lost after the request was sent
+        if not isinstance(exception, requests.exceptions.ConnectionError) or len(exception.args) < 1:
+            return False
+
+        # urllib3 wraps the failure to open a connection(refused, name not resolved) in MaxRetryError
+        reason = getattr(exception.args[0], 'reason', exception.args[0])
+
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    @staticmethod
+    def _is_server_error(exception):
+        result = getattr(exception, 'result', None)
+
+        return 500 <= (getattr(result, 'status_code', None) or 0) < 600
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def metrics(self):
+        """
+        :return: dict with the numbers of requests `delivered`, `failed`,
+            `retried` and answered with 429(`rate_limited`), and the number of
+            requests waiting(`queued`)
+        """
+        queued = sum(self._pool.queue_depths())
+
+        with self._lock:
+            return {
+                'delivered': self._delivered,
+                'failed': self._failed,
+                'retried': self._retried,
+                'rate_limited': self._rate_limited,
+                'queued': queued
+            }
+
+    def join(self, timeout=None):
+        """
+        Wait for the requests submitted so far to be sent.
+
+        :return: False if timed out
+        """
+        return self._pool.join(timeout)
+
+    def close(self):
+        self._pool.join()
+        self._pool.close()
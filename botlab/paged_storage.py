@@ -0,0 +1,827 @@
+import array
+import atexit
+import bisect
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+import weakref
+from argparse import ArgumentTypeError
+
+from botlab.serialization import Serializer
+from botlab.storage import Storage
+
+DATA_MAGIC = b'BLPD'
+INDEX_MAGIC = b'BLPI'
+FORMAT_VERSION = 1
+
+# magic, version, generation
+DATA_HEADER = struct.Struct('<4sHxxQ')
+# length of the reference, length of the object(0 - the object was removed)
+RECORD_HEADER = struct.Struct('<II')
+# magic, version, generation, size of the data file when flushed, capacity, slots used, objects, next id, dead bytes
+INDEX_HEADER = struct.Struct('<4sHxxQQQQQQQ')
+# hash of the reference, offset of the record
+SLOT = struct.Struct('<QQ')
+
+EMPTY = 0
+REMOVED = 1
+
+
+def _hash(ref):
+    return int.from_bytes(hashlib.blake2b(ref, digest_size=8).digest(), 'little')
+
+
+class PagedCollection(object):
+    """
+        One collection of `PagedStorage`: a data file(`<name>.data`) and its
+        index(`<name>.index`), both memory-mapped.
+
+        The data file is a log of records, each holding the object's
+        reference(its key or, for objects without one, an id) and the
+        serialized object; a change appends a new version of the object, a
+        removal appends an empty one. The index is an open-addressing hash
+        table from the references to the offsets of the latest versions.
+
+        The index is trusted if it was flushed together with the data file
+        (same generation and data size); otherwise it is rebuilt by reading
+        the data file once, dropping a torn last record.
+
+        Iterations(`start_iteration`) read the data file from the start up
+        to where it ended when they began and take the records the index
+        points to, so they hold no copy of the index. An object changed
+        before an iteration gets to it is remembered by the iteration and
+        met at the place of its old version; compaction moves the places of
+        the iterations in progress along with the records.
+    """
+    INITIAL_CAPACITY = 1024
+    MAX_LOAD = 0.7
+
+    def __init__(self, data_file_path, index_file_path, key_field, serializer):
+        self._data_file_path = data_file_path
+        self._index_file_path = index_file_path
+        self.key_field = key_field
+        self._serializer = serializer
+
+        # an empty file is left by a crash right after it was created, and can't be mapped
+        if not os.path.exists(data_file_path) or os.path.getsize(data_file_path) == 0:
+            self._create_data_file(data_file_path, self._new_generation())
+
+        self._data_file = open(data_file_path, 'r+b', buffering=0)
+        self._data_size = os.fstat(self._data_file.fileno()).st_size
+
+        if self._data_size < DATA_HEADER.size:
+            self._data_file.close()
+            raise ValueError('{0} is not a data file of a paged storage'.format(data_file_path))
+
+        self._data_map = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self._generation = DATA_HEADER.unpack_from(self._data_map, 0)
+
+        if magic != DATA_MAGIC or version != FORMAT_VERSION:
+            raise ValueError('{0} is not a data file of a paged storage'.format(data_file_path))
+
+        self._index_file = None
+        self._index_map = None
+
+        # iterations in progress, forgotten along with the iterators abandoned
+        self._iterations = weakref.WeakSet()
+
+        if not self._open_index():
+            self._rebuild_index()
+
+    @staticmethod
+    def _new_generation():
+        return int.from_bytes(os.urandom(8), 'little')
+
+    @staticmethod
+    def _create_data_file(file_path, generation):
+        with open(file_path, 'wb') as f:
+            f.write(DATA_HEADER.pack(DATA_MAGIC, FORMAT_VERSION, generation))
+            f.flush()
+            os.fsync(f.fileno())
+
+    # index
+
+    def _open_index(self):
+        """
+        :return: False if there is no index matching the data file
+        """
+        try:
+            index_file = open(self._index_file_path, 'r+b')
+        except FileNotFoundError:
+            return False
+
+        try:
+            header = INDEX_HEADER.unpack(index_file.read(INDEX_HEADER.size))
+        except struct.error:
+            header = None
+
+        if header is None or header[0] != INDEX_MAGIC or header[1] != FORMAT_VERSION \
+                or header[2] != self._generation or header[3] != self._data_size \
+                or os.fstat(index_file.fileno()).st_size != INDEX_HEADER.size + header[4] * SLOT.size:
+            index_file.close()
+            return False
+
+        self._index_file = index_file
+        self._index_map = mmap.mmap(index_file.fileno(), 0)
+        _, _, _, _, self._capacity, self._used, self.count, self._next_id, self.dead_bytes = header
+
+        return True
+
+    def _create_index(self, file_path, capacity):
+        with open(file_path, 'wb') as f:
+            f.truncate(INDEX_HEADER.size + capacity * SLOT.size)
+
+        index_file = open(file_path, 'r+b')
+
+        return index_file, mmap.mmap(index_file.fileno(), 0)
+
+    def _close_index(self):
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_file.close()
+
+    def _rebuild_index(self):
+        self._close_index()
+
+        self._index_file, self._index_map = self._create_index(self._index_file_path, self.INITIAL_CAPACITY)
+        self._capacity = self.INITIAL_CAPACITY
+        self._used = 0
+        self.count = 0
+        self._next_id = 0
+        self.dead_bytes = 0
+
+        offset = DATA_HEADER.size
+
+        while offset + RECORD_HEADER.size <= self._data_size:
+            ref_length, object_length = RECORD_HEADER.unpack_from(self._data_map, offset)
+            record_size = RECORD_HEADER.size + ref_length + object_length
+
+            if offset + record_size > self._data_size:
+                break
+
+            ref = self._data_map[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + ref_length]
+            kind, value = json.loads(ref.decode('utf-8'))
+
+            if kind == 'id':
+                self._next_id = max(self._next_id, value + 1)
+
+            if object_length > 0:
+                self._set_offset(ref, offset)
+            else:
+                self._remove_offset(ref, record_size)
+
+            offset += record_size
+
+        # a record torn by a crash
+        if offset < self._data_size:
+            self._data_file.truncate(offset)
+            self._data_size = offset
+            self._remap_data()
+
+        self._write_index_header()
+
+    def _write_index_header(self):
+        INDEX_HEADER.pack_into(self._index_map, 0, INDEX_MAGIC, FORMAT_VERSION, self._generation, self._data_size,
+                               self._capacity, self._used, self.count, self._next_id, self.dead_bytes)
+
+    def _probe(self, ref, ref_hash):
+        """
+        :return: (slot of the reference or None, first free slot)
+        """
+        mask = self._capacity - 1
+        slot = ref_hash & mask
+        free_slot = None
+
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self._index_map, INDEX_HEADER.size + slot * SLOT.size)
+
+            if offset == EMPTY:
+                return None, slot if free_slot is None else free_slot
+
+            if offset == REMOVED:
+                if free_slot is None:
+                    free_slot = slot
+            elif slot_hash == ref_hash and self._read_ref(offset) == ref:
+                return slot, free_slot
+
+            slot = (slot + 1) & mask
+
+    def _slot_offset(self, slot):
+        return SLOT.unpack_from(self._index_map, INDEX_HEADER.size + slot * SLOT.size)[1]
+
+    def _write_slot(self, slot, ref_hash, offset):
+        SLOT.pack_into(self._index_map, INDEX_HEADER.size + slot * SLOT.size, ref_hash, offset)
+
+    def _set_offset(self, ref, offset):
+        ref_hash = _hash(ref)
+        slot, free_slot = self._probe(ref, ref_hash)
+
+        if slot is not None:
+            old_offset = self._slot_offset(slot)
+            self.dead_bytes += self._record_size(old_offset)
+            self._note_change(ref, old_offset)
+            self._write_slot(slot, ref_hash, offset)
+            return
+
+        if self._slot_offset(free_slot) == EMPTY:
+            self._used += 1
+
+        self._write_slot(free_slot, ref_hash, offset)
+        self.count += 1
+
+        if self._used > self._capacity * self.MAX_LOAD:
+            self._grow_index()
+
+    def _remove_offset(self, ref, record_size):
+        self.dead_bytes += record_size
+        slot, _ = self._probe(ref, _hash(ref))
+
+        if slot is None:
+            return
+
+        self.dead_bytes += self._record_size(self._slot_offset(slot))
+        self._write_slot(slot, 0, REMOVED)
+        self.count -= 1
+
+    def _live_slots(self):
+        """
+        :return: list of (offset, hash) of the latest versions of the objects
+        """
+        live_slots = []
+
+        # read in place, the index is not copied
+        with memoryview(self._index_map) as index_view:
+            for slot_hash, offset in SLOT.iter_unpack(index_view[INDEX_HEADER.size:]):
+                if offset > REMOVED:
+                    live_slots.append((offset, slot_hash))
+
+        return live_slots
+
+    def _grow_index(self, capacity=None):
+        # the hashes are kept in the index, so the data file is not read
+        live_slots = self._live_slots()
+
+        if capacity is None:
+            # the slots of removed objects are reclaimed, the index only grows if it is full of live ones
+            capacity = self._capacity * 2 if len(live_slots) > self._capacity * self.MAX_LOAD / 2 else self._capacity
+
+        tmp_file_path = self._index_file_path + '.tmp'
+        index_file, index_map = self._create_index(tmp_file_path, capacity)
+        mask = capacity - 1
+
+        for offset, slot_hash in live_slots:
+            slot = slot_hash & mask
+
+            while SLOT.unpack_from(index_map, INDEX_HEADER.size + slot * SLOT.size)[1] != EMPTY:
+                slot = (slot + 1) & mask
+
+            SLOT.pack_into(index_map, INDEX_HEADER.size + slot * SLOT.size, slot_hash, offset)
+
+        self._close_index()
+        os.replace(tmp_file_path, self._index_file_path)
+
+        self._index_file, self._index_map = index_file, index_map
+        self._capacity = capacity
+        self._used = len(live_slots)
+        self._write_index_header()
+
+    # data
+
+    def _remap_data(self):
+        self._data_map.close()
+        self._data_map = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _ensure_mapped(self, end):
+        if end > len(self._data_map):
+            self._remap_data()
+
+    def _read_ref(self, offset):
+        self._ensure_mapped(offset + RECORD_HEADER.size)
+        ref_length, _ = RECORD_HEADER.unpack_from(self._data_map, offset)
+        self._ensure_mapped(offset + RECORD_HEADER.size + ref_length)
+
+        return self._data_map[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + ref_length]
+
+    def _record_size(self, offset):
+        self._ensure_mapped(offset + RECORD_HEADER.size)
+        ref_length, object_length = RECORD_HEADER.unpack_from(self._data_map, offset)
+
+        return RECORD_HEADER.size + ref_length + object_length
+
+    def read(self, offset):
+        """
+        :return: (reference, object) of a record
+        """
+        self._ensure_mapped(offset + RECORD_HEADER.size)
+        ref_length, object_length = RECORD_HEADER.unpack_from(self._data_map, offset)
+
+        ref_end = offset + RECORD_HEADER.size + ref_length
+        self._ensure_mapped(ref_end + object_length)
+
+        return (self._data_map[offset + RECORD_HEADER.size:ref_end],
+                self._serializer.loads(self._data_map[ref_end:ref_end + object_length]))
+
+    def _append(self, ref, data):
+        offset = self._data_size
+        record = RECORD_HEADER.pack(len(ref), len(data)) + ref + data
+
+        self._data_file.seek(offset)
+        self._data_file.write(record)
+        self._data_size += len(record)
+
+        return offset, len(record)
+
+    # objects
+
+    def key_ref(self, key_value):
+        """
+        :return: reference of the object with the key or None if the value cannot be a key
+        """
+        try:
+            return json.dumps(['key', key_value], separators=(',', ':'), sort_keys=True).encode('utf-8')
+        except (TypeError, ValueError):
+            return None
+
+    def ref_for(self, obj, old_ref=None):
+        """
+        :return: reference to keep the object by
+        """
+        if self.key_field is not None and self.key_field in obj:
+            ref = self.key_ref(obj[self.key_field])
+
+            if ref is not None:
+                return ref
+
+        if old_ref is not None and old_ref.startswith(b'["id",'):
+            return old_ref
+
+        ref = json.dumps(['id', self._next_id]).encode('utf-8')
+        self._next_id += 1
+
+        return ref
+
+    def get(self, ref):
+        """
+        :return: the object kept by the reference or None
+        """
+        slot, _ = self._probe(ref, _hash(ref))
+
+        if slot is None:
+            return None
+
+        return self.read(self._slot_offset(slot))[1]
+
+    def put(self, ref, obj):
+        offset, _ = self._append(ref, self._serializer.dumps(obj))
+        self._set_offset(ref, offset)
+
+    def remove(self, ref):
+        _, record_size = self._append(ref, b'')
+        self._remove_offset(ref, record_size)
+
+    # iteration
+
+    def _is_latest(self, ref, offset):
+        slot, _ = self._probe(ref, _hash(ref))
+
+        return slot is not None and self._slot_offset(slot) == offset
+
+    def start_iteration(self):
+        """
+        :return: iteration over the objects present now, in the order they were written, see `next_objects`
+        """
+        iteration = _Iteration(DATA_HEADER.size, self._data_size)
+        self._iterations.add(iteration)
+
+        return iteration
+
+    def end_iteration(self, iteration):
+        self._iterations.discard(iteration)
+
+    def _note_change(self, ref, old_offset):
+        for iteration in self._iterations:
+            # not met yet, and not added after the iteration began
+            if iteration.position <= old_offset < iteration.end:
+                heapq.heappush(iteration.changed, (old_offset, ref))
+
+    def next_objects(self, iteration, count):
+        """
+        Advance an iteration.
+
+        :param iteration: iteration made by `start_iteration`
+        :param count: number of objects to read, at least
+        :return: list of (reference, object), empty once the iteration is over
+        """
+        found = []
+
+        while len(found) < count and iteration.position < iteration.end:
+            offset = iteration.position
+
+            # objects changed meanwhile come at the place of the version the iteration would have met
+            while len(iteration.changed) > 0 and iteration.changed[0][0] <= offset:
+                self._read_changed(heapq.heappop(iteration.changed)[1], found)
+
+            ref = self._read_ref(offset)
+            iteration.position = offset + self._record_size(offset)
+
+            if self._is_latest(ref, offset):
+                found.append(self.read(offset))
+
+        if iteration.position >= iteration.end:
+            while len(iteration.changed) > 0:
+                self._read_changed(heapq.heappop(iteration.changed)[1], found)
+
+        return found
+
+    def _read_changed(self, ref, found):
+        slot, _ = self._probe(ref, _hash(ref))
+
+        # removed since
+        if slot is not None:
+            found.append(self.read(self._slot_offset(slot)))
+
+    def find(self, conforms):
+        """
+        :param conforms: function taking an object
+        :return: generator of (reference, object) of the conforming objects, in the order they were written
+        """
+        offset = DATA_HEADER.size
+
+        while offset < self._data_size:
+            ref = self._read_ref(offset)
+            record_offset = offset
+            offset += self._record_size(offset)
+
+            if self._is_latest(ref, record_offset):
+                ref, obj = self.read(record_offset)
+
+                if conforms(obj):
+                    yield ref, obj
+
+    def flush(self):
+        os.fsync(self._data_file.fileno())
+
+        self._write_index_header()
+        self._index_map.flush()
+
+    def compact(self):
+        """
+        Rewrite the data file with the latest versions of the objects only.
+        """
+        generation = self._new_generation()
+        live_slots = self._live_slots()
+        live_slots.sort()
+
+        tmp_data_file_path = self._data_file_path + '.tmp'
+        self._create_data_file(tmp_data_file_path, generation)
+
+        new_slots = []
+
+        with open(tmp_data_file_path, 'ab') as f:
+            offset = DATA_HEADER.size
+
+            for old_offset, slot_hash in live_slots:
+                record_size = self._record_size(old_offset)
+                self._ensure_mapped(old_offset + record_size)
+
+                f.write(self._data_map[old_offset:old_offset + record_size])
+                new_slots.append((offset, slot_hash))
+                offset += record_size
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        # a crash between the renames leaves an index of another generation, which is then rebuilt
+        os.replace(tmp_data_file_path, self._data_file_path)
+
+        self._data_map.close()
+        self._data_file.close()
+
+        self._data_file = open(self._data_file_path, 'r+b', buffering=0)
+        self._data_size = offset
+        self._data_map = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._generation = generation
+
+        capacity = self.INITIAL_CAPACITY
+
+        while len(new_slots) > capacity * self.MAX_LOAD / 2:
+            capacity *= 2
+
+        self._close_index()
+        self._index_file, self._index_map = self._create_index(self._index_file_path + '.tmp', capacity)
+        self._capacity = capacity
+        self.dead_bytes = 0
+
+        mask = capacity - 1
+
+        for offset, slot_hash in new_slots:
+            slot = slot_hash & mask
+
+            while self._slot_offset(slot) != EMPTY:
+                slot = (slot + 1) & mask
+
+            self._write_slot(slot, slot_hash, offset)
+
+        self._used = len(new_slots)
+        self.flush()
+
+        os.replace(self._index_file_path + '.tmp', self._index_file_path)
+
+        self._move_iterations(array.array('Q', (old_offset for old_offset, _ in live_slots)),
+                              array.array('Q', (new_offset for new_offset, _ in new_slots)))
+
+    def _move_iterations(self, old_offsets, new_offsets):
+        """
+        Move the places of the iterations in progress to the compacted data file.
+
+        :param old_offsets: offsets of the records copied, sorted
+        :param new_offsets: their offsets in the compacted file
+        """
+        def move(offset):
+            # to the first record copied from the offset or after it
+            i = bisect.bisect_left(old_offsets, offset)
+
+            return new_offsets[i] if i < len(new_offsets) else self._data_size
+
+        for iteration in self._iterations:
+            iteration.position = move(iteration.position)
+            iteration.end = move(iteration.end)
+            iteration.changed = [(move(offset), ref) for offset, ref in iteration.changed]
+            heapq.heapify(iteration.changed)
+
+    @property
+    def data_size(self):
+        return self._data_size
+
+    def close(self):
+        self.flush()
+
+        self._close_index()
+        self._data_map.close()
+        self._data_file.close()
+
+
+class _Iteration(object):
+    """
+        Place of an iteration over the data file of a `PagedCollection`.
+    """
+    def __init__(self, position, end):
+        # offset of the next record
+        self.position = position
+        # size of the data file when the iteration began
+        self.end = end
+        # heap of (offset of the version met otherwise, reference) of the objects changed meanwhile
+        self.changed = []
+
+
+class PagedStorage(Storage):
+    """
+        Storage keeping every collection in a memory-mapped file of its own
+        in the `path` directory, with an index on disk as well.
+
+        Nothing is read at startup: a collection's files are mapped when it
+        is first used, and then only the pages of the objects touched are
+        loaded by the OS. Lookups by the key field of a collection(`keys`,
+        collection name -> field, {'sessions': 'chat_id'} by default; the key
+        is expected to be unique) go through the index; lookups by other
+        fields read all the objects of the collection.
+
+        Objects are serialized with `serialization`(see `Serializer`). Every
+        change is written to the files(and so survives the process) right
+        away and made durable by `flush()`, or on every change with `fsync`.
+        If the process was not closed cleanly, a collection's index is
+        rebuilt from its data file when it is opened. Once more than
+        `compaction_ratio` of a data file bigger than `compaction_min_size`
+        bytes is taken by old versions of objects, `flush()` rewrites it.
+
+        Objects are iterated over in the order they were last changed.
+
+        :param config: dict with `path`, `keys`, `serialization`, `fsync`,
+            `compaction_ratio` and `compaction_min_size`
+    """
+    DEFAULT_KEYS = {
+        'sessions': 'chat_id'
+    }
+    DEFAULT_COMPACTION_RATIO = 0.5
+    DEFAULT_COMPACTION_MIN_SIZE = 16 * 1024 * 1024
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, config):
+        super().__init__(config)
+
+        self._path = config['path']
+        self._keys = config.get('keys', PagedStorage.DEFAULT_KEYS)
+        self._serializer = Serializer(config.get('serialization'))
+        self._fsync = config.get('fsync', False)
+        self._compaction_ratio = config.get('compaction_ratio', PagedStorage.DEFAULT_COMPACTION_RATIO)
+        self._compaction_min_size = config.get('compaction_min_size', PagedStorage.DEFAULT_COMPACTION_MIN_SIZE)
+
+        os.makedirs(self._path, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._collections = {}
+        self._closed = False
+
+        atexit.register(self.close)
+
+    def _collection(self, collection_name):
+        collection = self._collections.get(collection_name)
+
+        if collection is None:
+            file_path = os.path.join(self._path, collection_name)
+            collection = PagedCollection(file_path + '.data', file_path + '.index', self._keys.get(collection_name),
+                                         self._serializer)
+
+            self._collections[collection_name] = collection
+
+        return collection
+
+    @staticmethod
+    def _conforms(obj, filter_options):
+        for filter_key, filter_value in filter_options.items():
+            if obj.get(filter_key) != filter_value:
+                return False
+
+        return True
+
+    @staticmethod
+    def _project(obj, projection):
+        if projection is None:
+            return obj
+
+        return {field: obj[field] for field in projection if field in obj}
+
+    def _find(self, collection, filter_options, multi=True):
+        """
+        :return: list of (reference, object) conforming to the filter
+        """
+        if collection.key_field is not None and collection.key_field in filter_options:
+            ref = collection.key_ref(filter_options[collection.key_field])
+
+            if ref is not None:
+                obj = collection.get(ref)
+
+                if obj is None or not self._conforms(obj, filter_options):
+                    return []
+
+                return [(ref, obj)]
+
+        found = []
+
+        for ref, obj in collection.find(lambda obj: self._conforms(obj, filter_options)):
+            found.append((ref, obj))
+
+            if not multi:
+                break
+
+        return found
+
+    def _put(self, collection, obj, old_ref=None):
+        ref = collection.ref_for(obj, old_ref)
+
+        if old_ref is not None and ref != old_ref:
+            collection.remove(old_ref)
+
+        collection.put(ref, obj)
+
+    def _changed(self):
+        if self._fsync:
+            self.flush()
+
+    def get_field(self, collection_name, key, **filter_options):
+        with self._lock:
+            found = self._find(self._collection(collection_name), filter_options)
+
+        return [obj[key] for _, obj in found if obj.get(key) is not None]
+
+    def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
+        return self.set_fields(collection_name, {key: new_value}, multi=multi, **filter_options)
+
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        with self._lock:
+            self._set_fields(self._collection(collection_name), new_values, multi, filter_options)
+
+        self._changed()
+
+        return True
+
+    def _set_fields(self, collection, new_values, multi, filter_options):
+        found = self._find(collection, filter_options, multi)
+
+        if len(found) < 1:
+            obj = dict(filter_options)
+            obj.update(new_values)
+
+            self._put(collection, obj)
+            return
+
+        for ref, obj in found:
+            obj.update(new_values)
+            self._put(collection, obj, ref)
+
+    def bulk_set(self, collection_name, updates):
+        with self._lock:
+            collection = self._collection(collection_name)
+
+            for filter_options, new_values in updates:
+                self._set_fields(collection, new_values, False, filter_options)
+
+        self._changed()
+
+        return True
+
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
+            raise ArgumentTypeError('filter_options must be a non-empty dict!')
+
+        with self._lock:
+            found = self._find(self._collection(collection_name), filter_options, multi)
+
+        if multi:
+            return [self._project(obj, projection) for _, obj in found]
+
+        if len(found) < 1:
+            return None
+
+        return self._project(found[0][1], projection)
+
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        batch_size = batch_size or PagedStorage.DEFAULT_BATCH_SIZE
+
+        with self._lock:
+            collection = self._collection(collection_name)
+
+            # the objects present when the iteration starts, each once, even if changed meanwhile
+            iteration = collection.start_iteration()
+
+        try:
+            while True:
+                with self._lock:
+                    found = collection.next_objects(iteration, batch_size)
+
+                if len(found) < 1:
+                    return
+
+                for _, obj in found:
+                    if self._conforms(obj, filter_options):
+                        yield self._project(obj, projection)
+        finally:
+            with self._lock:
+                collection.end_iteration(iteration)
+
+    def set_object(self, collection_name, new_object, filter_options, multi=False):
+        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
+            raise ArgumentTypeError('filter_options must be a non-empty dict!')
+
+        with self._lock:
+            collection = self._collection(collection_name)
+
+            for ref, _ in self._find(collection, filter_options, multi):
+                collection.remove(ref)
+
+            self._put(collection, dict(new_object))
+
+        self._changed()
+
+        return True
+
+    def remove_object(self, collection_name, filter_options, multi=False):
+        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
+            raise ArgumentTypeError('filter_options must be a non-empty dict!')
+
+        with self._lock:
+            collection = self._collection(collection_name)
+            found = self._find(collection, filter_options, multi)
+
+            for ref, _ in found:
+                collection.remove(ref)
+
+        self._changed()
+
+        return len(found) > 0
+
+    def flush(self):
+        with self._lock:
+            for collection in self._collections.values():
+                collection.flush()
+
+                if collection.data_size > self._compaction_min_size \
+                        and collection.dead_bytes > collection.data_size * self._compaction_ratio:
+                    collection.compact()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = True
+
+            for collection in self._collections.values():
+                collection.close()
+
+            self._collections = {}
@@ -0,0 +1,112 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+        Lets through at most `rate` acquisitions per second on average,
+        with bursts of up to `capacity`.
+    """
+    def __init__(self, rate, capacity=None):
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, going into debt if there is none.
+
+        :return: seconds to wait before the token may be used
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            self._tokens -= 1
+
+            if self._tokens >= 0:
+                return 0
+
+            return -self._tokens / self._rate
+
+    def acquire(self):
+        delay = self.reserve()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """
+        Hold all the acquisitions back for a while(e.g. when asked to by a 429 response).
+
+        :param seconds: time to hold back for
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            self._tokens = min(self._tokens, -seconds * self._rate)
+
+
+class KeyedRateLimiter(object):
+    """
+        Lets through at most `rate` acquisitions per second for every key,
+        e.g. per chat. Idle keys are forgotten.
+    """
+    def __init__(self, rate):
+        self._interval = 1.0 / rate
+        # key -> time the next acquisition is allowed at
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+        self._cleaned_at = time.monotonic()
+
+    def reserve(self, key):
+        """
+        Book the next acquisition for a key.
+
+        :param key: key to book the acquisition for
+        :return: seconds to wait before going on
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            if now - self._cleaned_at > 60:
+                self._next_allowed = {k: t for k, t in self._next_allowed.items() if t > now}
+                self._cleaned_at = now
+
+            allowed_at = max(now, self._next_allowed.get(key, now))
+            self._next_allowed[key] = allowed_at + self._interval
+
+        return allowed_at - now
+
+    def acquire(self, key):
+        delay = self.reserve(key)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, key, seconds):
+        with self._lock:
+            self._next_allowed[key] = max(self._next_allowed.get(key, 0), time.monotonic() + seconds)
+
+
+def get_retry_after(exception):
+    """
+    Find out whether an api call has failed because of flood control.
+
+    :param exception: exception raised by an api call
+    :return: seconds to wait before retrying or None if the call is not to be retried
+    """
+    result = getattr(exception, 'result', None)
+
+    if result is None or getattr(result, 'status_code', None) != 429:
+        return None
+
+    try:
+        return result.json().get('parameters', {}).get('retry_after', 1)
+    except ValueError:
+        return 1
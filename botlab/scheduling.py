@@ -0,0 +1,162 @@
+import itertools
+import logging
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedWorkerPool(object):
+    """
+        Thread pool that runs the tasks of one key(e.g. chat id) one after
+        another, in the order they were put, while the tasks of different
+        keys run in parallel.
+
+        Every key is hashed to one of `workers` threads, each of them with
+        its own queue of at most `queue_size` tasks. `put` blocks while the
+        queue is full, so the producer(polling) slows down to the pace of
+        the handlers instead of piling the updates up in memory.
+
+        Has the interface of telebot's ThreadPool the polling loop relies on
+        (`exception_event`, `raise_exceptions`, `clear_exceptions`, `close`).
+
+        :param workers: number of worker threads
+        :param queue_size: max number of tasks waiting in one worker's queue
+    """
+    DEFAULT_WORKERS = 8
+    DEFAULT_QUEUE_SIZE = 1000
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.num_threads = workers
+        self._queue_size = queue_size
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        # tasks without a key are spread evenly
+        self._round_robin = itertools.count()
+        self._running = True
+
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._blocked_puts = 0
+        self._max_depths = [0] * workers
+
+        self.exception_event = threading.Event()
+        self.exc_info = None
+
+        self._workers = [threading.Thread(target=self._work, args=(shard,), name='BotLabWorker{0}'.format(shard),
+                                          daemon=True)
+                         for shard in range(workers)]
+
+        for worker in self._workers:
+            worker.start()
+
+    def shard(self, key):
+        """
+        :param key: hashable key or None
+        :return: index of the worker the tasks of the key go to
+        """
+        if key is None:
+            return next(self._round_robin) % self.num_threads
+
+        return hash(key) % self.num_threads
+
+    def put(self, key, func, *args, **kwargs):
+        """
+        Schedule `func(*args, **kwargs)` after all the tasks of the same key
+        put before. Blocks while the queue of the key's worker is full.
+        """
+        shard = self.shard(key)
+        tasks = self._queues[shard]
+
+        if tasks.full():
+            with self._lock:
+                self._blocked_puts += 1
+
+        tasks.put((func, args, kwargs))
+
+        depth = tasks.qsize()
+
+        if depth > self._max_depths[shard]:
+            self._max_depths[shard] = depth
+
+    def _work(self, shard):
+        tasks = self._queues[shard]
+
+        while self._running:
+            try:
+                func, args, kwargs = tasks.get(timeout=.5)
+            except queue.Empty:
+                continue
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('Task failed')
+
+                self.exc_info = sys.exc_info()
+                self.exception_event.set()
+            finally:
+                tasks.task_done()
+
+                with self._lock:
+                    self._processed += 1
+
+    def queue_depths(self):
+        """
+        :return: list of the numbers of tasks waiting for each worker
+        """
+        return [tasks.qsize() for tasks in self._queues]
+
+    def metrics(self):
+        """
+        :return: dict with the current queue depths(`depths`, `queued`), the
+            deepest each queue has been(`max_depths`), the number of tasks
+            done(`processed`) and of puts that had to wait for a full
+            queue(`blocked_puts`)
+        """
+        depths = self.queue_depths()
+
+        with self._lock:
+            return {
+                'workers': self.num_threads,
+                'queue_size': self._queue_size,
+                'depths': depths,
+                'queued': sum(depths),
+                'max_depths': list(self._max_depths),
+                'processed': self._processed,
+                'blocked_puts': self._blocked_puts
+            }
+
+    def join(self, timeout=None):
+        """
+        Wait for all the tasks put so far to be done.
+
+        :return: False if timed out
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        for tasks in self._queues:
+            with tasks.all_tasks_done:
+                while tasks.unfinished_tasks > 0:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+
+                    if remaining is not None and remaining <= 0:
+                        return False
+
+                    tasks.all_tasks_done.wait(remaining)
+
+        return True
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exc_info[1].with_traceback(self.exc_info[2])
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        self._running = False
+
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,170 @@
+import json
+import pickle
+import zlib
+
+from botlab.exceptions import UnsupportedCodecException
+
+# values encoded with a header start with this byte, which a JSON text never starts with
+MARKER = b'\xb1'
+
+
+class JsonCodec(object):
+    name = 'json'
+    id = 1
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    id = 2
+
+    @staticmethod
+    def dumps(value):
+        import msgpack
+
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        import msgpack
+
+        # keys of any type, as in json and pickle
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class PickleCodec(object):
+    name = 'pickle'
+    id = 3
+
+    @staticmethod
+    def dumps(value):
+        return pickle.dumps(value, protocol=5)
+
+    @staticmethod
+    def loads(data):
+        return pickle.loads(data)
+
+
+class ZlibCompression(object):
+    name = 'zlib'
+    id = 1
+
+    @staticmethod
+    def compress(data):
+        return zlib.compress(data)
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data)
+
+
+class Lz4Compression(object):
+    name = 'lz4'
+    id = 2
+
+    @staticmethod
+    def compress(data):
+        import lz4.frame
+
+        return lz4.frame.compress(data)
+
+    @staticmethod
+    def decompress(data):
+        import lz4.frame
+
+        return lz4.frame.decompress(data)
+
+
+CODECS = {codec.name: codec for codec in [JsonCodec, MsgpackCodec, PickleCodec]}
+COMPRESSIONS = {compression.name: compression for compression in [ZlibCompression, Lz4Compression]}
+
+
+class Serializer(object):
+    """
+        Turns values into bytes and back.
+
+        `codec` is 'json'(default), 'msgpack'(needs the msgpack package) or
+        'pickle'(protocol 5). Values encoded to more than
+        `compression_threshold` bytes(1024 by default) are compressed with
+        `compression`: None(default), 'zlib' or 'lz4'(needs the lz4 package).
+
+        Every value tells how it was encoded: a header with the codec and the
+        compression is put in front of it, except for uncompressed JSON,
+        which is stored as it always was. So values written with any
+        settings(or before the settings existed) can be read with any, and
+        the codec can be changed on a running deployment. Pickled values are
+        only read if the codec is 'pickle' or `allow_pickle` is set, as
+        unpickling data from a shared storage may run arbitrary code.
+
+        :param config: dict with `codec`, `compression`,
+            `compression_threshold` and `allow_pickle`, or None for defaults
+    """
+    DEFAULT_CODEC = 'json'
+    DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+    def __init__(self, config=None):
+        config = config or {}
+
+        codec_name = config.get('codec') or Serializer.DEFAULT_CODEC
+        compression_name = config.get('compression')
+
+        if codec_name not in CODECS:
+            raise UnsupportedCodecException(codec_name)
+
+        if compression_name is not None and compression_name not in COMPRESSIONS:
+            raise UnsupportedCodecException(compression_name)
+
+        self._codec = CODECS[codec_name]
+        self._compression = COMPRESSIONS[compression_name] if compression_name is not None else None
+        self._compression_threshold = config.get('compression_threshold', Serializer.DEFAULT_COMPRESSION_THRESHOLD)
+        self._allow_pickle = config.get('allow_pickle', codec_name == PickleCodec.name)
+
+        self._codecs_by_id = {codec.id: codec for codec in CODECS.values()}
+        self._compressions_by_id = {compression.id: compression for compression in COMPRESSIONS.values()}
+
+    def dumps(self, value):
+        """
+        :param value: value to encode
+        :return: bytes
+        """
+        data = self._codec.dumps(value)
+        compression_id = 0
+
+        if self._compression is not None and len(data) > self._compression_threshold:
+            data = self._compression.compress(data)
+            compression_id = self._compression.id
+
+        if self._codec is JsonCodec and compression_id == 0:
+            return data
+
+        return MARKER + bytes([self._codec.id, compression_id]) + data
+
+    def loads(self, data):
+        """
+        :param data: bytes produced by `dumps` with any settings
+        :return: value
+        """
+        if not data.startswith(MARKER):
+            return JsonCodec.loads(data)
+
+        codec = self._codecs_by_id.get(data[1])
+        compression_id = data[2]
+        data = data[3:]
+
+        if codec is None or (compression_id != 0 and compression_id not in self._compressions_by_id):
+            raise UnsupportedCodecException('unknown value header')
+
+        if codec is PickleCodec and not self._allow_pickle:
+            raise UnsupportedCodecException('pickled values are not allowed')
+
+        if compression_id != 0:
+            data = self._compressions_by_id[compression_id].decompress(data)
+
+        return codec.loads(data)
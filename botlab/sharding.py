@@ -0,0 +1,291 @@
+import copy
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import telebot
+
+from botlab.webhook import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_chat_id(update):
+    """
+    :param update: update as it comes from the Bot API(dict)
+    :return: id of the chat the update's session is bound to(see `BotLab._get_chat_id`) or None
+    """
+    if update.get('message') is not None:
+        return update['message']['chat']['id']
+
+    callback_query = update.get('callback_query')
+
+    if callback_query is not None:
+        if callback_query.get('message') is not None:
+            return callback_query['message']['chat']['id']
+        else:
+            return callback_query['from']['id']
+
+    for update_type in ['edited_message', 'channel_post', 'edited_channel_post']:
+        if update.get(update_type) is not None:
+            return update[update_type]['chat']['id']
+
+    for update_type in ['inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query']:
+        if update.get(update_type) is not None and update[update_type].get('from') is not None:
+            return update[update_type]['from']['id']
+
+    return None
+
+
+def shard_config(config_dict, shard):
+    """
+    Configuration of the bot of one worker process. Every worker only ever
+    sees the chats hashed to it, so with 'disk' storage each of them keeps
+    its own file(`<file_path>.shard<N>`) and no file is written by two
+    processes, and so does 'paged' storage with its directory. 'mongo'
+    and 'sqlite' storages are shared as is.
+
+    :param config_dict: configuration of the bot
+    :param shard: index of the worker
+    :return: configuration dict
+    """
+    config_dict = copy.deepcopy(config_dict)
+    db_storage = config_dict.get('db_storage', {})
+
+    if db_storage.get('type') == 'disk':
+        params = db_storage['params']
+
+        for key in ['file_path', 'journal_file_path']:
+            if params.get(key) is not None:
+                params[key] = '{0}.shard{1}'.format(params[key], shard)
+
+    if db_storage.get('type') == 'paged':
+        db_storage['params']['path'] = '{0}.shard{1}'.format(db_storage['params']['path'], shard)
+
+    return config_dict
+
+
+def _run_worker(shard, config_dict, setup, updates):
+    # imported here so that the module can be loaded by botlab itself
+    from botlab import BotLab
+
+    bot = BotLab(shard_config(config_dict, shard))
+    setup(bot)
+
+    try:
+        while True:
+            batch = [updates.get()]
+
+            # take whatever else is waiting, without blocking
+            while batch[-1] is not None and len(batch) < ShardSupervisor.WORKER_BATCH_SIZE:
+                try:
+                    batch.append(updates.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+
+            if stop:
+                batch.pop()
+
+            if len(batch) > 0:
+                bot.process_new_updates([telebot.types.Update.de_json(update) for update in batch])
+
+            if stop:
+                break
+    finally:
+        if bot.threaded:
+            bot.worker_pool.join()
+            bot.worker_pool.close()
+
+        bot._storage.close()
+
+
+class ShardSupervisor(object):
+    """
+        Runs a bot in several processes.
+
+        The supervisor receives the updates(by polling `getUpdates` or from
+        `process_new_updates`, e.g. called by a webhook) and hands each one
+        to the worker process its chat id is hashed to. Every worker runs
+        a BotLab of its own, set up by `setup(bot)`(must be picklable, e.g.
+        a module-level function, if processes are spawned). The updates of
+        one chat are always handled by the same worker in the order they
+        came, so its sessions are never touched by two processes at once.
+
+        The updates waiting for a worker are kept by the supervisor, so a
+        worker can be restarted(`restart_worker`) without losing any: the
+        old one handles everything it was given before it exits, the new one
+        goes on from there. Workers that die are started again whenever
+        updates are handed over, as well as when a worker's queue stays full
+        for `PUT_TIMEOUT` seconds.
+
+        Configured by the `sharding` section of the configuration:
+        `processes`(number of CPUs by default) and `queue_size`(max number
+        of updates waiting for one worker; receiving waits while it is full).
+
+        :param config_dict: configuration of the bot
+        :param setup: function registering the handlers on a BotLab
+    """
+    DEFAULT_QUEUE_SIZE = 10000
+    WORKER_BATCH_SIZE = 100
+    POLLING_LIMIT = 100
+    PUT_TIMEOUT = 1
+
+    def __init__(self, config_dict, setup):
+        sharding_config = config_dict.get('sharding') or {}
+
+        self._config_dict = config_dict
+        self._setup = setup
+        self._processes = sharding_config.get('processes') or os.cpu_count() or 1
+        self._queue_size = sharding_config.get('queue_size', ShardSupervisor.DEFAULT_QUEUE_SIZE)
+
+        self._queues = [multiprocessing.Queue(self._queue_size) for _ in range(self._processes)]
+        self._workers = [None] * self._processes
+        self._workers_lock = threading.RLock()
+        self._stopped = threading.Event()
+
+        self.last_update_id = 0
+
+    def start(self):
+        with self._workers_lock:
+            for shard in range(self._processes):
+                if self._workers[shard] is None:
+                    self._start_worker(shard)
+
+    def _start_worker(self, shard):
+        worker = multiprocessing.Process(target=_run_worker, name='BotLabShard{0}'.format(shard),
+                                         args=(shard, self._config_dict, self._setup, self._queues[shard]))
+        worker.start()
+
+        self._workers[shard] = worker
+
+    def shard(self, chat_id):
+        if chat_id is None:
+            return 0
+
+        return hash(chat_id) % self._processes
+
+    def process_new_updates(self, updates):
+        """
+        Hand the updates over to the workers.
+
+        :param updates: list of updates as they come from the Bot API(dicts)
+        """
+        self.revive_workers()
+
+        for update in updates:
+            if update['update_id'] > self.last_update_id:
+                self.last_update_id = update['update_id']
+
+            self._put(self.shard(get_update_chat_id(update)), update)
+
+    def _put(self, shard, update):
+        while True:
+            try:
+                self._queues[shard].put(update, timeout=ShardSupervisor.PUT_TIMEOUT)
+                return
+            except queue.Full:
+                # either the worker is busy or it is dead and nobody takes the updates out
+                self.revive_workers()
+
+    def polling(self, timeout=20, interval=0):
+        """
+        Receive updates with `getUpdates` until `stop()` is called.
+        """
+        self.start()
+        self._stopped.clear()
+
+        token = self._config_dict['bot']['token']
+        error_interval = 0.25
+
+        while not self._stopped.wait(interval):
+            try:
+                updates = telebot.apihelper.get_updates(token, offset=self.last_update_id + 1,
+                                                        limit=ShardSupervisor.POLLING_LIMIT, timeout=timeout)
+                error_interval = 0.25
+            except telebot.apihelper.ApiException as e:
+                logger.error(e)
+                time.sleep(error_interval)
+                error_interval = min(error_interval * 2, 30)
+                continue
+
+            self.process_new_updates(updates)
+
+    def webhook_server(self):
+        """
+        :return: WebhookServer handing the updates over to the workers(see `BotLab.webhook_server`)
+        """
+        return WebhookServer(self.process_new_updates, self._config_dict.get('webhook'), decode=None)
+
+    def revive_workers(self):
+        """
+        Start again the workers that died.
+
+        :return: list of the shards restarted
+        """
+        revived = []
+
+        with self._workers_lock:
+            for shard, worker in enumerate(self._workers):
+                if worker is not None and not worker.is_alive():
+                    logger.error('Worker %d exited with code %s, restarting', shard, worker.exitcode)
+
+                    self._start_worker(shard)
+                    revived.append(shard)
+
+        return revived
+
+    def restart_worker(self, shard):
+        """
+        Replace a worker with a new process after it has handled every update it was given.
+        """
+        with self._workers_lock:
+            self._stop_worker(shard)
+            self._start_worker(shard)
+
+    def _stop_worker(self, shard):
+        worker = self._workers[shard]
+
+        if worker is None:
+            return
+
+        while worker.is_alive():
+            try:
+                self._queues[shard].put(None, timeout=ShardSupervisor.PUT_TIMEOUT)
+            except queue.Full:
+                # keep waiting for it to drain the queue, unless it has died meanwhile
+                continue
+
+            worker.join()
+
+        # died, possibly with its queue full: nobody will take the updates out
+        worker.join()
+        self._workers[shard] = None
+
+    def queue_depths(self):
+        """
+        :return: list of the approximate numbers of updates waiting for each worker
+        """
+        depths = []
+
+        for updates in self._queues:
+            try:
+                depths.append(updates.qsize())
+            except NotImplementedError:
+                depths.append(None)
+
+        return depths
+
+    def stop(self):
+        """
+        Stop receiving updates and wait for the workers to handle the ones already received.
+        """
+        self._stopped.set()
+
+        with self._workers_lock:
+            for shard in range(self._processes):
+                self._stop_worker(shard)
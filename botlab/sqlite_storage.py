@@ -0,0 +1,370 @@
+import json
+import logging
+import sqlite3
+import threading
+from argparse import ArgumentTypeError
+
+from botlab.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _json_path(field):
+    return '$."' + field.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class SqliteStorage(Storage):
+    """
+        Storage keeping every collection in a table of an SQLite database
+        (`file_path`), one JSON document per row.
+
+        The fields declared in `indexes` are made generated columns of the
+        tables, with an index on each; lookups by them don't scan the whole
+        table. Declarations are the same as for MongoStorage:
+
+            'params': {
+                'indexes': {
+                    'sessions': [{'key': 'chat_id', 'unique': True}],
+                    'broadcasts': ['job_id']
+                }
+            }
+
+        A unique index on `chat_id` of `sessions` is created when nothing
+        is declared.
+
+        The database is in WAL mode, so that readers don't wait for writers,
+        and can be shared by several processes: every change is made in
+        a transaction of its own(`bulk_set` - in one for all the updates).
+        Each thread uses a connection of its own. With the default
+        `synchronous` = 'NORMAL' committed changes survive a crash of the
+        process, 'FULL' makes them survive a power loss as well.
+
+        :param config: dict with `file_path`, `indexes`, `synchronous` and
+            `timeout`(seconds to wait for a lock held by another process)
+    """
+    DEFAULT_INDEXES = {
+        'sessions': [{'key': 'chat_id', 'unique': True}]
+    }
+    DEFAULT_SYNCHRONOUS = 'NORMAL'
+    DEFAULT_TIMEOUT = 30
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, config):
+        super().__init__(config)
+
+        self._file_path = config['file_path']
+        self._synchronous = config.get('synchronous', SqliteStorage.DEFAULT_SYNCHRONOUS)
+        self._timeout = config.get('timeout', SqliteStorage.DEFAULT_TIMEOUT)
+
+        # collection name -> list of (field, unique)
+        self._indexes = {collection_name: [(field, False) if isinstance(field, str)
+                                           else (field['key'], field.get('unique', False))
+                                           for field in fields]
+                         for collection_name, fields in config.get('indexes', SqliteStorage.DEFAULT_INDEXES).items()}
+        # collection name -> indexed field -> column name
+        self._columns = {collection_name: {field: 'field_' + field for field, _ in fields}
+                         for collection_name, fields in self._indexes.items()}
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._tables = set()
+
+        # WAL mode is a property of the database file, set once
+        self._connection().execute('PRAGMA journal_mode=WAL')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            # transactions are begun explicitly
+            connection = sqlite3.connect(self._file_path, timeout=self._timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA synchronous={0}'.format(self._synchronous))
+
+            self._local.connection = connection
+
+            with self._lock:
+                self._connections.append(connection)
+
+        return connection
+
+    def _table(self, collection_name):
+        """
+        :return: quoted name of the collection's table, created if needed
+        """
+        table = _quote(collection_name)
+
+        if collection_name in self._tables:
+            return table
+
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS {0} (id INTEGER PRIMARY KEY, doc TEXT NOT NULL)'.format(table))
+
+        existing_columns = {row[1] for row in connection.execute('PRAGMA table_xinfo({0})'.format(table))}
+
+        for field, unique in self._indexes.get(collection_name, []):
+            column = self._columns[collection_name][field]
+
+            try:
+                if column not in existing_columns:
+                    connection.execute('ALTER TABLE {0} ADD COLUMN {1} GENERATED ALWAYS AS (json_extract(doc, {2}))'
+                                       .format(table, _quote(column), "'" + _json_path(field).replace("'", "''") + "'"))
+
+                connection.execute('CREATE {0}INDEX IF NOT EXISTS {1} ON {2} ({3})'.format(
+                    'UNIQUE ' if unique else '', _quote('{0}_{1}'.format(collection_name, column)), table,
+                    _quote(column)))
+            except sqlite3.OperationalError as e:
+                # e.g. created by another process meanwhile
+                logger.warning('Failed to create index on %s.%s: %s', collection_name, field, e)
+
+        self._tables.add(collection_name)
+
+        return table
+
+    def _where(self, collection_name, filter_options):
+        """
+        Narrow the rows down in SQL; the objects are then checked by `_conforms`,
+        as SQLite compares some values(e.g. booleans) differently.
+
+        :return: (WHERE clause, parameters)
+        """
+        conditions = []
+        params = []
+        columns = self._columns.get(collection_name, {})
+
+        for key, value in filter_options.items():
+            column = _quote(columns[key]) if key in columns else 'json_extract(doc, ?)'
+
+            if value is None:
+                condition = '{0} IS NULL'
+            elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                condition = '{0} = ?'
+            else:
+                continue
+
+            if key not in columns:
+                params.append(_json_path(key))
+
+            if value is not None:
+                params.append(value)
+
+            conditions.append(condition.format(column))
+
+        if len(conditions) < 1:
+            return '', params
+
+        return ' WHERE ' + ' AND '.join(conditions), params
+
+    @staticmethod
+    def _conforms(obj, filter_options):
+        for filter_key, filter_value in filter_options.items():
+            if obj.get(filter_key) != filter_value:
+                return False
+
+        return True
+
+    @staticmethod
+    def _project(obj, projection):
+        if projection is None:
+            return obj
+
+        return {field: obj[field] for field in projection if field in obj}
+
+    def _find(self, connection, collection_name, filter_options, multi=True):
+        """
+        :return: list of (row id, object) conforming to the filter
+        """
+        where, params = self._where(collection_name, filter_options)
+        found = []
+
+        for row_id, doc in connection.execute('SELECT id, doc FROM {0}{1} ORDER BY id'
+                                              .format(self._table(collection_name), where), params):
+            obj = json.loads(doc)
+
+            if self._conforms(obj, filter_options):
+                found.append((row_id, obj))
+
+                if not multi:
+                    break
+
+        return found
+
+    def _set_fields(self, connection, collection_name, new_values, multi, filter_options):
+        table = self._table(collection_name)
+        found = self._find(connection, collection_name, filter_options, multi)
+
+        if len(found) < 1:
+            obj = dict(filter_options)
+            obj.update(new_values)
+
+            connection.execute('INSERT INTO {0} (doc) VALUES (?)'.format(table), (json.dumps(obj),))
+            return
+
+        for row_id, obj in found:
+            obj.update(new_values)
+            connection.execute('UPDATE {0} SET doc = ? WHERE id = ?'.format(table), (json.dumps(obj), row_id))
+
+    def _transaction(self, func, *args):
+        connection = self._connection()
+
+        # the write lock is taken right away, so that nothing changes between reading and writing
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            result = func(connection, *args)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+
+        return result
+
+    def get_field(self, collection_name, key, **filter_options):
+        found = self._find(self._connection(), collection_name, filter_options)
+
+        return [obj[key] for _, obj in found if obj.get(key) is not None]
+
+    def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
+        return self.set_fields(collection_name, {key: new_value}, multi=multi, **filter_options)
+
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        self._transaction(self._set_fields, collection_name, new_values, multi, filter_options)
+
+        return True
+
+    def bulk_set(self, collection_name, updates):
+        def set_all(connection):
+            for filter_options, new_values in updates:
+                self._set_fields(connection, collection_name, new_values, False, filter_options)
+
+        self._transaction(set_all)
+
+        return True
+
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
+            raise ArgumentTypeError('filter_options must be a non-empty dict!')
+
+        found = self._find(self._connection(), collection_name, filter_options, multi)
+
+        if multi:
+            return [self._project(obj, projection) for _, obj in found]
+
+        if len(found) < 1:
+            return None
+
+        return self._project(found[0][1], projection)
+
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        if batch_size is None:
+            batch_size = SqliteStorage.DEFAULT_BATCH_SIZE
+
+        table = self._table(collection_name)
+        where, params = self._where(collection_name, filter_options)
+        where = (where + ' AND' if where else ' WHERE') + ' id > ?'
+        last_row_id = 0
+
+        while True:
+            # a batch at a time, so that no read transaction is held between them
+            rows = self._connection().execute('SELECT id, doc FROM {0}{1} ORDER BY id LIMIT ?'.format(table, where),
+                                              params + [last_row_id, batch_size]).fetchall()
+
+            for row_id, doc in rows:
+                obj = json.loads(doc)
+
+                if self._conforms(obj, filter_options):
+                    yield self._project(obj, projection)
+
+            if len(rows) < batch_size:
+                return
+
+            last_row_id = rows[-1][0]
+
+    def iter_field_sorted(self, collection_name, key, after=None, batch_size=None, **filter_options):
+        column = self._columns.get(collection_name, {}).get(key)
+
+        if column is None:
+            # no index to sort by
+            yield from super().iter_field_sorted(collection_name, key, after=after, batch_size=batch_size,
+                                                 **filter_options)
+            return
+
+        batch_size = batch_size or Storage.SORTED_BATCH_SIZE
+        table = self._table(collection_name)
+        where, params = self._where(collection_name, filter_options)
+        column = _quote(column)
+        # rows are read by (value, id), so that rows with the same value don't stop the paging
+        last_row = None
+
+        while True:
+            if last_row is None:
+                condition = '{0} IS NOT NULL'.format(column) if after is None else '{0} > ?'.format(column)
+                condition_params = [] if after is None else [after]
+            else:
+                condition = '({0} > ? OR ({0} = ? AND id > ?))'.format(column)
+                condition_params = [last_row[1], last_row[1], last_row[0]]
+
+            rows = self._connection().execute(
+                'SELECT id, {0}, doc FROM {1}{2} {3} ORDER BY {0}, id LIMIT ?'.format(
+                    column, table, where + ' AND' if where else ' WHERE', condition),
+                params + condition_params + [batch_size]).fetchall()
+
+            for row_id, value, doc in rows:
+                if (after is None or value > after) and self._conforms(json.loads(doc), filter_options):
+                    after = value
+                    yield value
+
+            if len(rows) < batch_size:
+                return
+
+            last_row = rows[-1][:2]
+
+    def set_object(self, collection_name, new_object, filter_options, multi=False):
+        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
+            raise ArgumentTypeError('filter_options must be a non-empty dict!')
+
+        def replace(connection):
+            table = self._table(collection_name)
+
+            for row_id, _ in self._find(connection, collection_name, filter_options, multi):
+                connection.execute('DELETE FROM {0} WHERE id = ?'.format(table), (row_id,))
+
+            connection.execute('INSERT INTO {0} (doc) VALUES (?)'.format(table), (json.dumps(new_object),))
+
+        self._transaction(replace)
+
+        return True
+
+    def remove_object(self, collection_name, filter_options, multi=False):
+        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
+            raise ArgumentTypeError('filter_options must be a non-empty dict!')
+
+        def remove(connection):
+            table = self._table(collection_name)
+            found = self._find(connection, collection_name, filter_options, multi)
+
+            for row_id, _ in found:
+                connection.execute('DELETE FROM {0} WHERE id = ?'.format(table), (row_id,))
+
+            return len(found) > 0
+
+        return self._transaction(remove)
+
+    def flush(self):
+        # move the committed changes from the WAL to the database file
+        self._connection().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+
+        for connection in connections:
+            connection.close()
+
+        self._local = threading.local()
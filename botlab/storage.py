@@ -1,9 +1,20 @@
+import atexit
+import collections.abc
+import heapq
 import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
 from abc import abstractmethod
 from argparse import ArgumentTypeError
-from functools import reduce
 
-import pymongo
+from botlab.exceptions import UnsupportedCodecException
+from botlab.serialization import Serializer
+
+logger = logging.getLogger(__name__)
 
 
 class Collection(object):
@@ -11,6 +22,8 @@ class Collection(object):
 
 
 class Storage(object):
+    SORTED_BATCH_SIZE = 1000
+
     def __init__(self, config):
         self.config = config
 
@@ -22,11 +35,108 @@ class Storage(object):
     def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
         pass
 
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        """
+        Set several fields of the conforming object(s) at once.
+
+        :param collection_name: name of the collection
+        :param new_values: dict of field names and their new values
+        :param multi: update all the conforming objects instead of the first one
+        :param filter_options: equality filter; an object made of it is created if nothing conforms
+        :return: True on success
+        """
+        for key, new_value in new_values.items():
+            self.set_field(collection_name, key, new_value, multi=multi, **filter_options)
+
+        return True
+
+    def bulk_set(self, collection_name, updates):
+        """
+        Apply many `set_fields` at once, e.g. write back a batch of sessions.
+
+        :param collection_name: name of the collection
+        :param updates: list of (filter_options, new_values) pairs, see `set_fields`
+        :return: True on success
+        """
+        for filter_options, new_values in updates:
+            self.set_fields(collection_name, new_values, **filter_options)
+
+        return True
+
     # work with entire objects from collection
     # TODO: add deprecations
 
     @abstractmethod
-    def get_object(self, collection_name, filter_options, multi=False):
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        """
+        :param collection_name: name of the collection
+        :param filter_options: equality filter
+        :param multi: return all the conforming objects instead of the first one
+        :param projection: list of fields to fetch, None - all of them
+        :return: object or None, list of objects if `multi`
+        """
+        pass
+
+    # lazy iteration over big result sets
+
+    def iter_field(self, collection_name, key, batch_size=None, **filter_options):
+        """
+        Iterate over the values of a field of the conforming objects without loading them all at once.
+
+        Unlike `get_field`, values are not deduplicated; objects without
+        the field are skipped.
+
+        :param collection_name: name of the collection
+        :param key: field name
+        :param batch_size: number of objects to fetch from the backend at a time
+        :param filter_options: equality filter
+        :return: iterator over the field values
+        """
+        for obj in self.iter_objects(collection_name, filter_options, batch_size=batch_size, projection=[key]):
+            value = obj.get(key)
+
+            if value is not None:
+                yield value
+
+    def iter_field_sorted(self, collection_name, key, after=None, batch_size=None, **filter_options):
+        """
+        Iterate over the distinct values of a field of the conforming objects in ascending order.
+
+        Only a batch of values is held at a time: this implementation scans
+        the conforming objects once per batch, backends able to sort replace it.
+
+        :param collection_name: name of the collection
+        :param key: field name
+        :param after: start with the first value greater than it, None - with the smallest one
+        :param batch_size: number of values to fetch from the backend at a time
+        :param filter_options: equality filter
+        :return: iterator over the field values
+        """
+        batch_size = batch_size or Storage.SORTED_BATCH_SIZE
+
+        while True:
+            values = self.iter_field(collection_name, key, **filter_options)
+            batch = heapq.nsmallest(batch_size, (value for value in values if after is None or value > after))
+
+            for value in batch:
+                if after is None or value > after:
+                    after = value
+                    yield value
+
+            if len(batch) < batch_size:
+                return
+
+    @abstractmethod
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        """
+        Iterate over the conforming objects in insertion order without loading them all at once.
+
+        :param collection_name: name of the collection
+        :param filter_options: equality filter, empty dict - all the objects
+        :param batch_size: number of objects to fetch from the backend at a time
+        :param projection: list of fields to fetch, None - all of them
+        :return: iterator over the objects
+        """
         pass
 
     @abstractmethod
@@ -37,6 +147,18 @@ class Storage(object):
     def remove_object(self, collection_name, filter_options, multi=False):
         pass
 
+    def flush(self):
+        """
+        Make every change made so far durable.
+        """
+        pass
+
+    def sync(self):
+        return self.flush()
+
+    def close(self):
+        pass
+
     def collection(self, collection_name):
         coll = Collection()
 
@@ -46,8 +168,23 @@ class Storage(object):
         def decorated_set_field(key, new_value, multi=False, **filter_options):
             return self.set_field(collection_name, key, new_value, multi=multi, **filter_options)
 
-        def decorated_get_object(filter_options, multi=False):
-            return self.get_object(collection_name, filter_options, multi)
+        def decorated_set_fields(new_values, multi=False, **filter_options):
+            return self.set_fields(collection_name, new_values, multi=multi, **filter_options)
+
+        def decorated_bulk_set(updates):
+            return self.bulk_set(collection_name, updates)
+
+        def decorated_get_object(filter_options, multi=False, projection=None):
+            return self.get_object(collection_name, filter_options, multi, projection)
+
+        def decorated_iter_field(key, batch_size=None, **filter_options):
+            return self.iter_field(collection_name, key, batch_size=batch_size, **filter_options)
+
+        def decorated_iter_field_sorted(key, after=None, batch_size=None, **filter_options):
+            return self.iter_field_sorted(collection_name, key, after=after, batch_size=batch_size, **filter_options)
+
+        def decorated_iter_objects(filter_options, batch_size=None, projection=None):
+            return self.iter_objects(collection_name, filter_options, batch_size=batch_size, projection=projection)
 
         def decorated_set_object(new_object, filter_options, multi=False):
             return self.set_object(collection_name, new_object, filter_options, multi)
@@ -57,23 +194,309 @@ class Storage(object):
 
         decorated_get_field.__name__ = 'get_field'
         decorated_set_field.__name__ = 'set_field'
+        decorated_set_fields.__name__ = 'set_fields'
+        decorated_bulk_set.__name__ = 'bulk_set'
         decorated_get_object.__name__ = 'get_object'
+        decorated_iter_field.__name__ = 'iter_field'
+        decorated_iter_field_sorted.__name__ = 'iter_field_sorted'
+        decorated_iter_objects.__name__ = 'iter_objects'
         decorated_set_object.__name__ = 'set_object'
         decorated_remove_object.__name__ = 'remove_object'
 
         setattr(coll, decorated_get_field.__name__, decorated_get_field)
         setattr(coll, decorated_set_field.__name__, decorated_set_field)
+        setattr(coll, decorated_set_fields.__name__, decorated_set_fields)
+        setattr(coll, decorated_bulk_set.__name__, decorated_bulk_set)
         setattr(coll, decorated_get_object.__name__, decorated_get_object)
+        setattr(coll, decorated_iter_field.__name__, decorated_iter_field)
+        setattr(coll, decorated_iter_field_sorted.__name__, decorated_iter_field_sorted)
+        setattr(coll, decorated_iter_objects.__name__, decorated_iter_objects)
         setattr(coll, decorated_set_object.__name__, decorated_set_object)
         setattr(coll, decorated_remove_object.__name__, decorated_remove_object)
 
         return coll
 
 
+# value of a slot the record has no field for
+_UNSET = object()
+
+
+class CompactRecord(collections.abc.MutableMapping):
+    """
+        Object of a collection with a known schema, for `InMemoryStorage`.
+
+        The values of the schema fields are kept in slots instead of a dict
+        of the object's own, and strings among them are interned, so that
+        every 'main_menu' state is the same string. Any other field goes to
+        a dict created when the first one is set. Reads and compares like
+        the dict it stands for.
+
+        Use `CompactRecord.for_fields(fields)` to get the class of a schema.
+        The classes are made at runtime, so records never leave the storage:
+        they are handed out as plain dicts, which can be pickled or dumped
+        to json.
+    """
+    __slots__ = ('_extra',)
+
+    # field name -> slot name, set by `for_fields`
+    _slots = {}
+
+    @staticmethod
+    def for_fields(fields):
+        """
+        :param fields: list of field names
+        :return: CompactRecord subclass keeping them in slots
+        """
+        # slots are not named after the fields, which could shadow the methods
+        slots = {field: '_f{0}'.format(i) for i, field in enumerate(fields)}
+
+        return type('CompactRecord', (CompactRecord,), {'__slots__': tuple(slots.values()), '_slots': slots})
+
+    def __init__(self, obj=()):
+        self._extra = None
+        self.update(obj)
+
+    def __getitem__(self, key):
+        slot = self._slots.get(key)
+
+        if slot is not None:
+            value = getattr(self, slot, _UNSET)
+
+            if value is not _UNSET:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        slot = self._slots.get(key)
+
+        if slot is not None:
+            return getattr(self, slot, default)
+
+        if self._extra is None:
+            return default
+
+        return self._extra.get(key, default)
+
+    def __contains__(self, key):
+        slot = self._slots.get(key)
+
+        if slot is not None:
+            return hasattr(self, slot)
+
+        return self._extra is not None and key in self._extra
+
+    def __setitem__(self, key, value):
+        slot = self._slots.get(key)
+
+        if slot is not None:
+            setattr(self, slot, sys.intern(value) if type(value) is str else value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        slot = self._slots.get(key)
+
+        if slot is not None:
+            if not hasattr(self, slot):
+                raise KeyError(key)
+
+            delattr(self, slot)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for field, slot in self._slots.items():
+            if hasattr(self, slot):
+                yield field
+
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class InMemoryStorage(Storage):
+    """
+        Keeps collections as dicts, keyed by object identity, in insertion
+        order, so that an object found is removed without a scan; `store`
+        gives them out as lists of dicts.
+
+        Equality lookups on indexed fields are served from per-collection
+        hash indexes instead of scanning the whole collection. Indexes are
+        declared in the storage config:
+
+            'params': {
+                'indexes': {
+                    'sessions': ['chat_id']
+                }
+            }
+
+        `chat_id` on `sessions` is indexed when nothing is declared.
+
+        Collections whose objects mostly have the same few fields may be
+        given a schema, then their objects are kept as `CompactRecord`s,
+        several times smaller than dicts, and read as copies of them:
+
+            'params': {
+                'schemas': {
+                    'sessions': ['chat_id', 'lang', 'state', 'inline_state']
+                }
+            }
+    """
+    DEFAULT_INDEXES = {
+        'sessions': ['chat_id']
+    }
+
     def __init__(self, config):
         super().__init__(config)
-        self.store = {}
+        # collection name -> id of object -> object
+        self._collections = {}
+
+        indexes = (config or {}).get('indexes', InMemoryStorage.DEFAULT_INDEXES)
+
+        # collection name -> indexed field names(declarations may be dicts, see `MongoStorage`)
+        self._indexed_fields = {collection_name: tuple(field if isinstance(field, str) else field['key']
+                                                       for field in fields)
+                                for collection_name, fields in indexes.items()}
+        # collection name -> field name -> field value -> id of object -> object
+        self._indexes = {}
+
+        # collection name -> CompactRecord class
+        self._record_classes = {collection_name: CompactRecord.for_fields(fields)
+                                for collection_name, fields in (config or {}).get('schemas', {}).items()}
+
+    @property
+    def store(self):
+        """
+        :return: dict, collection name -> list of the objects
+        """
+        return {collection_name: list(collection.values()) for collection_name, collection in self._collections.items()}
+
+    @store.setter
+    def store(self, store):
+        # indexes are to be rebuilt afterwards
+        self._collections = {collection_name: {id(obj): obj for obj in collection}
+                             for collection_name, collection in store.items()}
+
+    def _rebuild_indexes(self):
+        self._indexes = {}
+
+        for collection_name, collection in self._collections.items():
+            record_class = self._record_classes.get(collection_name)
+
+            if record_class is not None:
+                records = [obj if isinstance(obj, record_class) else record_class(obj) for obj in collection.values()]
+
+                collection.clear()
+                collection.update((id(obj), obj) for obj in records)
+
+            for obj in collection.values():
+                self._index_object(collection_name, obj)
+
+    def _dump_store(self):
+        """
+        :return: the store with all the objects as plain dicts, e.g. to be serialized
+        """
+        return {collection_name: [dict(obj) for obj in collection] if collection_name in self._record_classes
+                else collection
+                for collection_name, collection in self.store.items()}
+
+    @staticmethod
+    def _hashable(value):
+        try:
+            hash(value)
+        except TypeError:
+            return False
+
+        return True
+
+    def _index_object(self, collection_name, obj):
+        for field in self._indexed_fields.get(collection_name, ()):
+            self._index_value(collection_name, field, obj.get(field), obj)
+
+    def _unindex_object(self, collection_name, obj):
+        for field in self._indexed_fields.get(collection_name, ()):
+            self._unindex_value(collection_name, field, obj.get(field), obj)
+
+    def _index_value(self, collection_name, field, value, obj):
+        if not self._hashable(value):
+            # unhashable values are only reachable by a full scan
+            return
+
+        field_index = self._indexes.setdefault(collection_name, {}).setdefault(field, {})
+        field_index.setdefault(value, {})[id(obj)] = obj
+
+    def _unindex_value(self, collection_name, field, value, obj):
+        if not self._hashable(value):
+            return
+
+        field_index = self._indexes.get(collection_name, {}).get(field, {})
+        bucket = field_index.get(value)
+
+        if bucket is None:
+            return
+
+        bucket.pop(id(obj), None)
+
+        if len(bucket) < 1:
+            del field_index[value]
+
+    def _update_object_field(self, collection_name, obj, key, new_value):
+        if key in self._indexed_fields.get(collection_name, ()):
+            self._unindex_value(collection_name, key, obj.get(key), obj)
+            self._index_value(collection_name, key, new_value, obj)
+
+        obj[key] = new_value
+
+    def _insert_object(self, collection_name, obj):
+        record_class = self._record_classes.get(collection_name)
+
+        if record_class is not None:
+            obj = record_class(obj)
+
+        self._collections.setdefault(collection_name, {})[id(obj)] = obj
+        self._index_object(collection_name, obj)
+
+    def _delete_object(self, collection_name, obj):
+        # by identity: an equal twin must stay
+        self._collections.get(collection_name, {}).pop(id(obj), None)
+        self._unindex_object(collection_name, obj)
+
+    def _candidate_objects(self, collection_name, filter_options):
+        """
+        Narrow a collection down to the objects that may match the filter.
+
+        :param collection_name: name of the collection to look in
+        :param filter_options: equality filter
+        :return: the smallest index bucket usable for the filter or the whole collection
+        """
+        collection_indexes = self._indexes.get(collection_name, {})
+        candidates = None
+
+        for field in self._indexed_fields.get(collection_name, ()):
+            if field not in filter_options or not self._hashable(filter_options[field]):
+                continue
+
+            bucket = collection_indexes.get(field, {}).get(filter_options[field], {})
+
+            if candidates is None or len(bucket) < len(candidates):
+                candidates = bucket
+
+        if candidates is None:
+            candidates = self._collections.get(collection_name, {})
+
+        return candidates.values()
 
     @staticmethod
     def _find_conforming_objects(collection, filter_options):
@@ -93,83 +516,74 @@ class InMemoryStorage(Storage):
 
         return conforming_objects
 
-    def get_field(self, collection_name, key, **filter_options):
-        arr = self.store.get(collection_name, [])
+    @staticmethod
+    def _find_conforming_records(record_class, collection, filter_options):
+        # slots are read directly, which is faster than even dict lookups
+        slot_filters = [(record_class._slots[key], value) for key, value in filter_options.items()
+                        if key in record_class._slots]
+        other_filters = [(key, value) for key, value in filter_options.items() if key not in record_class._slots]
 
-        if len(arr) < 1:
-            return []
+        if len(slot_filters) == 1 and len(other_filters) < 1:
+            slot, value = slot_filters[0]
 
-        reduce_filter_func = lambda dict_key, elem, res: \
-            res and (elem.get(dict_key) == filter_options.get(dict_key))
+            return [obj for obj in collection if getattr(obj, slot, None) == value]
 
-        arr_elem_meets_filter = lambda elem: reduce(lambda res, dict_key: reduce_filter_func(dict_key, elem, res), filter_options.keys(), True)
+        return [obj for obj in collection
+                if all(getattr(obj, slot, None) == value for slot, value in slot_filters)
+                and all(obj.get(key) == value for key, value in other_filters)]
 
-        filtered_arr = tuple(filter(lambda elem: arr_elem_meets_filter(elem), arr))
+    def _find(self, collection_name, filter_options):
+        candidates = self._candidate_objects(collection_name, filter_options)
+        record_class = self._record_classes.get(collection_name)
 
-        if len(filtered_arr) < 1:
-            return []
+        if record_class is not None:
+            return self._find_conforming_records(record_class, candidates, filter_options)
+
+        return self._find_conforming_objects(candidates, filter_options)
 
-        resulting_arr = list(filter(lambda elem: elem is not None, map(lambda elem: elem.get(key, None), filtered_arr)))
+    def get_field(self, collection_name, key, **filter_options):
+        filtered_arr = self._find(collection_name, filter_options)
 
-        return resulting_arr
+        return [elem.get(key) for elem in filtered_arr if elem.get(key) is not None]
 
     def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
-        collection = self.store.get(collection_name, [])
+        found_objects = self._find(collection_name, filter_options)
 
-        def create_new_obj(filter_options, key, new_value):
+        if len(found_objects) < 1:
             obj = dict(filter_options)
             obj[key] = new_value
 
-            return obj
-
-        if len(collection) < 1:
-            self.store[collection_name] = collection
-
-            collection.append(create_new_obj(filter_options, key, new_value))
+            self._insert_object(collection_name, obj)
+        else:
+            self._update_object_field(collection_name, found_objects[0], key, new_value)
 
-            return True
+        return True
 
-        def find_conforming_obj(collection, filter_options):
-            for obj in collection:
-                conforms = True
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        found_objects = self._find(collection_name, filter_options)
 
-                for filter_key in filter_options.keys():
-                    if obj.get(filter_key) != filter_options[filter_key]:
-                        conforms = False
-                        break
+        if len(found_objects) < 1:
+            obj = dict(filter_options)
+            obj.update(new_values)
 
-                if conforms:
-                    return obj
+            self._insert_object(collection_name, obj)
 
-            return None
+            return True
 
-        found_obj = find_conforming_obj(collection, filter_options)
+        if not multi:
+            found_objects = found_objects[:1]
 
-        if found_obj is None:
-            collection.append(create_new_obj(filter_options, key, new_value))
-        else:
-            found_obj[key] = new_value
+        for found_object in found_objects:
+            for key, new_value in new_values.items():
+                self._update_object_field(collection_name, found_object, key, new_value)
 
         return True
 
-    def get_object(self, collection_name, filter_options, multi=False):
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
         if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
             raise ArgumentTypeError('filter_options must be a non-empty dict!')
 
-        arr = self.store.get(collection_name, [])
-
-        if len(arr) < 1:
-            if multi:
-                return []
-            return None
-
-        reduce_filter_func = lambda dict_key, elem, res: \
-            res and (elem.get(dict_key) == filter_options.get(dict_key))
-
-        arr_elem_meets_filter = lambda elem: reduce(lambda res, dict_key: reduce_filter_func(dict_key, elem, res),
-                                                    filter_options.keys(), True)
-
-        filtered_arr = list(filter(lambda elem: arr_elem_meets_filter(elem), arr))
+        filtered_arr = self._find(collection_name, filter_options)
 
         if len(filtered_arr) < 1:
             if multi:
@@ -177,35 +591,57 @@ class InMemoryStorage(Storage):
             else:
                 return None
 
+        if not multi:
+            filtered_arr = filtered_arr[:1]
+
+        if projection is not None:
+            filtered_arr = [self._project(obj, projection) for obj in filtered_arr]
+        elif collection_name in self._record_classes:
+            filtered_arr = [dict(obj) for obj in filtered_arr]
+
         if multi:
             return filtered_arr
         else:
             return filtered_arr[0]
 
-    def set_object(self, collection_name, new_object, filter_options, multi=False):
-        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
-            raise ArgumentTypeError('filter_options must be a non-empty dict!')
+    @staticmethod
+    def _project(obj, projection):
+        return {field: obj[field] for field in projection if field in obj}
 
-        collection = self.store.get(collection_name, [])
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        # changes made while iterating must not shift the iteration
+        candidates = list(self._candidate_objects(collection_name, filter_options))
 
-        if len(collection) < 1:
-            self.store[collection_name] = collection
+        for obj in candidates:
+            conforms = True
 
-            collection.append(new_object)
+            for filter_key in filter_options.keys():
+                if obj.get(filter_key) != filter_options[filter_key]:
+                    conforms = False
+                    break
 
-            return True
+            if not conforms:
+                continue
 
-        found_objects = self._find_conforming_objects(collection, filter_options)
+            if projection is None:
+                yield dict(obj) if collection_name in self._record_classes else obj
+            else:
+                yield self._project(obj, projection)
 
-        if len(found_objects) > 0:
-            for found_object in found_objects:
-                collection.remove(found_object)
+    def set_object(self, collection_name, new_object, filter_options, multi=False):
+        if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
+            raise ArgumentTypeError('filter_options must be a non-empty dict!')
 
-                if not multi:
-                    # we've already removed one
-                    break
+        found_objects = self._find(collection_name, filter_options)
+
+        for found_object in found_objects:
+            self._delete_object(collection_name, found_object)
+
+            if not multi:
+                # we've already removed one
+                break
 
-        collection.append(new_object)
+        self._insert_object(collection_name, new_object)
 
         return True
 
@@ -213,89 +649,568 @@ class InMemoryStorage(Storage):
         if filter_options is None or not isinstance(filter_options, dict) or len(filter_options.keys()) < 1:
             raise ArgumentTypeError('filter_options must be a non-empty dict!')
 
-        collection = self.store.get(collection_name, [])
+        found_objects = self._find(collection_name, filter_options)
 
-        if len(collection) < 1:
+        if len(found_objects) < 1:
             return False
 
-        found_objects = self._find_conforming_objects(collection, filter_options)
+        for found_object in found_objects:
+            self._delete_object(collection_name, found_object)
 
-        if len(found_objects) > 0:
-            for found_object in found_objects:
-                collection.remove(found_object)
-
-                if not multi:
-                    # we've already removed one
-                    break
-        else:
-            return False
+            if not multi:
+                # we've already removed one
+                break
 
         return True
 
 
 class DiskStorage(InMemoryStorage):
+    """
+        InMemoryStorage persisted to a file, JSON by default(see
+        `serialization` and `Serializer` for the other formats).
+
+        By default the whole store is rewritten on every change. With
+        `journal` set, every change is appended as one record to a log file
+        (`journal_file_path`, `<file_path>.log` by default) instead, and the
+        log is replayed over the last snapshot at startup. Once the log grows
+        past `compaction_threshold` bytes it is folded into a new snapshot in
+        a background thread. A failed compaction is logged and tried again
+        after `COMPACTION_RETRY_INTERVAL` seconds, with the records that came
+        meanwhile appended to those it left.
+
+        Snapshots are written to a temporary file and renamed over the old
+        one, so a crash mid-write leaves the previous snapshot intact. A
+        snapshot that can't be decoded at startup is moved to
+        `<file_path>.corrupt`; one written with a codec the `serialization`
+        settings don't accept(e.g. pickle without `allow_pickle`) raises
+        UnsupportedCodecException.
+
+        With `write_behind` set, changes are only marked as pending and a
+        background thread writes them out every `flush_interval_ms`
+        milliseconds or every `flush_every` changes, whichever comes first.
+        All pending journal records go out in a single write and fsync.
+        `flush()` writes pending changes out right away; `close()` flushes
+        and stops the background thread. Changes that failed to be written
+        out stay pending for the next attempt.
+    """
+    DEFAULT_COMPACTION_THRESHOLD = 16 * 1024 * 1024
+    DEFAULT_FLUSH_INTERVAL_MS = 1000
+    DEFAULT_FLUSH_EVERY = 1000
+    COMPACTION_RETRY_INTERVAL = 60
+
     def __init__(self, config):
         super().__init__(config)
 
         self.storage_file_path = config['file_path']
+        self._serializer = Serializer(config.get('serialization'))
+
+        self._journal = config.get('journal', False)
+        self._journal_file_path = config.get('journal_file_path', self.storage_file_path + '.log')
+        self._compaction_threshold = config.get('compaction_threshold', DiskStorage.DEFAULT_COMPACTION_THRESHOLD)
+
+        self._write_behind = config.get('write_behind', False)
+        self._flush_interval = config.get('flush_interval_ms', DiskStorage.DEFAULT_FLUSH_INTERVAL_MS) / 1000
+        self._flush_every = config.get('flush_every', DiskStorage.DEFAULT_FLUSH_EVERY)
+
+        # guards the store and the pending changes
+        self._lock = threading.RLock()
+        # serializes writing pending changes out
+        self._flush_lock = threading.Lock()
+
+        self._journal_file = None
+        self._compaction_thread = None
+        # monotonic time before which no compaction is started, set when one fails
+        self._compaction_retry_at = 0
+
+        # serialized journal records waiting to be written out
+        self._pending_records = []
+        self._pending_count = 0
+
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+        self._flusher_thread = None
+
+        self.store = self._load_snapshot()
+        self._rebuild_indexes()
+
+        if self._journal:
+            self._open_journal()
+
+        if self._write_behind:
+            self._flusher_thread = threading.Thread(target=self._flusher, daemon=True)
+            self._flusher_thread.start()
+
+            atexit.register(self.close)
+
+    def _compacting_journal_file_path(self):
+        return self._journal_file_path + '.compacting'
+
+    def _load_snapshot(self):
+        """
+        Read the snapshot at startup. One that can't be decoded is moved aside to `<file_path>.corrupt`,
+        so that it is not overwritten, and the storage starts without it.
+
+        :raise UnsupportedCodecException: if the snapshot is written in a format the serializer doesn't accept
+        """
+        try:
+            return self._read_snapshot(self.storage_file_path, self._serializer)
+        except UnsupportedCodecException as e:
+            # nothing is wrong with the data, but the settings
+            raise UnsupportedCodecException('{0}: {1}'.format(self.storage_file_path, e)) from e
+        except Exception:
+            corrupt_file_path = self.storage_file_path + '.corrupt'
+
+            logger.exception('Failed to read snapshot %s, moved to %s', self.storage_file_path, corrupt_file_path)
+            os.replace(self.storage_file_path, corrupt_file_path)
+
+            return {}
+
+    @staticmethod
+    def _read_snapshot(file_path, serializer):
+        """
+        :return: the store saved to the file, empty if there is no file or it is empty
+        :raise Exception: if the file can't be decoded
+        """
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+
+        if len(data) < 1:
+            return {}
+
+        return serializer.loads(data)
+
+    @staticmethod
+    def _write_snapshot(file_path, serialized_store):
+        tmp_file_path = file_path + '.tmp'
+
+        with open(tmp_file_path, 'wb') as f:
+            f.write(serialized_store)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_file_path, file_path)
+
+    @staticmethod
+    def _replay_journal(storage, journal_file_path):
+        """
+        Apply journal records to a storage.
+
+        :param storage: InMemoryStorage to apply the records to
+        :param journal_file_path: journal to read the records from
+        :return: number of records applied
+        """
+        applied = 0
+
+        try:
+            f = open(journal_file_path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return applied
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a record torn by a crash can only be the last one
+                    break
+
+                DiskStorage._apply_record(storage, record)
+                applied += 1
+
+        return applied
+
+    @staticmethod
+    def _apply_record(storage, record):
+        op = record['op']
+        collection_name = record['collection']
+
+        if op == 'set_field':
+            InMemoryStorage.set_field(storage, collection_name, record['key'], record['value'],
+                                      record['multi'], **record['filter'])
+        elif op == 'set_fields':
+            InMemoryStorage.set_fields(storage, collection_name, record['values'], record['multi'],
+                                       **record['filter'])
+        elif op == 'set_object':
+            InMemoryStorage.set_object(storage, collection_name, record['object'], record['filter'], record['multi'])
+        elif op == 'remove_object':
+            InMemoryStorage.remove_object(storage, collection_name, record['filter'], record['multi'])
+
+    def _open_journal(self):
+        compacting_journal_file_path = self._compacting_journal_file_path()
+        interrupted_compaction = os.path.exists(compacting_journal_file_path)
+
+        # leftovers of a compaction interrupted by a crash go first
+        self._replay_journal(self, compacting_journal_file_path)
+        self._replay_journal(self, self._journal_file_path)
+
+        if interrupted_compaction:
+            self._write_snapshot(self.storage_file_path, self._serializer.dumps(self._dump_store()))
+            os.remove(compacting_journal_file_path)
+            open(self._journal_file_path, 'w').close()
+
+        self._journal_file = open(self._journal_file_path, 'a', encoding='utf-8')
+
+    def _enqueue(self, record):
+        """
+        Queue a change that has just been applied to the store to be written out.
+
+        Must be called under the store lock, right after the change, so that
+        records are queued in the order the changes were made.
+
+        :param record: journal record describing the change
+        """
+        if self._journal:
+            # serialize right away: the objects referenced by the record may change later
+            self._pending_records.append(json.dumps(record) + '\n')
+
+        self._pending_count += 1
+
+        if self._write_behind and self._pending_count >= self._flush_every:
+            self._flush_requested.set()
+
+    def _persist(self):
+        if not self._write_behind:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._pending_count < 1:
+                    return
+
+                pending_records = self._pending_records
+                pending_count = self._pending_count
+                serialized_store = None if self._journal else self._serializer.dumps(self._dump_store())
+
+                self._pending_records = []
+                self._pending_count = 0
+
+            try:
+                if not self._journal:
+                    self._write_snapshot(self.storage_file_path, serialized_store)
+                    return
+
+                self._write_journal(''.join(pending_records))
+            except BaseException:
+                with self._lock:
+                    # in front of the changes made meanwhile
+                    self._pending_records = pending_records + self._pending_records
+                    self._pending_count += pending_count
+
+                raise
+
+            if self._journal_file.tell() >= self._compaction_threshold:
+                self._start_compaction()
+
+    def _write_journal(self, data):
+        journal_size = os.fstat(self._journal_file.fileno()).st_size
+
+        try:
+            self._journal_file.write(data)
+            self._journal_file.flush()
+            os.fsync(self._journal_file.fileno())
+        except BaseException:
+            # cut off whatever part made it to the file, so that the retry doesn't leave a torn record
+            # in the middle of the journal
+            try:
+                self._journal_file.close()
+            except OSError:
+                pass
+
+            try:
+                os.truncate(self._journal_file_path, journal_size)
+            except OSError as e:
+                logger.error('Failed to truncate journal %s: %s', self._journal_file_path, e)
+
+            self._journal_file = open(self._journal_file_path, 'a', encoding='utf-8')
+
+            raise
+
+    def _flusher(self):
+        while not self._closed.is_set():
+            self._flush_requested.wait(self._flush_interval)
+            self._flush_requested.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                # the changes stay pending, the next round retries them
+                logger.exception('Failed to write out the pending changes')
+
+    def _start_compaction(self):
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+
+        if time.monotonic() < self._compaction_retry_at:
+            return
+
+        compacting_journal_file_path = self._compacting_journal_file_path()
+
+        # new records go to a fresh journal while the rotated one is folded
+        self._journal_file.close()
+
+        if os.path.exists(compacting_journal_file_path):
+            # left by a failed compaction: the newer records go after its ones. Should the process crash before
+            # the journal is removed, its records are replayed twice in a row at startup, which changes nothing
+            with open(self._journal_file_path, 'rb') as journal, open(compacting_journal_file_path, 'ab') as f:
+                shutil.copyfileobj(journal, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.remove(self._journal_file_path)
+        else:
+            os.replace(self._journal_file_path, compacting_journal_file_path)
+
+        self._journal_file = open(self._journal_file_path, 'a', encoding='utf-8')
+
+        self._compaction_thread = threading.Thread(target=self._compact, daemon=True)
+        self._compaction_thread.start()
 
+    def _compact(self):
         try:
-            self.store = json.load(open(self.storage_file_path, 'r'))
-        except (json.JSONDecodeError, FileNotFoundError) as e:
-            self.store = {}
+            self._fold_journal()
+        except Exception:
+            # the rotated journal stays, the next compaction folds it along with the newer records
+            logger.exception('Failed to compact journal %s, retrying in %d s', self._journal_file_path,
+                             DiskStorage.COMPACTION_RETRY_INTERVAL)
+
+            self._compaction_retry_at = time.monotonic() + DiskStorage.COMPACTION_RETRY_INTERVAL
+
+    def _fold_journal(self):
+        # rebuild the state from files so that the live store is never locked for long
+        compacted = InMemoryStorage(self.config)
+        compacted.store = self._read_snapshot(self.storage_file_path, self._serializer)
+        compacted._rebuild_indexes()
+
+        compacting_journal_file_path = self._compacting_journal_file_path()
+
+        self._replay_journal(compacted, compacting_journal_file_path)
+        self._write_snapshot(self.storage_file_path, self._serializer.dumps(compacted._dump_store()))
+
+        os.remove(compacting_journal_file_path)
 
     def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
-        result = super().set_field(collection_name, key, new_value, multi, **filter_options)
+        with self._lock:
+            result = super().set_field(collection_name, key, new_value, multi, **filter_options)
+
+            self._enqueue({'op': 'set_field', 'collection': collection_name, 'key': key, 'value': new_value,
+                           'multi': multi, 'filter': filter_options})
 
-        json.dump(self.store, open(self.storage_file_path, 'w'))
+        self._persist()
 
         return result
 
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        with self._lock:
+            result = super().set_fields(collection_name, new_values, multi, **filter_options)
+
+            self._enqueue({'op': 'set_fields', 'collection': collection_name, 'values': new_values,
+                           'multi': multi, 'filter': filter_options})
+
+        self._persist()
+
+        return result
+
+    def bulk_set(self, collection_name, updates):
+        with self._lock:
+            for filter_options, new_values in updates:
+                super().set_fields(collection_name, new_values, **filter_options)
+
+                self._enqueue({'op': 'set_fields', 'collection': collection_name, 'values': new_values,
+                               'multi': False, 'filter': filter_options})
+
+        # all the updates go out in one write
+        self._persist()
+
+        return True
+
     def get_field(self, collection_name, key, **filter_options):
         result = super().get_field(collection_name, key, **filter_options)
         return result
 
     def set_object(self, collection_name, new_object, filter_options, multi=False):
-        result = super().set_object(collection_name, new_object, filter_options, multi)
+        with self._lock:
+            result = super().set_object(collection_name, new_object, filter_options, multi)
+
+            self._enqueue({'op': 'set_object', 'collection': collection_name, 'object': new_object,
+                           'multi': multi, 'filter': filter_options})
 
-        json.dump(self.store, open(self.storage_file_path, 'w'))
+        self._persist()
 
         return result
 
-    def get_object(self, collection_name, filter_options, multi=False):
-        result = super().get_object(collection_name, filter_options, multi)
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
+        result = super().get_object(collection_name, filter_options, multi, projection)
         return result
 
     def remove_object(self, collection_name, filter_options, multi=False):
-        result = super().remove_object(collection_name, filter_options, multi)
+        with self._lock:
+            result = super().remove_object(collection_name, filter_options, multi)
 
-        json.dump(self.store, open(self.storage_file_path, 'w'))
+            if result:
+                self._enqueue({'op': 'remove_object', 'collection': collection_name,
+                               'multi': multi, 'filter': filter_options})
+
+        self._persist()
 
         return result
 
+    def close(self):
+        if self._closed.is_set():
+            return
+
+        self._closed.set()
+
+        if self._flusher_thread is not None:
+            self._flush_requested.set()
+            self._flusher_thread.join()
+
+        self.flush()
+
+        with self._flush_lock:
+            if self._compaction_thread is not None:
+                self._compaction_thread.join()
+
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
 
 class MongoStorage(Storage):
+    """
+        Indexes declared in the storage config are created at startup:
+
+            'params': {
+                'indexes': {
+                    'sessions': [{'key': 'chat_id', 'unique': True}],
+                    'broadcasts': ['job_id']
+                }
+            }
+
+        A unique index on `chat_id` of `sessions` is created when nothing
+        is declared.
+    """
+    DEFAULT_INDEXES = {
+        'sessions': [{'key': 'chat_id', 'unique': True}]
+    }
+
     def __init__(self, config):
         super().__init__(config)
 
+        # imported here, so that the other storages don't load pymongo
+        import pymongo
+
         mongo_client = pymongo.MongoClient(config['host'], config['port'])
 
         self.db = mongo_client[config['database']]
 
+        self._create_indexes(config.get('indexes', MongoStorage.DEFAULT_INDEXES))
+
+    def _create_indexes(self, indexes):
+        import pymongo
+
+        for collection_name, fields in indexes.items():
+            for field in fields:
+                if isinstance(field, str):
+                    field = {'key': field}
+
+                try:
+                    self.db[collection_name].create_index(field['key'], unique=field.get('unique', False))
+                except pymongo.errors.OperationFailure as e:
+                    # e.g. duplicates left from the times without the unique index
+                    logger.error('Failed to create index on %s.%s: %s', collection_name, field['key'], e)
+
     def set_field(self, collection_name, key, new_value, multi=False, **filter_options):
-        return self.db[collection_name].update(filter_options, {'$set': {key: new_value}}, upsert=True, multi=multi)
+        return self.set_fields(collection_name, {key: new_value}, multi, **filter_options)
+
+    def set_fields(self, collection_name, new_values, multi=False, **filter_options):
+        if multi:
+            return self.db[collection_name].update_many(filter_options, {'$set': new_values}, upsert=True)
+        else:
+            return self.db[collection_name].update_one(filter_options, {'$set': new_values}, upsert=True)
+
+    def bulk_set(self, collection_name, updates):
+        import pymongo
+
+        operations = [pymongo.UpdateOne(filter_options, {'$set': new_values}, upsert=True)
+                      for filter_options, new_values in updates]
+
+        if len(operations) < 1:
+            return True
+
+        # the updates are independent, so the server may apply them in any order
+        return self.db[collection_name].bulk_write(operations, ordered=False)
 
     def get_field(self, collection_name, key, **filter_options):
-        return self.db[collection_name].distinct(key, filter_options)
+        found_values = []
+
+        # only the field is fetched, of every conforming object as the other storages do
+        for found_object in self.db[collection_name].find(filter_options, {key: 1, '_id': 0}):
+            found_value = self._field_value(found_object, key)
+
+            if found_value is not None:
+                found_values.append(found_value)
+
+        return found_values
+
+    @staticmethod
+    def _field_value(found_object, key):
+        # dotted keys address nested fields
+        for path_key in key.split('.'):
+            if not isinstance(found_object, dict) or path_key not in found_object:
+                return None
+
+            found_object = found_object[path_key]
 
-    def get_object(self, collection_name, filter_options, multi=False):
+        return found_object
+
+    def get_object(self, collection_name, filter_options, multi=False, projection=None):
         if multi:
-            return self.db[collection_name].find(filter_options)
+            return list(self.db[collection_name].find(filter_options, projection))
         else:
-            return self.db[collection_name].find_one(filter_options)
+            return self.db[collection_name].find_one(filter_options, projection)
+
+    def iter_objects(self, collection_name, filter_options, batch_size=None, projection=None):
+        import pymongo
+
+        cursor = self.db[collection_name].find(filter_options, projection).sort('_id', pymongo.ASCENDING)
+
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+
+        return cursor
+
+    @staticmethod
+    def _sorted_field_query(key, after, filter_options):
+        if after is None:
+            return filter_options
+
+        return {'$and': [filter_options, {key: {'$gt': after}}]}
+
+    def iter_field_sorted(self, collection_name, key, after=None, batch_size=None, **filter_options):
+        import pymongo
+
+        # sorted by the index of the field, if there is one
+        cursor = self.db[collection_name].find(self._sorted_field_query(key, after, filter_options),
+                                               {key: 1, '_id': 0}).sort(key, pymongo.ASCENDING)
+        cursor = cursor.batch_size(batch_size or Storage.SORTED_BATCH_SIZE)
+
+        for obj in cursor:
+            value = obj.get(key)
+
+            if value is not None and (after is None or value > after):
+                after = value
+                yield value
 
     def set_object(self, collection_name, new_object, filter_options, multi=False):
-        return self.db[collection_name].update(filter_options, new_object, upsert=True, multi=multi)
+        if multi:
+            # the same as InMemoryStorage: the conforming objects are replaced by a single one
+            self.db[collection_name].delete_many(filter_options)
+
+        return self.db[collection_name].replace_one(filter_options, new_object, upsert=True)
 
     def remove_object(self, collection_name, filter_options, multi=False):
         if multi:
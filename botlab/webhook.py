@@ -0,0 +1,239 @@
+import hmac
+import http.server
+import json
+import logging
+import queue
+import threading
+
+import telebot
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer(object):
+    """
+        Receives updates from Telegram through a webhook.
+
+        A POST to `path` is answered as soon as its body is read; the body is
+        queued and a dispatching thread decodes whatever has piled up in one
+        batch and passes the batch, in update order, to `process_updates`.
+        With a threaded BotLab that only puts the updates on the worker pool,
+        so requests are never held by handlers. When the queue is full the
+        requests wait, which makes Telegram slow down.
+
+        Requests to any other path are answered with 404, and so are the ones
+        without the `secret_token`(X-Telegram-Bot-Api-Secret-Token header),
+        if it is configured; bodies longer than `max_body_size` bytes(1 MiB
+        by default) are answered with 413. The body of a rejected request is
+        not read and its connection is closed. GET `health_path` returns the server counters,
+        GET `metrics_path` the `metrics` in Prometheus text format.
+
+        :param process_updates: function taking a list of updates
+        :param config: dict with `host`, `port`, `path`, `secret_token`,
+            `health_path`, `metrics_path`, `queue_size`, `batch_size` and
+            `max_body_size`
+        :param decode: function turning an update dict into what
+            `process_updates` takes, None to pass the dicts as they are
+        :param metrics: Metrics to export or None
+    """
+    DEFAULT_HOST = '0.0.0.0'
+    DEFAULT_PORT = 8443
+    DEFAULT_PATH = '/'
+    DEFAULT_HEALTH_PATH = '/health'
+    DEFAULT_METRICS_PATH = '/metrics'
+    DEFAULT_QUEUE_SIZE = 10000
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_MAX_BODY_SIZE = 1024 * 1024
+
+    SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+    def __init__(self, process_updates, config=None, decode=telebot.types.Update.de_json, metrics=None):
+        config = config or {}
+
+        self._process_updates = process_updates
+        self._decode = decode
+        self._path = config.get('path', WebhookServer.DEFAULT_PATH)
+        self._secret_token = config.get('secret_token')
+        self._health_path = config.get('health_path', WebhookServer.DEFAULT_HEALTH_PATH)
+        self._metrics_path = config.get('metrics_path', WebhookServer.DEFAULT_METRICS_PATH)
+        self._metrics = metrics
+        self._batch_size = config.get('batch_size', WebhookServer.DEFAULT_BATCH_SIZE)
+        self._max_body_size = config.get('max_body_size', WebhookServer.DEFAULT_MAX_BODY_SIZE)
+
+        self._bodies = queue.Queue(maxsize=config.get('queue_size', WebhookServer.DEFAULT_QUEUE_SIZE))
+        self._lock = threading.Lock()
+        self._received = 0
+        self._processed = 0
+        self._rejected = 0
+        self._failed = 0
+
+        self._httpd = http.server.ThreadingHTTPServer(
+            (config.get('host', WebhookServer.DEFAULT_HOST), config.get('port', WebhookServer.DEFAULT_PORT)),
+            self._make_request_handler())
+        self._httpd.daemon_threads = True
+
+        self._dispatcher = None
+        self._server_thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            # keep-alive, Telegram reuses its connections
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                # checked before the body is read, so that nobody can make the server take in a lot of data
+                if not server._accepts(self.path, self.headers.get(WebhookServer.SECRET_TOKEN_HEADER)):
+                    return self._reject(404)
+
+                try:
+                    content_length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    return self._reject(400)
+
+                if content_length < 0:
+                    return self._reject(400)
+
+                if content_length > server._max_body_size:
+                    return self._reject(413)
+
+                body = self.rfile.read(content_length)
+
+                server._bodies.put(body)
+                server._count('_received')
+
+                self._respond(200)
+
+            def do_GET(self):
+                if self.path == server._metrics_path and server._metrics is not None:
+                    return self._respond(200, server._metrics.render().encode('utf-8'),
+                                         'text/plain; version=0.0.4; charset=utf-8')
+
+                if self.path != server._health_path:
+                    return self._respond(404)
+
+                self._respond(200, json.dumps(server.health()).encode('utf-8'), 'application/json')
+
+            def _reject(self, status):
+                server._count('_rejected')
+
+                # the body is left unread, so the connection can't be used for another request
+                self.close_connection = True
+                self._respond(status)
+
+            def _respond(self, status, body=b'', content_type='text/plain'):
+                self.send_response(status)
+
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return RequestHandler
+
+    def _accepts(self, path, secret_token):
+        if path != self._path:
+            return False
+
+        if self._secret_token is None:
+            return True
+
+        return secret_token is not None and hmac.compare_digest(secret_token, self._secret_token)
+
+    def _count(self, counter, increment=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + increment)
+
+    def _dispatch(self):
+        while True:
+            bodies = [self._bodies.get()]
+
+            while bodies[-1] is not None and len(bodies) < self._batch_size:
+                try:
+                    bodies.append(self._bodies.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = bodies[-1] is None
+
+            if stop:
+                bodies.pop()
+
+            if len(bodies) > 0:
+                self._process_bodies(bodies)
+
+            if stop:
+                return
+
+    def _process_bodies(self, bodies):
+        updates = []
+
+        for body in bodies:
+            try:
+                updates.append(json.loads(body.decode('utf-8')))
+            except ValueError:
+                logger.error('Malformed update: %r', body[:100])
+                self._count('_failed')
+
+        # concurrent requests may come in any order
+        updates.sort(key=lambda update: update.get('update_id', 0))
+
+        if self._decode is not None:
+            updates = [self._decode(update) for update in updates]
+
+        try:
+            self._process_updates(updates)
+            self._count('_processed', len(updates))
+        except Exception:
+            logger.exception('Failed to process updates')
+            self._count('_failed', len(updates))
+
+    def health(self):
+        """
+        :return: dict with the status and the counters of the server
+        """
+        with self._lock:
+            return {
+                'status': 'ok',
+                'received': self._received,
+                'processed': self._processed,
+                'rejected': self._rejected,
+                'failed': self._failed,
+                'queued': self._bodies.qsize()
+            }
+
+    def start(self):
+        """
+        Serve in background threads.
+        """
+        self._dispatcher = threading.Thread(target=self._dispatch, name='WebhookDispatcher', daemon=True)
+        self._dispatcher.start()
+
+        self._server_thread = threading.Thread(target=self._httpd.serve_forever, name='WebhookServer', daemon=True)
+        self._server_thread.start()
+
+    def serve_forever(self):
+        self.start()
+        self._server_thread.join()
+
+    def stop(self):
+        """
+        Stop accepting requests and wait for the updates received to be passed on.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+        if self._dispatcher is not None:
+            self._bodies.put(None)
+            self._dispatcher.join()
@@ -1,8 +1,8 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='botlab',
-    packages=['botlab'],
+    packages=['botlab', 'botlab.aio'],
     version='0.2.4',
     description='Tool to ease the development of telegram bots',
     author='Max(TrickOrTreat)',
@@ -11,6 +11,13 @@ setup(
     download_url='https://github.com/aivel/botlab/tarball/0.2.4',
     keywords=['telegram', 'bot', 'api'],
     classifiers=[],
-    install_requires=['pyTelegramBotApi', 'pymongo', 'redis'],
+    install_requires=['pyTelegramBotApi'],
+    extras_require={
+        'mongo': ['pymongo'],
+        'redis': ['redis'],
+        'aio-mongo': ['motor'],
+        'aio-redis': ['redis'],
+        'outbox': ['requests'],
+    },
     license='MIT'
 )
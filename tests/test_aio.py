@@ -0,0 +1,188 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from botlab.aio import AsyncBotLab, AsyncSession
+
+from test_botlab import make_message_update
+
+
+class FakeApi(object):
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        # lets the other updates run meanwhile
+        await asyncio.sleep(0)
+        self.sent.append((chat_id, text))
+
+    async def close(self):
+        pass
+
+
+class TestAsyncBotLab(unittest.TestCase):
+    def setUp(self):
+        self.settings = {
+            'config': {
+                'sync_strategy': 'cold'
+            },
+            'bot': {
+                'token': '123:TEST',
+                'initial_state': 'main_menu',
+                'initial_inline_state': None,
+                'suppress_exceptions': False
+            },
+            'db_storage': {
+                'type': 'inmemory',
+                'params': {}
+            },
+            'l10n': {
+                'default_lang': 'en',
+                'file_path': 'assets/l10n.json'
+            }
+        }
+        self.bot = AsyncBotLab(self.settings)
+
+        @self.bot.message_handler(state='settings')
+        async def settings_state(session, message):
+            await session.reply_message('settings')
+
+        @self.bot.message_handler(state='main_menu')
+        async def main_menu_state(session, message):
+            session.set_state('settings')
+            await session.reply_message(session._('hello', name=message.from_user.first_name))
+
+    def run_bot(self, coroutine):
+        async def run():
+            await self.bot.setup()
+            self.bot.api = FakeApi()
+
+            result = await coroutine()
+
+            await self.bot.close()
+
+            return result
+
+        return asyncio.run(run())
+
+    def test_handlers_are_dispatched_by_state(self):
+        async def process():
+            await self.bot.process_new_updates([make_message_update(1, 42, 'hi')])
+            await self.bot.process_new_updates([make_message_update(2, 42, 'hi again')])
+
+            return self.bot.api.sent
+
+        self.assertEqual(self.run_bot(process), [(42, 'hello, Max!'), (42, 'settings')])
+
+    def test_updates_of_different_chats_are_processed_concurrently(self):
+        async def process():
+            await self.bot.process_new_updates([make_message_update(i, i, 'hi') for i in range(1, 101)])
+
+            return await self.bot._storage.get_object('sessions', {'state': 'settings'}, multi=True)
+
+        self.assertEqual(len(self.run_bot(process)), 100)
+
+    def test_updates_of_one_chat_are_processed_in_order(self):
+        async def process():
+            await self.bot.process_new_updates([make_message_update(1, 42, 'hi'), make_message_update(2, 42, 'hi'),
+                                                make_message_update(3, 43, 'hi')])
+
+            return self.bot.api.sent
+
+        sent = self.run_bot(process)
+
+        self.assertEqual([text for chat_id, text in sent if chat_id == 42], ['hello, Max!', 'settings'])
+        self.assertEqual(self.bot._chat_locks, {})
+
+    def test_polling_backs_off_on_errors(self):
+        delays = []
+
+        async def get_updates(offset=None, timeout=None):
+            if len(delays) >= 4:
+                self.bot.stop_polling()
+                return []
+
+            raise ConnectionError('network is down')
+
+        async def sleep(delay):
+            delays.append(delay)
+
+        async def poll():
+            self.bot._suppress_exceptions = True
+            self.bot.api.get_updates = get_updates
+
+            with mock.patch('asyncio.sleep', sleep):
+                await self.bot.polling()
+
+        self.run_bot(poll)
+
+        self.assertEqual(delays, [0.25, 0.5, 1, 2])
+
+    def test_session_is_read_asynchronously(self):
+        async def process():
+            await self.bot.process_new_updates([make_message_update(1, 42, 'hi')])
+
+            session = await self.bot._get_session(42)
+            session.set_state('main_menu')
+            await session.save()
+
+            return (await session.load()).get_state()
+
+        self.assertEqual(self.run_bot(process), 'main_menu')
+
+        session = AsyncSession(self.bot, 42, self.bot.l10n, self.bot._storage, self.bot._config_manager,
+                               autosave=False, document={'chat_id': 42, 'lang': 'en'}, fields=['lang'])
+        session._loaded_fields = {'chat_id', 'lang'}
+
+        self.assertRaises(RuntimeError, session.get_state)
+
+    def test_broadcast(self):
+        async def process():
+            await self.bot.process_new_updates([make_message_update(i, i, 'hi') for i in range(1, 11)])
+
+            job = await self.bot.broadcast_message({'lang': 'en'}, 'news')
+            await job.wait(5)
+
+            return job
+
+        job = self.run_bot(process)
+
+        self.assertEqual((job.sent, job.failed, job.pending), (10, 0, 0))
+
+    def test_cancelled_broadcast_is_not_resumed(self):
+        async def process():
+            await self.bot.process_new_updates([make_message_update(i, i, 'hi') for i in range(1, 11)])
+
+            job = await self.bot.broadcast_message({'lang': 'en'}, 'news')
+            job.cancel()
+            await job.wait(5)
+
+            return job, await self.bot.resume_broadcasts()
+
+        job, resumed = self.run_bot(process)
+
+        self.assertEqual((job.sent, job.pending), (0, 0))
+        self.assertEqual(resumed, [])
+
+    def test_missing_config_section_gives_default(self):
+        async def process():
+            return self.bot._config_manager.get('webhook', {}), self.bot._config_manager.get('webhook')
+
+        self.assertEqual(self.run_bot(process), ({}, None))
+
+    def test_close_stops_config_refresh(self):
+        async def process():
+            config_manager = self.bot._config_manager
+            refresh_task = config_manager._refresh_task
+
+            await self.bot.close()
+
+            others = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+            return refresh_task, config_manager._refresh_task, others
+
+        refresh_task, closed_refresh_task, others = self.run_bot(process)
+
+        self.assertTrue(refresh_task.cancelled())
+        self.assertIsNone(closed_refresh_task)
+        self.assertEqual(others, [])
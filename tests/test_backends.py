@@ -0,0 +1,125 @@
+import importlib.metadata
+import json
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+from botlab import BotLab, ConfigurationManager, backends
+from botlab.exceptions import UnknownStorageException, UnsupportedKVStorageException
+from botlab.storage import InMemoryStorage
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# client libraries and modules of the backends nobody selected
+LAZY_MODULES = ['pymongo', 'redis', 'motor', 'botlab.paged_storage', 'botlab.sqlite_storage', 'botlab.webhook']
+# modules of the features only loaded by the bots constructing them
+FEATURE_MODULES = ['botlab.broadcast', 'botlab.caching', 'botlab.metrics', 'botlab.outbox', 'botlab.scheduling']
+IMPORT_TIME_BUDGET = 1.0
+
+
+def run_python(code):
+    """
+    :return: what the code printed as JSON, run in a fresh interpreter
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=TESTS_DIR, env=env)
+
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def loaded_modules_code(setup_code):
+    return ('import json, sys\n' + setup_code + '\n'
+            'print(json.dumps(sorted(name for name in sys.modules\n'
+            '                        if name.split(".")[0] in {0} or name in {0})))'.format(repr(LAZY_MODULES)))
+
+
+def make_settings(storage_type, storage_params):
+    return {
+        'config': {
+            'sync_strategy': 'cold'
+        },
+        'bot': {
+            'token': '123:TEST'
+        },
+        'db_storage': {
+            'type': storage_type,
+            'params': storage_params
+        },
+        'l10n': {
+            'default_lang': 'en',
+            'file_path': 'assets/l10n.json'
+        }
+    }
+
+
+class CustomStorage(InMemoryStorage):
+    pass
+
+
+class TestBackends(unittest.TestCase):
+    def test_import_loads_no_backend(self):
+        self.assertEqual(run_python(loaded_modules_code('import botlab')), [])
+
+    def test_import_loads_no_feature(self):
+        code = ('import json, sys\n'
+                'import botlab\n'
+                'print(json.dumps(sorted(name for name in sys.modules if name in {0})))'.format(repr(FEATURE_MODULES)))
+
+        self.assertEqual(run_python(code), [])
+
+    def test_only_selected_backend_is_loaded(self):
+        inmemory_code = 'import botlab\nbotlab.BotLab({0}, threaded=False)'.format(
+            repr(make_settings('inmemory', {})))
+        sqlite_code = 'import botlab\nbotlab.BotLab({0}, threaded=False)'.format(
+            repr(make_settings('sqlite', {'file_path': ':memory:'})))
+
+        self.assertEqual(run_python(loaded_modules_code(inmemory_code)), [])
+        self.assertEqual(run_python(loaded_modules_code(sqlite_code)), ['botlab.sqlite_storage'])
+
+    def test_import_time(self):
+        elapsed = run_python('import json, time\n'
+                             'started_at = time.perf_counter()\n'
+                             'import botlab\n'
+                             'print(json.dumps(time.perf_counter() - started_at))')
+
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
+
+    def test_register(self):
+        backends.storages.register('custom', CustomStorage)
+        self.addCleanup(backends.storages._backends.pop, 'custom')
+
+        bot = BotLab(make_settings('custom', {}), threaded=False)
+
+        self.assertIsInstance(bot._storage, CustomStorage)
+        self.assertIn('custom', backends.storages.names())
+
+    def test_register_by_path(self):
+        backends.kv_storages.register('custom', 'botlab.kv_storage:InMemoryKVStorage')
+        self.addCleanup(backends.kv_storages._backends.pop, 'custom')
+
+        settings = make_settings('inmemory', {})
+        settings['config']['sync_strategy'] = 'hot'
+        settings['kv_storage'] = {'type': 'custom', 'params': {}}
+
+        self.assertEqual(ConfigurationManager(settings).get('bot')['token'], '123:TEST')
+
+    def test_entry_points(self):
+        entry_point = importlib.metadata.EntryPoint(name='plugin', value='test_backends:CustomStorage',
+                                                    group='botlab.storages')
+        self.addCleanup(backends.storages._backends.pop, 'plugin', None)
+
+        with mock.patch('importlib.metadata.entry_points',
+                        return_value=importlib.metadata.EntryPoints([entry_point])):
+            self.assertIs(backends.storages.get('plugin'), CustomStorage)
+
+        # loaded once
+        self.assertIs(backends.storages.get('plugin'), CustomStorage)
+
+    def test_unknown(self):
+        self.assertRaises(UnknownStorageException, BotLab, make_settings('unknown', {}), threaded=False)
+        self.assertRaises(UnsupportedKVStorageException, backends.kv_storages.get, 'unknown')
@@ -0,0 +1,19 @@
+import unittest
+
+from benchmarks.bench_updates import run_benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_benchmark(self):
+        for backend in ['inmemory', 'disk']:
+            result = run_benchmark(backend, sessions=10, updates=50)
+
+            self.assertEqual(result['backend'], backend)
+            self.assertEqual(result['updates'], 50)
+            self.assertGreater(result['updates_per_sec'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['storage_requests_per_update'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import json
+import unittest
+
+import telebot
+
+from botlab import BotLab
+
+
+def make_message_update(update_id, chat_id, text):
+    return telebot.types.Update.de_json(json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Max'}
+        }
+    }))
+
+
+class CountingStorageMixin(object):
+    def count_calls(self, storage):
+        self.calls = []
+
+        for name in ['get_field', 'set_field', 'set_fields', 'get_object', 'set_object', 'remove_object']:
+            setattr(storage, name, self._counted(name, getattr(storage, name)))
+
+    def _counted(self, name, func):
+        def counted(*args, **kwargs):
+            self.calls.append(name)
+            return func(*args, **kwargs)
+
+        return counted
+
+
+class TestBotLab(CountingStorageMixin, unittest.TestCase):
+    def setUp(self):
+        self.settings = {
+            'config': {
+                'sync_strategy': 'cold'
+            },
+            'bot': {
+                'token': '123:TEST',
+                'initial_state': 'main_menu',
+                'initial_inline_state': None,
+                'suppress_exceptions': False
+            },
+            'db_storage': {
+                'type': 'inmemory',
+                'params': {}
+            },
+            'l10n': {
+                'default_lang': 'en',
+                'file_path': 'assets/l10n.json'
+            }
+        }
+        self.bot = BotLab(self.settings, threaded=False)
+        self.handled = []
+
+        @self.bot.message_handler(state='settings')
+        def settings_state(session, message):
+            self.handled.append(('settings', message.text))
+
+        @self.bot.message_handler(state='main_menu')
+        def main_menu_state(session, message):
+            self.handled.append(('main_menu', message.text))
+            session.set_state('settings')
+            session.set_field('counter', 1)
+
+    def test_handlers_are_dispatched_by_state(self):
+        self.bot.process_new_updates([make_message_update(1, 42, 'hi')])
+        self.bot.process_new_updates([make_message_update(2, 42, 'hi again')])
+
+        self.assertEqual(self.handled, [('main_menu', 'hi'), ('settings', 'hi again')])
+
+    def test_one_update_reads_session_once(self):
+        self.bot.process_new_updates([make_message_update(1, 42, 'hi')])
+
+        self.count_calls(self.bot._storage)
+        self.bot.process_new_updates([make_message_update(2, 42, 'hi again')])
+
+        self.assertEqual(self.calls, ['get_object'])
+
+    def test_changes_are_written_back_in_one_update(self):
+        self.count_calls(self.bot._storage)
+        self.bot.process_new_updates([make_message_update(1, 43, 'hi')])
+
+        # one write registers the new user, one writes back the handler changes
+        self.assertEqual(self.calls, ['get_object', 'set_fields', 'set_fields'])
+
+        profile = self.bot._storage.collection('sessions').get_object({'chat_id': 43})
+
+        self.assertEqual(profile['state'], 'settings')
+        self.assertEqual(profile['counter'], 1)
+        self.assertEqual(profile['lang'], 'en')
+
+    def test_state_handlers_are_not_tested_one_by_one(self):
+        for i in range(50):
+            self.bot.message_handler(state='state_%d' % i)(lambda session, message: None)
+
+        @self.bot.message_handler(func=lambda message: message.text == 'generic')
+        def generic(session, message):
+            self.handled.append(('generic', message.text))
+
+        tested = []
+        test_message_handler = self.bot._test_message_handler
+
+        def counted_test_message_handler(message_handler, message):
+            tested.append(message_handler)
+            return test_message_handler(message_handler, message)
+
+        self.bot._test_message_handler = counted_test_message_handler
+
+        self.bot.process_new_updates([make_message_update(1, 42, 'hi')])
+        self.bot.process_new_updates([make_message_update(2, 42, 'hi')])
+
+        self.bot._storage.collection('sessions').set_field('state', 'unknown', chat_id=42)
+        self.bot.process_new_updates([make_message_update(3, 42, 'generic')])
+
+        self.assertEqual(self.handled, [('main_menu', 'hi'), ('settings', 'hi'), ('generic', 'generic')])
+        self.assertEqual(len(tested), 3)
+
+    def test_session_fields_are_projected(self):
+        self.bot._storage.collection('sessions').set_fields({'lang': 'en', 'state': 'main_menu', 'counter': 5,
+                                                            'history': ['a'] * 100}, chat_id=42)
+        self.settings['bot']['session_fields'] = ['lang', 'state', 'inline_state']
+        self.bot._config_manager.set('bot', self.settings['bot'])
+
+        session = self.bot._get_session(42, autosave=False)
+
+        self.assertNotIn('history', session._document)
+        self.assertEqual(session.get_state(), 'main_menu')
+
+        # fields left out are read on first access, the unsaved changes are kept
+        session.set_field('counter', 6)
+        self.count_calls(self.bot._storage)
+
+        self.assertEqual(session.get_field('counter'), [6])
+        self.assertEqual(len(session.get_field('history')[0]), 100)
+        self.assertEqual(self.calls, ['get_object'])
+
+        session.load()
+
+        self.assertEqual(session.get_field('counter'), [6])
+        self.assertTrue(session.save())
+        self.assertEqual(self.bot._storage.collection('sessions').get_field('counter', chat_id=42), [6])
+
+
+class TestThreadedBotLab(unittest.TestCase):
+    def setUp(self):
+        self.settings = {
+            'config': {
+                'sync_strategy': 'cold'
+            },
+            'bot': {
+                'token': '123:TEST',
+                'initial_state': 'main_menu',
+                'initial_inline_state': None,
+                'suppress_exceptions': False,
+                'workers': 4
+            },
+            'db_storage': {
+                'type': 'inmemory',
+                'params': {}
+            },
+            'l10n': {
+                'default_lang': 'en',
+                'file_path': 'assets/l10n.json'
+            }
+        }
+        self.bot = BotLab(self.settings)
+        self.handled = []
+
+        @self.bot.message_handler(state='main_menu')
+        def main_menu_state(session, message):
+            self.handled.append((session.chat_id, 'main_menu', message.text))
+            session.set_state('settings')
+
+        @self.bot.message_handler(state='settings')
+        def settings_state(session, message):
+            self.handled.append((session.chat_id, 'settings', message.text))
+            session.set_state('main_menu')
+
+    def tearDown(self):
+        self.bot.worker_pool.close()
+
+    def test_updates_of_one_chat_are_handled_in_order(self):
+        updates = [make_message_update(i * 10 + chat_id, chat_id, str(i)) for i in range(20) for chat_id in range(5)]
+
+        self.bot.process_new_updates(updates)
+        self.assertTrue(self.bot.worker_pool.join(5))
+
+        for chat_id in range(5):
+            handled = [(state, text) for handled_chat_id, state, text in self.handled if handled_chat_id == chat_id]
+
+            self.assertEqual(handled, [('main_menu' if i % 2 == 0 else 'settings', str(i)) for i in range(20)])
+
+        metrics = self.bot.worker_pool_metrics()
+
+        self.assertEqual(metrics['workers'], 4)
+        self.assertEqual(metrics['queued'], 0)
+        self.assertEqual(metrics['processed'], 100)
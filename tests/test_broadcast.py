@@ -0,0 +1,110 @@
+import threading
+import unittest
+from unittest import mock
+
+from telebot.apihelper import ApiException
+
+from botlab.broadcast import Broadcaster
+from botlab.storage import InMemoryStorage
+
+
+class FloodControlResponse(object):
+    status_code = 429
+
+    def json(self):
+        return {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0.01}}
+
+
+class TestBroadcaster(unittest.TestCase):
+    def setUp(self):
+        self.storage = InMemoryStorage(None)
+        self.sent = []
+        self.flooded = set()
+
+        for chat_id in range(1, 31):
+            self.storage.collection('sessions').set_field('lang', 'en' if chat_id <= 20 else 'ru', chat_id=chat_id)
+
+        self.broadcaster = Broadcaster(None, self.storage, 'sessions', {'rate': 1000, 'per_chat_rate': 1000})
+
+    def fake_send_message(self, bot, chat_id, text, **kwargs):
+        if chat_id == 5:
+            raise ApiException('Forbidden: bot was blocked by the user', 'sendMessage', None)
+
+        if chat_id == 7 and chat_id not in self.flooded:
+            self.flooded.add(chat_id)
+            raise ApiException('Too Many Requests', 'sendMessage', FloodControlResponse())
+
+        self.sent.append((chat_id, text))
+
+    def test_broadcast_reaches_conforming_sessions(self):
+        with mock.patch('telebot.TeleBot.send_message', self.fake_send_message):
+            job = self.broadcaster.start({'lang': 'en'}, 'hello')
+
+            self.assertTrue(job.wait(5))
+
+        self.assertEqual(sorted(chat_id for chat_id, _ in self.sent), [i for i in range(1, 21) if i != 5])
+        self.assertEqual((job.sent, job.failed, job.pending), (19, 1, 0))
+
+        saved_job = self.storage.collection('broadcasts').get_object({'job_id': job.job_id})
+
+        self.assertTrue(saved_job['finished'])
+        self.assertEqual(saved_job['last_chat_id'], 20)
+        self.assertEqual(self.broadcaster.unfinished_jobs(), [])
+
+    def test_broadcast_is_resumed_from_cursor(self):
+        self.storage.collection('broadcasts').set_fields({'filter': {'lang': 'ru'}, 'text': 'hello', 'kwargs': {},
+                                                          'last_chat_id': 24, 'sent': 4, 'failed': 0,
+                                                          'finished': False},
+                                                         job_id='interrupted')
+
+        self.assertEqual(self.broadcaster.unfinished_jobs(), ['interrupted'])
+
+        with mock.patch('telebot.TeleBot.send_message', self.fake_send_message):
+            job = self.broadcaster.resume('interrupted')
+
+            self.assertTrue(job.wait(5))
+
+        self.assertEqual(sorted(chat_id for chat_id, _ in self.sent), list(range(25, 31)))
+        self.assertEqual(job.sent, 10)
+        self.assertIsNone(self.broadcaster.resume('interrupted'))
+
+    def test_cancelled_broadcast_is_not_resumed(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send_message(bot, chat_id, text, **kwargs):
+            sending.set()
+            release.wait(5)
+
+        with mock.patch('telebot.TeleBot.send_message', send_message):
+            job = self.broadcaster.start({'lang': 'en'}, 'hello')
+
+            self.assertTrue(sending.wait(5))
+            job.cancel()
+            release.set()
+
+            self.assertTrue(job.wait(5))
+
+        saved_job = self.storage.collection('broadcasts').get_object({'job_id': job.job_id})
+
+        self.assertEqual((saved_job['finished'], saved_job['cancelled']), (False, True))
+        self.assertEqual(self.broadcaster.unfinished_jobs(), [])
+        self.assertIsNone(self.broadcaster.resume(job.job_id))
+
+    def test_resume_is_not_shifted_by_changed_sessions(self):
+        self.storage.collection('broadcasts').set_fields({'filter': {'lang': 'ru'}, 'text': 'hello', 'kwargs': {},
+                                                          'last_chat_id': 24, 'sent': 4, 'failed': 0,
+                                                          'finished': False},
+                                                         job_id='interrupted')
+
+        # a processed recipient is gone and another one is rewritten, which moves it to the end of the storage
+        self.storage.remove_object('sessions', {'chat_id': 22})
+        self.storage.set_object('sessions', {'chat_id': 26, 'lang': 'ru'}, {'chat_id': 26})
+
+        with mock.patch('telebot.TeleBot.send_message', self.fake_send_message):
+            job = self.broadcaster.resume('interrupted')
+
+            self.assertTrue(job.wait(5))
+
+        self.assertEqual(sorted(chat_id for chat_id, _ in self.sent), list(range(25, 31)))
+        self.assertEqual(len(self.sent), 6)
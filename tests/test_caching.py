@@ -0,0 +1,149 @@
+import unittest
+
+from botlab import BotLab
+from botlab.caching import CachingStorage
+from botlab.storage import InMemoryStorage
+
+from test_botlab import CountingStorageMixin, make_message_update
+
+
+class TestCachingStorage(CountingStorageMixin, unittest.TestCase):
+    def setUp(self):
+        self.backend = InMemoryStorage({})
+        self.backend.set_fields('sessions', {'state': 'main_menu', 'lang': 'en'}, chat_id=1)
+        self.backend.set_fields('sessions', {'state': 'settings', 'lang': 'ru'}, chat_id=2)
+
+        self.count_calls(self.backend)
+
+    def test_objects_read_by_key_are_cached(self):
+        storage = CachingStorage(self.backend)
+
+        self.assertEqual(storage.get_object('sessions', {'chat_id': 1})['state'], 'main_menu')
+        self.assertEqual(storage.get_object('sessions', {'chat_id': 1}, projection=['lang']), {'lang': 'en'})
+        self.assertEqual(storage.get_field('sessions', 'state', chat_id=1), ['main_menu'])
+        self.assertIsNone(storage.get_object('sessions', {'chat_id': 3}))
+        self.assertIsNone(storage.get_object('sessions', {'chat_id': 3}))
+
+        self.assertEqual(self.calls, ['get_object', 'get_object'])
+        self.assertEqual(storage.stats(), {'hits': 3, 'misses': 2, 'evictions': 0, 'expirations': 0, 'size': 2})
+
+    def test_changes_are_written_through(self):
+        storage = CachingStorage(self.backend)
+
+        storage.get_object('sessions', {'chat_id': 1})
+        storage.set_field('sessions', 'state', 'settings', chat_id=1)
+
+        self.assertEqual(storage.get_object('sessions', {'chat_id': 1})['state'], 'settings')
+        self.assertEqual(self.backend.get_field('sessions', 'state', chat_id=1), ['settings'])
+
+        # a change by any other filter drops the collection from the cache
+        storage.set_field('sessions', 'state', 'main_menu', lang='en')
+
+        self.assertEqual(storage.get_object('sessions', {'chat_id': 1})['state'], 'main_menu')
+        self.assertEqual(self.calls, ['get_object', 'set_fields', 'get_field', 'set_fields', 'get_object'])
+
+    def test_least_recently_used_and_expired_objects_are_evicted(self):
+        storage = CachingStorage(self.backend, {'max_size': 1})
+
+        storage.get_object('sessions', {'chat_id': 1})
+        storage.get_object('sessions', {'chat_id': 2})
+        storage.get_object('sessions', {'chat_id': 1})
+
+        self.assertEqual(storage.stats()['evictions'], 2)
+        self.assertEqual(storage.stats()['size'], 1)
+
+        storage = CachingStorage(self.backend, {'ttl': 0})
+
+        storage.get_object('sessions', {'chat_id': 1})
+        storage.get_object('sessions', {'chat_id': 1})
+
+        self.assertEqual(storage.stats()['expirations'], 1)
+
+    def test_write_behind(self):
+        storage = CachingStorage(self.backend, {'write_behind': True, 'flush_interval_ms': 60000})
+
+        try:
+            storage.get_object('sessions', {'chat_id': 1})
+            storage.set_field('sessions', 'state', 'settings', chat_id=1)
+            storage.set_fields('sessions', {'lang': 'ru'}, chat_id=1)
+            storage.set_fields('sessions', {'state': 'main_menu'}, chat_id=5)
+
+            self.assertEqual(storage.get_object('sessions', {'chat_id': 1})['lang'], 'ru')
+            # not cached, but the queued changes are not lost
+            self.assertEqual(storage.get_object('sessions', {'chat_id': 5}), {'chat_id': 5, 'state': 'main_menu'})
+            self.assertEqual(self.backend.get_field('sessions', 'lang', chat_id=1), ['en'])
+
+            # reads the cache cannot serve see the queued changes
+            self.assertEqual(storage.get_field('sessions', 'chat_id', lang='ru'), [1, 2])
+
+            storage.set_field('sessions', 'state', 'settings', chat_id=2)
+            storage.flush()
+
+            self.assertEqual(self.backend.get_field('sessions', 'state', chat_id=2), ['settings'])
+        finally:
+            storage.close()
+
+    def test_failed_write_behind_is_kept(self):
+        storage = CachingStorage(self.backend, {'write_behind': True, 'flush_interval_ms': 60000})
+        bulk_set = self.backend.bulk_set
+
+        def failing_bulk_set(collection_name, updates):
+            # a change made while the failing write is in flight
+            storage.set_field('sessions', 'lang', 'de', chat_id=1)
+            raise IOError('disk is full')
+
+        try:
+            storage.set_fields('sessions', {'state': 'settings', 'lang': 'ru'}, chat_id=1)
+
+            self.backend.bulk_set = failing_bulk_set
+            self.assertRaises(IOError, storage.flush)
+
+            self.backend.bulk_set = bulk_set
+            storage.flush()
+
+            self.assertEqual(self.backend.get_object('sessions', {'chat_id': 1}, projection=['state', 'lang']),
+                             {'state': 'settings', 'lang': 'de'})
+        finally:
+            storage.close()
+
+
+class TestBotLabStorageCache(CountingStorageMixin, unittest.TestCase):
+    def test_sessions_of_active_chats_are_not_read_again(self):
+        bot = BotLab({
+            'config': {
+                'sync_strategy': 'cold'
+            },
+            'bot': {
+                'token': '123:TEST',
+                'initial_state': 'main_menu',
+                'initial_inline_state': None,
+                'suppress_exceptions': False
+            },
+            'db_storage': {
+                'type': 'inmemory',
+                'params': {},
+                'cache': {
+                    'enabled': True
+                }
+            },
+            'l10n': {
+                'default_lang': 'en',
+                'file_path': 'assets/l10n.json'
+            }
+        }, threaded=False)
+
+        @bot.message_handler(state='main_menu')
+        def main_menu(session, message):
+            session.set_field('counter', (session.get_field('counter') or [0])[0] + 1)
+
+        self.count_calls(bot._storage.storage)
+
+        for update_id in range(1, 4):
+            bot.process_new_updates([make_message_update(update_id, 42, 'hi')])
+
+        self.assertEqual(self.calls.count('get_object'), 1)
+        self.assertEqual(bot._storage.storage.get_field('sessions', 'counter', chat_id=42), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
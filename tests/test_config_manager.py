@@ -1,7 +1,45 @@
+import time
 import unittest
+from unittest import mock
 
 from botlab import ConfigurationManager
 from botlab.exceptions import WrongConfigurationException
+from botlab.kv_storage import InMemoryKVStorage, RedisKVStorage
+
+
+class CountingKVStorage(InMemoryKVStorage):
+    def __init__(self, values):
+        super().__init__()
+
+        self._kv_storage.update(values)
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append('get')
+        return super().get(key)
+
+    def set(self, key, value):
+        self.calls.append('set')
+        return super().set(key, value)
+
+    def exists(self, key):
+        self.calls.append('exists')
+        return super().exists(key)
+
+    def get_many(self, keys):
+        self.calls.append('get_many')
+        return super().get_many(keys)
+
+    def set_many(self, values):
+        self.calls.append('set_many')
+        return super().set_many(values)
+
+
+class CountingConfigManager(ConfigurationManager):
+    kv_storage_values = {}
+
+    def _create_kv_storage(self, kv_storage_type, params):
+        return CountingKVStorage(self.kv_storage_values)
 
 
 class TestConfigManager(unittest.TestCase):
@@ -66,5 +104,116 @@ class TestConfigManager(unittest.TestCase):
 
         self.assertEqual(cm.get('l10n').get('default_lang'), 'ru')
 
+    def test_values_are_cached(self):
+        settings = self.basic_settings
+        settings['config']['sync_strategy'] = 'hot'
+        settings['kv_storage']['type'] = 'inmemory'
+
+        cm = ConfigurationManager(settings)
+        cm.get('l10n')
+
+        cm._kv_storage.get = None
+
+        self.assertEqual(cm.get('l10n').get('default_lang'), 'en')
+
+    def test_stale_values_are_reread(self):
+        settings = self.basic_settings
+        settings['config']['sync_strategy'] = 'hot'
+        settings['kv_storage']['type'] = 'inmemory'
+
+        cm = ConfigurationManager(settings)
+        cm._max_staleness = 0
+        cm.get('l10n')
+
+        cm._kv_storage.set('l10n', {'default_lang': 'ru'})
+
+        self.assertEqual(cm.get('l10n').get('default_lang'), 'ru')
+
+    def test_values_are_reread_when_notifications_stop(self):
+        settings = self.basic_settings
+        settings['config']['sync_strategy'] = 'cold'
+        settings['config']['max_staleness'] = 0.01
+
+        # reports notifications as supported, but never sends any, as if the listening thread died
+        class SilentKVStorage(InMemoryKVStorage):
+            def subscribe(self, callback):
+                return True
+
+        class SilentConfigManager(ConfigurationManager):
+            def _create_kv_storage(self, kv_storage_type, params):
+                return SilentKVStorage()
+
+        cm = SilentConfigManager(settings)
+        cm.get('l10n')
+
+        # changed by another tool, without a notification
+        cm._kv_storage.set('l10n', {'default_lang': 'ru'})
+        time.sleep(0.02)
+
+        self.assertEqual(cm.get('l10n').get('default_lang'), 'ru')
+
+    def test_listeners_are_notified(self):
+        settings = self.basic_settings
+        settings['config']['sync_strategy'] = 'cold'
+
+        cm = ConfigurationManager(settings)
+        changed_keys = []
+        cm.add_listener(changed_keys.append)
+
+        cm.set('l10n', {'default_lang': 'ru'})
+        cm._on_change('bot')
+
+        self.assertEqual(changed_keys, ['l10n', 'bot'])
+
+    def test_own_redis_notifications_are_skipped(self):
+        # both storages talk to the same client, as if to the same server
+        with mock.patch('redis.StrictRedis') as redis_client:
+            kv_storage = RedisKVStorage({'host': 'localhost', 'port': 6379, 'db': 0})
+            other_kv_storage = RedisKVStorage({'host': 'localhost', 'port': 6379, 'db': 0})
+
+        changed_keys = []
+        kv_storage.subscribe(changed_keys.append)
+        redis = redis_client.return_value
+        on_message = redis.pubsub.return_value.subscribe.call_args[1][RedisKVStorage.DEFAULT_CHANNEL]
+
+        kv_storage.set('l10n', {})
+        other_kv_storage.set('bot', {})
+
+        for publish_call in redis.publish.call_args_list:
+            _, message = publish_call[0]
+            on_message({'data': message.encode('utf-8')})
+
+        self.assertEqual(changed_keys, ['bot'])
+
+    def test_bootstrap_is_one_request(self):
+        settings = self.basic_settings
+        settings['config']['sync_strategy'] = 'cold'
+
+        CountingConfigManager.kv_storage_values = {'l10n': {'default_lang': 'ru'}}
+        cm = CountingConfigManager(settings)
+
+        # kv-storage values take precedence, the missing ones are written at once
+        self.assertEqual(cm._kv_storage.calls, ['get_many', 'set_many'])
+        self.assertEqual(cm._kv_storage.get('kv_storage')['type'], 'redis')
+
+        CountingConfigManager.kv_storage_values = cm._kv_storage._kv_storage
+        cm = CountingConfigManager(settings)
+
+        self.assertEqual(cm._kv_storage.calls, ['get_many'])
+
+        # values read at bootstrap are cached
+        self.assertEqual(cm.get_many(['l10n', 'config', 'unknown']),
+                         {'l10n': {'default_lang': 'ru'}, 'config': settings['config']})
+        self.assertEqual(cm._kv_storage.calls, ['get_many', 'get_many'])
+
+    def test_get_many_reads_missing_values_at_once(self):
+        settings = self.basic_settings
+        settings['config']['sync_strategy'] = 'cold'
 
+        CountingConfigManager.kv_storage_values = {}
+        cm = CountingConfigManager(settings)
+        cm._max_staleness = 0
+        cm._kv_storage.calls = []
 
+        self.assertEqual(cm.get_many(['l10n', 'config'])['l10n']['default_lang'], 'en')
+        self.assertEqual(cm._kv_storage.calls, ['get_many'])
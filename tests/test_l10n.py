@@ -1,3 +1,5 @@
+import copy
+import time
 import unittest
 
 from botlab import ConfigurationManager, L10n
@@ -27,3 +29,57 @@ class TestL10n(unittest.TestCase):
     def test_return_none_when_faced_unknown_field(self):
         self.assertEqual(self._('zbc'), None)
 
+
+    def test_can_translate_to_other_language(self):
+        self.assertEqual(self.l10n.translator('ru')('hello', name='Max'), 'привет, Max!')
+        self.assertEqual(self.l10n.translator('de')('hello', name='Max'), None)
+
+    def test_compiled_templates_render_like_format(self):
+        templates = ['plain', 'braces {{kept}}', '{name}', '{name!r} and {count:>5}', '{args[name]}', '',
+                     '{count:>{width}}', '{name:{fill}^{width}}']
+        args = {'name': 'Max', 'count': 3, 'args': {'name': 'Max'}, 'width': 7, 'fill': '*'}
+
+        for template in templates:
+            compiled = L10n._compile(template)
+            rendered = compiled if isinstance(compiled, str) else compiled(args)
+
+            self.assertEqual(rendered, template.format(**args))
+
+    def test_set_translation(self):
+        self.l10n.set_translation('hello', 'en', 'hi, {name}')
+
+        self.assertEqual(self._('hello', name='Max'), 'hi, Max')
+        self.assertEqual(self.cm.get('l10n')['translations']['hello']['en'], 'hi, {name}')
+
+    def test_hot_config_update_rebuilds_tables(self):
+        l10n = self.cm.get('l10n')
+        l10n['translations'] = {'bye': {'en': 'bye!'}}
+
+        self.cm.set('l10n', l10n)
+
+        self.assertEqual(self._('bye'), 'bye!')
+        self.assertEqual(self._('hello', name='Max'), None)
+
+    def test_rebuild_leaves_tables_in_use_intact(self):
+        table = self.l10n._tables['en']
+
+        l10n = self.cm.get('l10n')
+        l10n['translations'] = {'bye': {'en': 'bye!'}}
+        self.cm.set('l10n', l10n)
+
+        # a translation running meanwhile sees the whole old table
+        self.assertIn('hello', table)
+        self.assertNotIn('bye', table)
+        self.assertEqual(self._('bye'), 'bye!')
+
+    def test_changes_by_others_reach_tables_once_stale(self):
+        self.cm._max_staleness = 0.01
+
+        # written straight to kv-storage, as another process would, without a notification
+        l10n = copy.deepcopy(self.cm.get('l10n'))
+        l10n['translations']['hello']['en'] = 'hi, {name}!'
+        self.cm._kv_storage._kv_storage['l10n'] = l10n
+
+        time.sleep(0.02)
+
+        self.assertEqual(self._('hello', name='Max'), 'hi, Max!')
@@ -0,0 +1,110 @@
+import unittest
+from unittest import mock
+
+from botlab import BotLab
+from botlab.metrics import Metrics
+
+from test_botlab import make_message_update
+
+
+def fake_make_request(token, method_name, method='get', params=None, files=None):
+    return {'message_id': 1, 'date': 0, 'chat': {'id': params['chat_id'], 'type': 'private'}}
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics({'buckets': [0.1, 1]})
+
+    def test_prometheus_text_format(self):
+        self.metrics.inc('requests_total', labels={'result': 'hit'})
+        self.metrics.inc('requests_total', 2, {'result': 'hit'})
+        self.metrics.set_gauge('queue_depth', 3, {'worker': 0})
+
+        for value in [0.05, 0.5, 5]:
+            self.metrics.observe('latency_seconds', value, {'op': 'get'})
+
+        self.assertEqual(self.metrics.render().splitlines(), [
+            '# TYPE requests_total counter',
+            'requests_total{result="hit"} 3',
+            '# TYPE queue_depth gauge',
+            'queue_depth{worker="0"} 3',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{op="get",le="0.1"} 1',
+            'latency_seconds_bucket{op="get",le="1"} 2',
+            'latency_seconds_bucket{op="get",le="+Inf"} 3',
+            'latency_seconds_sum{op="get"} 5.55',
+            'latency_seconds_count{op="get"} 3'
+        ])
+
+    def test_hooks_and_collectors(self):
+        recorded = []
+
+        self.metrics.add_hook(lambda kind, name, labels, value: recorded.append((kind, name, labels)))
+        self.metrics.add_collector(lambda metrics: metrics.set_gauge('collected', 1))
+
+        self.metrics.timed('call_seconds', lambda: None, {'func': 'noop'})()
+        self.metrics.render()
+
+        self.assertEqual(recorded, [('histogram', 'call_seconds', {'func': 'noop'}), ('gauge', 'collected', {})])
+        self.assertEqual(self.metrics.get('call_seconds', {'func': 'noop'})[0], 1)
+        self.assertEqual(self.metrics.get('collected'), 1)
+
+
+class TestBotLabMetrics(unittest.TestCase):
+    def setUp(self):
+        self.settings = {
+            'config': {
+                'sync_strategy': 'cold'
+            },
+            'bot': {
+                'token': '123:TEST',
+                'initial_state': 'main_menu',
+                'initial_inline_state': None,
+                'suppress_exceptions': False
+            },
+            'db_storage': {
+                'type': 'inmemory',
+                'params': {}
+            },
+            'l10n': {
+                'default_lang': 'en',
+                'file_path': 'assets/l10n.json'
+            },
+            'metrics': {
+                'enabled': True
+            }
+        }
+
+    def test_hot_path_is_measured(self):
+        bot = BotLab(self.settings, threaded=False)
+
+        @bot.message_handler(state='main_menu')
+        def main_menu(session, message):
+            session.reply_message(session._('hello', name='Max'))
+
+        with mock.patch('telebot.apihelper._make_request', fake_make_request):
+            bot.process_new_updates([make_message_update(1, 42, 'hi')])
+            bot.process_new_updates([make_message_update(2, 42, 'hi')])
+
+        handler_labels = {'handler': 'main_menu', 'state': 'main_menu'}
+
+        self.assertEqual(bot.metrics.get('botlab_handler_seconds', handler_labels)[0], 2)
+        self.assertEqual(bot.metrics.get('botlab_dispatch_seconds')[0], 2)
+        self.assertEqual(bot.metrics.get('botlab_api_request_seconds', {'method': 'send_message'})[0], 2)
+        self.assertEqual(bot.metrics.get('botlab_storage_seconds', {'backend': 'inmemory', 'collection': 'sessions',
+                                                                    'operation': 'get_object'})[0], 2)
+        self.assertGreater(bot.metrics.get('botlab_config_cache_requests_total', {'result': 'hit'}), 0)
+
+        self.assertIn('# TYPE botlab_handler_seconds histogram', bot.metrics.render())
+
+    def test_disabled_by_default(self):
+        del self.settings['metrics']
+
+        bot = BotLab(self.settings, threaded=False)
+
+        self.assertIsNone(bot.metrics)
+        self.assertIsNone(bot._config_manager.metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import concurrent.futures
+import unittest
+from unittest import mock
+
+import requests
+import urllib3
+from telebot.apihelper import ApiException
+
+from botlab import BotLab
+from botlab.outbox import Outbox
+
+from test_broadcast import FloodControlResponse
+
+
+class ServerErrorResponse(object):
+    status_code = 502
+
+
+def fake_send_message(bot, chat_id, text, **kwargs):
+    if chat_id == 5:
+        raise ApiException('Forbidden: bot was blocked by the user', 'sendMessage', None)
+
+    return text
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.outbox = Outbox({'workers': 4, 'rate': 1000, 'per_chat_rate': 1000})
+        self.sent = []
+
+    def tearDown(self):
+        self.outbox.close()
+
+    def send(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+        return text
+
+    def test_requests_to_one_chat_are_sent_in_order(self):
+        futures = [self.outbox.submit(i % 5, self.send, i % 5, i) for i in range(50)]
+
+        self.assertEqual([future.result(5) for future in futures], list(range(50)))
+
+        for chat_id in range(5):
+            self.assertEqual([text for sent_chat_id, text in self.sent if sent_chat_id == chat_id],
+                             list(range(chat_id, 50, 5)))
+
+        self.assertEqual(self.outbox.metrics()['delivered'], 50)
+
+    def test_flood_control_and_connection_errors_are_retried(self):
+        errors = [ApiException('Too Many Requests', 'sendMessage', FloodControlResponse()),
+                  ApiException('Bad Gateway', 'sendMessage', ServerErrorResponse()),
+                  requests.exceptions.ConnectTimeout(),
+                  requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(
+                      None, '/', urllib3.exceptions.NewConnectionError(None, 'Connection refused')))]
+        self.outbox.close()
+        self.outbox = Outbox({'workers': 4, 'rate': 1000, 'per_chat_rate': 1000, 'max_retries': len(errors)})
+
+        def send(chat_id, text):
+            if len(errors) > 0:
+                raise errors.pop(0)
+
+            return self.send(chat_id, text)
+
+        with mock.patch.object(Outbox, 'CONNECTION_RETRY_INTERVAL', 0.01):
+            self.assertEqual(self.outbox.submit(1, send, 1, 'hi').result(5), 'hi')
+
+        metrics = self.outbox.metrics()
+
+        self.assertEqual((metrics['delivered'], metrics['retried'], metrics['rate_limited']), (1, 4, 1))
+
+    def test_requests_that_may_have_been_sent_are_not_retried(self):
+        for error in [requests.exceptions.ReadTimeout(),
+                      requests.exceptions.ConnectionError(urllib3.exceptions.ProtocolError('Connection aborted.'))]:
+            calls = []
+
+            def send(chat_id, text):
+                calls.append(text)
+                raise error
+
+            self.assertRaises(type(error), self.outbox.submit(1, send, 1, 'hi').result, 5)
+            self.assertEqual(calls, ['hi'])
+
+        self.assertEqual(self.outbox.metrics()['retried'], 0)
+
+    def test_failures_are_passed_to_the_future(self):
+        def send(chat_id, text):
+            raise ApiException('Forbidden: bot was blocked by the user', 'sendMessage', None)
+
+        future = self.outbox.submit(1, send, 1, 'hi')
+
+        self.assertRaises(ApiException, future.result, 5)
+        self.assertEqual(self.outbox.metrics()['failed'], 1)
+
+
+class TestBotLabOutbox(unittest.TestCase):
+    def make_bot(self, outbox_config):
+        return BotLab({
+            'config': {'sync_strategy': 'cold'},
+            'bot': {'token': '123:TEST', 'initial_state': 'main_menu', 'initial_inline_state': None,
+                    'suppress_exceptions': True},
+            'db_storage': {'type': 'inmemory', 'params': {}},
+            'l10n': {'default_lang': 'en', 'file_path': 'assets/l10n.json'},
+            'outbox': outbox_config
+        }, threaded=False)
+
+    def test_send_methods_wait_for_outbox(self):
+        bot = self.make_bot({'enabled': True, 'per_chat_rate': 1000})
+
+        with mock.patch('telebot.TeleBot.send_message', fake_send_message):
+            self.assertEqual(bot.send_message(1, 'hi'), 'hi')
+            # exceptions are suppressed as without the outbox
+            self.assertIsNone(bot.send_message(5, 'hi'))
+
+        self.assertEqual(bot.outbox.metrics()['delivered'], 1)
+        self.assertEqual(bot.outbox.metrics()['failed'], 1)
+
+        bot.outbox.close()
+
+    def test_send_methods_return_futures(self):
+        bot = self.make_bot({'enabled': True, 'wait': False, 'per_chat_rate': 1000})
+
+        with mock.patch('telebot.TeleBot.send_message', fake_send_message):
+            future = bot.send_message(1, 'hi')
+
+            self.assertIsInstance(future, concurrent.futures.Future)
+            self.assertEqual(future.result(5), 'hi')
+
+        bot.outbox.close()
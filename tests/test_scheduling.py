@@ -0,0 +1,75 @@
+import threading
+import time
+import unittest
+
+from botlab.scheduling import ShardedWorkerPool
+
+
+class TestShardedWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ShardedWorkerPool(workers=4, queue_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_tasks_of_one_key_run_in_order(self):
+        done = {}
+
+        for i in range(100):
+            key = i % 10
+            self.pool.put(key, lambda key, i: done.setdefault(key, []).append(i), key, i)
+
+        self.assertTrue(self.pool.join(5))
+
+        for key in range(10):
+            self.assertEqual(done[key], list(range(key, 100, 10)))
+
+    def test_keys_of_different_workers_run_in_parallel(self):
+        released = threading.Event()
+        started = threading.Event()
+
+        self.pool.put(0, released.wait, 5)
+        self.pool.put(1, started.set)
+
+        self.assertTrue(started.wait(5))
+        released.set()
+
+    def test_put_blocks_on_full_queue(self):
+        released = threading.Event()
+
+        self.pool.put(0, released.wait, 5)
+        # wait for the worker to take the blocking task
+        while self.pool.queue_depths()[0] > 0:
+            time.sleep(0.01)
+
+        self.pool.put(0, lambda: None)
+        self.pool.put(0, lambda: None)
+
+        third_put = threading.Thread(target=self.pool.put, args=(0, lambda: None))
+        third_put.start()
+        third_put.join(0.2)
+
+        self.assertTrue(third_put.is_alive())
+        self.assertEqual(self.pool.queue_depths(), [2, 0, 0, 0])
+
+        released.set()
+        third_put.join(5)
+        self.assertTrue(self.pool.join(5))
+
+        metrics = self.pool.metrics()
+
+        self.assertEqual(metrics['blocked_puts'], 1)
+        self.assertEqual(metrics['max_depths'][0], 2)
+        self.assertEqual(metrics['processed'], 4)
+
+    def test_exceptions_are_kept_for_polling(self):
+        def fail():
+            raise ValueError('failed')
+
+        self.pool.put(0, fail)
+        self.pool.join(5)
+
+        self.assertRaises(ValueError, self.pool.raise_exceptions)
+
+        self.pool.clear_exceptions()
+        self.pool.raise_exceptions()
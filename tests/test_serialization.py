@@ -0,0 +1,45 @@
+import importlib.util
+import json
+import unittest
+
+from botlab.exceptions import UnsupportedCodecException
+from botlab.serialization import Serializer
+
+VALUE = {'default_lang': 'en', 'translations': {'en': {'hello': 'hello, {name}!' * 100}}, 'ids': [1, 2, 3]}
+
+
+class TestSerializer(unittest.TestCase):
+    def test_json_is_stored_as_is(self):
+        data = Serializer().dumps(VALUE)
+
+        self.assertEqual(json.loads(data.decode('utf-8')), VALUE)
+        self.assertEqual(Serializer().loads(json.dumps(VALUE).encode('utf-8')), VALUE)
+
+    def test_values_are_read_with_any_settings(self):
+        configs = [None, {'codec': 'pickle'}, {'codec': 'json', 'compression': 'zlib'},
+                   {'codec': 'pickle', 'compression': 'zlib', 'compression_threshold': 0}]
+
+        if importlib.util.find_spec('msgpack') is not None:
+            configs.append({'codec': 'msgpack'})
+
+        if importlib.util.find_spec('lz4') is not None:
+            configs.append({'codec': 'json', 'compression': 'lz4'})
+
+        reader = Serializer({'allow_pickle': True})
+
+        for config in configs:
+            data = Serializer(config).dumps(VALUE)
+
+            self.assertEqual(reader.loads(data), VALUE)
+
+    def test_compression_threshold(self):
+        serializer = Serializer({'compression': 'zlib', 'compression_threshold': 1024})
+
+        self.assertEqual(serializer.dumps([1]), b'[1]')
+        self.assertLess(len(serializer.dumps(VALUE)), len(Serializer().dumps(VALUE)))
+
+    def test_pickle_is_not_read_unless_allowed(self):
+        data = Serializer({'codec': 'pickle'}).dumps(VALUE)
+
+        self.assertRaises(UnsupportedCodecException, Serializer().loads, data)
+        self.assertRaises(UnsupportedCodecException, Serializer, {'codec': 'yaml'})
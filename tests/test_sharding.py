@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from botlab.sharding import ShardSupervisor, get_update_chat_id, shard_config
+from botlab.storage import DiskStorage
+
+
+def setup_handlers(bot):
+    @bot.message_handler(func=lambda message: True)
+    def count(session, message):
+        session.set_field('texts', (session.get_field('texts') or [[]])[0] + [message.text])
+        session.set_field('pid', os.getpid())
+
+
+def setup_stuck_once(bot):
+    flag_file_path = os.path.join(os.path.dirname(bot._storage.storage_file_path), 'stuck')
+
+    if os.path.exists(flag_file_path):
+        os.remove(flag_file_path)
+        time.sleep(60)
+
+    setup_handlers(bot)
+
+
+def make_message(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Max'}
+        }
+    }
+
+
+class TestShardSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.settings = {
+            'config': {
+                'sync_strategy': 'cold'
+            },
+            'bot': {
+                'token': '123:TEST',
+                'initial_state': 'main_menu',
+                'initial_inline_state': None,
+                'suppress_exceptions': False
+            },
+            'db_storage': {
+                'type': 'disk',
+                'params': {'file_path': os.path.join(self.dir, 'storage.json')}
+            },
+            'l10n': {
+                'default_lang': 'en',
+                'file_path': 'assets/l10n.json'
+            },
+            'sharding': {
+                'processes': 3
+            }
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_sessions(self):
+        sessions = {}
+
+        for shard in range(3):
+            storage = DiskStorage(shard_config(self.settings, shard)['db_storage']['params'])
+
+            for session in storage.iter_objects('sessions', {}):
+                self.assertNotIn(session['chat_id'], sessions)
+                sessions[session['chat_id']] = session
+
+            storage.close()
+
+        return sessions
+
+    def test_chat_id_of_updates(self):
+        self.assertEqual(get_update_chat_id(make_message(1, 42, 'hi')), 42)
+        self.assertEqual(get_update_chat_id({'update_id': 1, 'callback_query': {'id': '1', 'from': {'id': 7}}}), 7)
+        self.assertEqual(get_update_chat_id({'update_id': 1, 'poll': {}}), None)
+
+    def test_updates_of_one_chat_go_to_one_worker_in_order(self):
+        supervisor = ShardSupervisor(self.settings, setup_handlers)
+        supervisor.start()
+
+        supervisor.process_new_updates([make_message(i * 10 + chat_id, chat_id, str(i))
+                                        for i in range(10) for chat_id in range(6)])
+        # updates given before the restart are handled by the old worker, the rest by the new one
+        supervisor.restart_worker(supervisor.shard(0))
+        supervisor.process_new_updates([make_message(100 + chat_id, chat_id, 'last') for chat_id in range(6)])
+        supervisor.stop()
+
+        sessions = self.read_sessions()
+
+        self.assertEqual(sorted(sessions.keys()), list(range(6)))
+        self.assertEqual(supervisor.last_update_id, 105)
+
+        for chat_id in range(6):
+            self.assertEqual(sessions[chat_id]['texts'], [str(i) for i in range(10)] + ['last'])
+
+        self.assertEqual(len({session['pid'] for session in sessions.values()}), 3)
+
+    def test_dead_workers_are_revived(self):
+        supervisor = ShardSupervisor(self.settings, setup_handlers)
+        supervisor.start()
+
+        supervisor._workers[1].kill()
+        supervisor._workers[1].join()
+
+        self.assertEqual(supervisor.revive_workers(), [1])
+
+        supervisor.process_new_updates([make_message(chat_id + 1, chat_id, 'hi') for chat_id in range(6)])
+        supervisor.stop()
+
+        self.assertEqual(len(self.read_sessions()), 6)
+
+    def test_dead_workers_are_revived_when_updates_are_handed_over(self):
+        supervisor = ShardSupervisor(self.settings, setup_handlers)
+        supervisor.start()
+
+        supervisor._workers[1].kill()
+        supervisor._workers[1].join()
+
+        # as a webhook does, without polling
+        supervisor.process_new_updates([make_message(chat_id + 1, chat_id, 'hi') for chat_id in range(6)])
+        supervisor.stop()
+
+        self.assertEqual(len(self.read_sessions()), 6)
+
+    def test_full_queue_of_dead_worker(self):
+        self.settings['sharding']['queue_size'] = 2
+        supervisor = ShardSupervisor(self.settings, setup_handlers)
+        supervisor.start()
+
+        supervisor._workers[1].kill()
+        supervisor._workers[1].join()
+
+        # all to shard 1, more than its queue holds
+        for update_id, chat_id in enumerate([1, 4, 7, 10, 13]):
+            supervisor._put(supervisor.shard(chat_id), make_message(update_id + 1, chat_id, 'hi'))
+
+        supervisor.stop()
+
+        self.assertEqual(sorted(self.read_sessions().keys()), [1, 4, 7, 10, 13])
+
+    def test_worker_dying_with_full_queue_is_restarted(self):
+        self.settings['sharding'] = {'processes': 1, 'queue_size': 2}
+        open(os.path.join(self.dir, 'stuck'), 'w').close()
+
+        supervisor = ShardSupervisor(self.settings, setup_stuck_once)
+        supervisor.start()
+
+        # the worker doesn't take anything out while it is stuck
+        supervisor._put(0, make_message(1, 4, 'hi'))
+        supervisor._put(0, make_message(2, 7, 'hi'))
+
+        restart = threading.Thread(target=supervisor.restart_worker, args=(0,), daemon=True)
+        restart.start()
+        # the stop marker waits for room in the queue meanwhile
+        time.sleep(ShardSupervisor.PUT_TIMEOUT / 2)
+        supervisor._workers[0].kill()
+        restart.join(10)
+
+        self.assertFalse(restart.is_alive())
+
+        supervisor.stop()
+
+        sessions = self.read_sessions()
+
+        # the updates left in the queue are handled by the new worker
+        self.assertEqual([sessions[chat_id]['texts'] for chat_id in [4, 7]], [['hi'], ['hi']])
@@ -0,0 +1,640 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pymongo
+
+from botlab.exceptions import UnsupportedCodecException
+from botlab.paged_storage import PagedCollection, PagedStorage
+from botlab.serialization import Serializer
+from botlab.sqlite_storage import SqliteStorage
+from botlab.storage import InMemoryStorage, DiskStorage, MongoStorage, CompactRecord
+
+
+class TestInMemoryStorage(unittest.TestCase):
+    def setUp(self):
+        self.storage = InMemoryStorage(None)
+        self.sessions = self.storage.collection('sessions')
+
+        for chat_id in range(100):
+            self.sessions.set_field('lang', 'en' if chat_id % 2 else 'ru', chat_id=chat_id)
+
+    def test_get_field_by_indexed_key(self):
+        self.assertEqual(self.sessions.get_field('lang', chat_id=3), ['en'])
+        self.assertEqual(self.sessions.get_field('lang', chat_id=4), ['ru'])
+        self.assertEqual(self.sessions.get_field('lang', chat_id=1000), [])
+
+    def test_index_narrows_lookup(self):
+        candidates = self.storage._candidate_objects('sessions', {'chat_id': 3, 'lang': 'en'})
+
+        self.assertEqual(len(candidates), 1)
+
+    def test_get_field_by_unindexed_key(self):
+        self.assertEqual(len(self.sessions.get_field('chat_id', lang='en')), 50)
+
+    def test_set_field_keeps_index_up_to_date(self):
+        storage = InMemoryStorage({'indexes': {'sessions': ['chat_id', 'lang']}})
+        sessions = storage.collection('sessions')
+
+        sessions.set_field('lang', 'en', chat_id=1)
+        sessions.set_field('lang', 'ru', chat_id=1)
+
+        self.assertEqual(sessions.get_field('chat_id', lang='en'), [])
+        self.assertEqual(sessions.get_field('chat_id', lang='ru'), [1])
+
+    def test_set_object_replaces_indexed_object(self):
+        self.sessions.set_object({'chat_id': 3, 'lang': 'de'}, {'chat_id': 3})
+
+        self.assertEqual(self.sessions.get_object({'chat_id': 3}), {'chat_id': 3, 'lang': 'de'})
+        self.assertEqual(len(self.sessions.get_object({'chat_id': 3}, multi=True)), 1)
+
+    def test_remove_object_drops_it_from_index(self):
+        self.assertTrue(self.sessions.remove_object({'chat_id': 3}))
+        self.assertIsNone(self.sessions.get_object({'chat_id': 3}))
+        self.assertFalse(self.sessions.remove_object({'chat_id': 3}))
+        self.assertNotIn(3, self.storage._indexes['sessions']['chat_id'])
+
+    def test_remove_multi(self):
+        self.assertTrue(self.sessions.remove_object({'lang': 'en'}, multi=True))
+        self.assertEqual(self.sessions.get_field('chat_id', lang='en'), [])
+        self.assertEqual(len(self.sessions.get_field('chat_id', lang='ru')), 50)
+
+    def test_removal_from_large_collection(self):
+        self.storage.bulk_set('sessions', [({'chat_id': chat_id}, {'lang': 'en'}) for chat_id in range(100, 20100)])
+        started_at = time.perf_counter()
+
+        # a scan of the collection per object would take minutes
+        for chat_id in range(100, 20100, 2):
+            self.sessions.remove_object({'chat_id': chat_id})
+            self.sessions.set_object({'chat_id': chat_id + 1, 'lang': 'ru'}, {'chat_id': chat_id + 1})
+
+        self.assertLess(time.perf_counter() - started_at, 2)
+        self.assertEqual(len(self.sessions.get_field('chat_id', lang='ru')), 50 + 10000)
+        self.assertIsNone(self.sessions.get_object({'chat_id': 100}))
+        self.assertEqual([obj['chat_id'] for obj in self.sessions.iter_objects({'lang': 'ru'})][-2:], [20097, 20099])
+
+    def test_iter_field(self):
+        values = self.sessions.iter_field('chat_id', batch_size=10, lang='en')
+
+        self.assertFalse(isinstance(values, list))
+        self.assertEqual(list(values), list(range(1, 100, 2)))
+
+    def test_iter_field_sorted(self):
+        # inserted out of order
+        self.sessions.remove_object({'chat_id': 7})
+        self.sessions.set_field('lang', 'en', chat_id=7)
+
+        values = self.sessions.iter_field_sorted('chat_id', batch_size=10, lang='en')
+
+        self.assertFalse(isinstance(values, list))
+        self.assertEqual(list(values), list(range(1, 100, 2)))
+        self.assertEqual(list(self.sessions.iter_field_sorted('chat_id', after=90, batch_size=3, lang='en')),
+                         [91, 93, 95, 97, 99])
+        self.assertEqual(list(self.sessions.iter_field_sorted('lang', batch_size=1)), ['en', 'ru'])
+
+    def test_iter_objects_with_projection(self):
+        self.sessions.set_field('state', 'main_menu', chat_id=3)
+
+        objects = list(self.sessions.iter_objects({'chat_id': 3}, projection=['state']))
+
+        self.assertEqual(objects, [{'state': 'main_menu'}])
+
+    def test_iter_objects_survives_removal(self):
+        removed = []
+
+        for obj in self.sessions.iter_objects({'lang': 'ru'}):
+            self.sessions.remove_object({'chat_id': obj['chat_id']})
+            removed.append(obj['chat_id'])
+
+        self.assertEqual(removed, list(range(0, 100, 2)))
+
+
+class TestCompactInMemoryStorage(TestInMemoryStorage):
+    SCHEMAS = {'sessions': ['chat_id', 'lang', 'state', 'inline_state']}
+
+    def setUp(self):
+        self.storage = InMemoryStorage({'schemas': TestCompactInMemoryStorage.SCHEMAS})
+        self.sessions = self.storage.collection('sessions')
+
+        for chat_id in range(100):
+            self.sessions.set_field('lang', 'en' if chat_id % 2 else 'ru', chat_id=chat_id)
+
+    def test_objects_are_compact_records(self):
+        self.sessions.set_fields({'state': ''.join(['main', '_menu']), 'counter': 1}, chat_id=1)
+
+        self.assertIsInstance(self.storage.store['sessions'][1], CompactRecord)
+
+        obj = self.sessions.get_object({'chat_id': 1})
+
+        self.assertIs(type(obj), dict)
+        self.assertEqual(obj, {'chat_id': 1, 'lang': 'en', 'state': 'main_menu', 'counter': 1})
+        self.assertIs(obj['state'], 'main_menu')
+        self.assertNotIn('inline_state', obj)
+        self.assertEqual(self.sessions.get_object({'chat_id': 1}, projection=['state', 'inline_state']),
+                         {'state': 'main_menu'})
+        self.assertEqual(len(self.sessions.get_field('chat_id', lang='en', counter=1)), 1)
+
+    def test_objects_can_be_pickled_and_dumped(self):
+        self.sessions.set_fields({'state': 'main_menu', 'history': [1]}, chat_id=1)
+
+        for obj in [self.sessions.get_object({'chat_id': 1}), self.sessions.get_object({'chat_id': 1}, multi=True)[0],
+                    next(self.sessions.iter_objects({'chat_id': 1}))]:
+            self.assertEqual(pickle.loads(pickle.dumps(obj)), obj)
+            self.assertEqual(json.loads(json.dumps(obj)), obj)
+
+    def test_disk_snapshot_of_compact_records(self):
+        dir = tempfile.mkdtemp()
+
+        try:
+            config = {'file_path': os.path.join(dir, 'storage.json'), 'schemas': TestCompactInMemoryStorage.SCHEMAS}
+
+            storage = DiskStorage(config)
+            storage.collection('sessions').set_fields({'state': 'main_menu', 'history': [1]}, chat_id=1)
+            storage.close()
+
+            storage = DiskStorage(config)
+
+            self.assertIsInstance(storage.store['sessions'][0], CompactRecord)
+            self.assertEqual(storage.collection('sessions').get_object({'chat_id': 1}),
+                             {'chat_id': 1, 'state': 'main_menu', 'history': [1]})
+            storage.close()
+        finally:
+            shutil.rmtree(dir)
+
+
+class TestMongoStorage(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('pymongo.MongoClient')
+        self.addCleanup(patcher.stop)
+
+        self.db = patcher.start()()['botlab_test']
+        self.storage = MongoStorage({'host': 'localhost', 'port': 27017, 'database': 'botlab_test'})
+
+    def test_unique_session_index_is_created(self):
+        self.db['sessions'].create_index.assert_called_once_with('chat_id', unique=True)
+
+    def test_get_field_reads_projected_objects(self):
+        self.db['sessions'].find.return_value = [{'profile': {'lang': 'en'}}, {'profile': {}},
+                                                 {'profile': {'lang': 'ru'}}]
+
+        self.assertEqual(self.storage.get_field('sessions', 'profile.lang', state='main_menu'), ['en', 'ru'])
+        self.db['sessions'].find.assert_called_once_with({'state': 'main_menu'}, {'profile.lang': 1, '_id': 0})
+
+        self.db['sessions'].find.return_value = []
+
+        self.assertEqual(self.storage.get_field('sessions', 'state', chat_id=2), [])
+
+    def test_iter_field_sorted_is_a_sorted_query(self):
+        cursor = self.db['sessions'].find.return_value.sort.return_value.batch_size.return_value
+        cursor.__iter__.return_value = iter([{'chat_id': 21}, {'chat_id': 22}])
+
+        self.assertEqual(list(self.storage.iter_field_sorted('sessions', 'chat_id', after=20, lang='en')), [21, 22])
+        self.db['sessions'].find.assert_called_once_with({'$and': [{'lang': 'en'}, {'chat_id': {'$gt': 20}}]},
+                                                         {'chat_id': 1, '_id': 0})
+        self.db['sessions'].find.return_value.sort.assert_called_once_with('chat_id', pymongo.ASCENDING)
+
+    def test_bulk_set_is_one_bulk_write(self):
+        self.storage.bulk_set('sessions', [({'chat_id': 1}, {'state': 'main_menu'}),
+                                           ({'chat_id': 2}, {'state': 'settings', 'lang': 'ru'})])
+
+        operations = self.db['sessions'].bulk_write.call_args[0][0]
+
+        self.assertEqual(operations, [
+            pymongo.UpdateOne({'chat_id': 1}, {'$set': {'state': 'main_menu'}}, upsert=True),
+            pymongo.UpdateOne({'chat_id': 2}, {'$set': {'state': 'settings', 'lang': 'ru'}}, upsert=True)
+        ])
+
+
+class TestDiskStorage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir, 'storage.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_snapshot_survives_restart(self):
+        storage = DiskStorage({'file_path': self.file_path})
+        storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+        storage.close()
+
+        storage = DiskStorage({'file_path': self.file_path})
+
+        self.assertEqual(storage.collection('sessions').get_field('state', chat_id=1), ['main_menu'])
+        self.assertFalse(os.path.exists(self.file_path + '.tmp'))
+
+    def test_corrupt_snapshot_is_moved_aside(self):
+        with open(self.file_path, 'wb') as f:
+            f.write(b'{"sessions": [{"chat_id"')
+
+        with self.assertLogs('botlab.storage', 'ERROR'):
+            storage = DiskStorage({'file_path': self.file_path})
+
+        storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+        storage.close()
+
+        with open(self.file_path + '.corrupt', 'rb') as f:
+            self.assertEqual(f.read(), b'{"sessions": [{"chat_id"')
+
+    def test_snapshot_of_codec_not_allowed(self):
+        storage = DiskStorage({'file_path': self.file_path, 'serialization': {'codec': 'pickle'}})
+        storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+        storage.close()
+
+        self.assertRaises(UnsupportedCodecException, DiskStorage, {'file_path': self.file_path})
+        self.assertEqual(len(DiskStorage._read_snapshot(self.file_path, Serializer({'codec': 'pickle'}))), 1)
+
+    def test_journal_is_replayed_over_snapshot(self):
+        config = {'file_path': self.file_path, 'journal': True}
+
+        storage = DiskStorage(config)
+        sessions = storage.collection('sessions')
+        sessions.set_field('state', 'main_menu', chat_id=1)
+        sessions.set_field('state', 'switch_lang', chat_id=1)
+        sessions.set_object({'chat_id': 2, 'state': 'main_menu'}, {'chat_id': 2})
+        sessions.set_field('state', 'main_menu', chat_id=3)
+        sessions.remove_object({'chat_id': 3})
+        storage.close()
+
+        self.assertFalse(os.path.exists(self.file_path))
+
+        storage = DiskStorage(config)
+        sessions = storage.collection('sessions')
+
+        self.assertEqual(sessions.get_field('state', chat_id=1), ['switch_lang'])
+        self.assertEqual(sessions.get_object({'chat_id': 2}), {'chat_id': 2, 'state': 'main_menu'})
+        self.assertIsNone(sessions.get_object({'chat_id': 3}))
+
+    def test_torn_journal_record_is_ignored(self):
+        config = {'file_path': self.file_path, 'journal': True}
+
+        storage = DiskStorage(config)
+        storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+        storage.close()
+
+        with open(self.file_path + '.log', 'a') as f:
+            f.write('{"op": "set_fi')
+
+        storage = DiskStorage(config)
+
+        self.assertEqual(storage.collection('sessions').get_field('state', chat_id=1), ['main_menu'])
+
+    def test_journal_is_compacted(self):
+        config = {'file_path': self.file_path, 'journal': True, 'compaction_threshold': 1024}
+
+        storage = DiskStorage(config)
+        sessions = storage.collection('sessions')
+
+        for i in range(200):
+            sessions.set_field('counter', i, chat_id=i % 10)
+
+        storage.close()
+
+        self.assertTrue(os.path.exists(self.file_path))
+        self.assertLess(os.path.getsize(self.file_path + '.log'), 1024 * 2)
+
+        storage = DiskStorage(config)
+
+        self.assertEqual(storage.collection('sessions').get_field('counter', chat_id=9), [199])
+
+    def test_failed_compaction_loses_no_records(self):
+        config = {'file_path': self.file_path, 'journal': True, 'compaction_threshold': 1024}
+        fold_journal = DiskStorage._fold_journal
+        failures = []
+
+        def fail_once(storage):
+            if len(failures) < 1:
+                failures.append(storage)
+                raise OSError('No space left on device')
+
+            fold_journal(storage)
+
+        with mock.patch.object(DiskStorage, '_fold_journal', fail_once), \
+                mock.patch.object(DiskStorage, 'COMPACTION_RETRY_INTERVAL', 0), \
+                self.assertLogs('botlab.storage', 'ERROR'):
+            storage = DiskStorage(config)
+
+            for i in range(200):
+                storage.collection('sessions').set_field('counter', i, chat_id=i % 10)
+
+            storage.close()
+
+        self.assertEqual(len(failures), 1)
+        self.assertFalse(os.path.exists(self.file_path + '.log.compacting'))
+
+        storage = DiskStorage(config)
+
+        self.assertEqual([storage.collection('sessions').get_field('counter', chat_id=chat_id)[0]
+                          for chat_id in range(10)], list(range(190, 200)))
+
+    def test_write_behind_flushes_on_demand(self):
+        config = {'file_path': self.file_path, 'journal': True, 'write_behind': True,
+                  'flush_interval_ms': 60 * 1000, 'flush_every': 1000}
+
+        storage = DiskStorage(config)
+        storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+
+        self.assertEqual(os.path.getsize(self.file_path + '.log'), 0)
+
+        storage.flush()
+
+        self.assertGreater(os.path.getsize(self.file_path + '.log'), 0)
+
+        storage.close()
+
+    def test_failed_flush_keeps_pending_changes(self):
+        for journal in [True, False]:
+            config = {'file_path': self.file_path + str(journal), 'journal': journal, 'write_behind': True,
+                      'flush_interval_ms': 60 * 1000}
+
+            storage = DiskStorage(config)
+            storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+
+            with mock.patch('os.fsync', side_effect=OSError('disk is full')):
+                self.assertRaises(OSError, storage.flush)
+
+            storage.collection('sessions').set_field('lang', 'en', chat_id=1)
+            storage.flush()
+            storage.close()
+
+            self.assertEqual(DiskStorage(config).collection('sessions').get_object({'chat_id': 1}),
+                             {'chat_id': 1, 'state': 'main_menu', 'lang': 'en'})
+
+            if journal:
+                with open(config['file_path'] + '.log', encoding='utf-8') as f:
+                    self.assertEqual(len(f.readlines()), 2)
+
+    def test_write_behind_flushes_every_n_changes(self):
+        config = {'file_path': self.file_path, 'write_behind': True,
+                  'flush_interval_ms': 60 * 1000, 'flush_every': 10}
+
+        storage = DiskStorage(config)
+
+        for i in range(10):
+            storage.collection('sessions').set_field('state', 'main_menu', chat_id=i)
+
+        for _ in range(100):
+            if os.path.exists(self.file_path):
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(len(DiskStorage._read_snapshot(self.file_path, Serializer())['sessions']), 10)
+
+        storage.close()
+
+    def test_write_behind_flushes_on_close(self):
+        config = {'file_path': self.file_path, 'journal': True, 'write_behind': True,
+                  'flush_interval_ms': 60 * 1000}
+
+        storage = DiskStorage(config)
+        storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+        storage.close()
+
+        storage = DiskStorage(config)
+
+        self.assertEqual(storage.collection('sessions').get_field('state', chat_id=1), ['main_menu'])
+
+        storage.close()
+
+    def test_codec_can_be_switched(self):
+        storage = DiskStorage({'file_path': self.file_path})
+        storage.collection('sessions').set_field('state', 'main_menu', chat_id=1)
+        storage.close()
+
+        config = {'file_path': self.file_path,
+                  'serialization': {'codec': 'pickle', 'compression': 'zlib', 'compression_threshold': 0}}
+
+        # a JSON snapshot is read and the next one is written with the new codec
+        storage = DiskStorage(config)
+        storage.collection('sessions').set_field('state', 'settings', chat_id=2)
+        storage.close()
+
+        with open(self.file_path, 'rb') as f:
+            self.assertFalse(f.read().startswith(b'{'))
+
+        storage = DiskStorage(config)
+
+        self.assertEqual(storage.collection('sessions').get_field('state', chat_id=1), ['main_menu'])
+        self.assertEqual(storage.collection('sessions').get_field('state', chat_id=2), ['settings'])
+
+    def test_bulk_set_is_journaled(self):
+        config = {'file_path': self.file_path, 'journal': True}
+
+        storage = DiskStorage(config)
+        storage.collection('sessions').bulk_set([({'chat_id': chat_id}, {'state': 'main_menu'})
+                                                 for chat_id in range(10)])
+        storage.close()
+
+        storage = DiskStorage(config)
+
+        self.assertEqual(len(storage.get_object('sessions', {'state': 'main_menu'}, multi=True)), 10)
+
+
+class TestPagedStorage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = {'path': os.path.join(self.dir, 'storage')}
+        self.storage = PagedStorage(self.config)
+        self.sessions = self.storage.collection('sessions')
+
+        for chat_id in range(100):
+            self.sessions.set_fields({'lang': 'en' if chat_id % 2 else 'ru', 'state': 'main_menu'}, chat_id=chat_id)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = PagedStorage(self.config)
+        self.sessions = self.storage.collection('sessions')
+
+    def test_objects_survive_restart(self):
+        self.sessions.set_field('state', 'settings', chat_id=3)
+        self.sessions.remove_object({'chat_id': 4})
+        self.reopen()
+
+        self.assertEqual(self.sessions.get_object({'chat_id': 3}), {'chat_id': 3, 'lang': 'en', 'state': 'settings'})
+        self.assertIsNone(self.sessions.get_object({'chat_id': 4}))
+        self.assertEqual(self.sessions.get_object({'chat_id': 5}, projection=['lang']), {'lang': 'en'})
+        self.assertEqual(len(self.sessions.get_field('chat_id', lang='ru')), 49)
+
+    def test_index_is_rebuilt_after_crash(self):
+        self.sessions.set_field('state', 'settings', chat_id=3)
+
+        collection = self.storage._collection('sessions')
+        # a record torn in the middle, the process dies without flushing the index
+        collection._data_file.write(b'\x05\x00\x00')
+
+        storage = PagedStorage(self.config)
+
+        try:
+            self.assertEqual(storage.get_field('sessions', 'state', chat_id=3), ['settings'])
+            self.assertEqual(len(list(storage.iter_objects('sessions', {}))), 100)
+
+            storage.set_field('sessions', 'state', 'main_menu', chat_id=100)
+            self.assertEqual(storage.get_field('sessions', 'state', chat_id=100), ['main_menu'])
+        finally:
+            storage._collections.clear()
+
+    def test_objects_without_key(self):
+        broadcasts = self.storage.collection('broadcasts')
+
+        broadcasts.set_fields({'status': 'running'}, job_id='a')
+        broadcasts.set_object({'job_id': 'b', 'status': 'done'}, {'job_id': 'x'})
+        broadcasts.set_field('status', 'done', job_id='a')
+        self.reopen()
+
+        broadcasts = self.storage.collection('broadcasts')
+
+        self.assertEqual(sorted(broadcasts.get_field('job_id', status='done')), ['a', 'b'])
+        self.assertTrue(broadcasts.remove_object({'status': 'done'}, multi=True))
+        self.assertEqual(broadcasts.get_object({'status': 'done'}, multi=True), [])
+
+    def test_iter_objects_sees_every_object_once(self):
+        iterated = []
+
+        for obj in self.sessions.iter_objects({'lang': 'ru'}):
+            # moves the object to the end of the data file
+            self.sessions.set_field('state', 'settings', chat_id=obj['chat_id'])
+            iterated.append(obj['chat_id'])
+
+        self.assertEqual(iterated, list(range(0, 100, 2)))
+
+    def test_iter_objects_reads_no_copy_of_index(self):
+        with mock.patch.object(PagedCollection, '_live_slots', side_effect=AssertionError):
+            self.assertEqual(len(list(self.sessions.iter_objects({}, batch_size=7))), 100)
+            self.assertEqual(len(self.sessions.get_field('chat_id', lang='ru')), 50)
+
+    def test_data_file_is_compacted_during_iteration(self):
+        storage = PagedStorage({'path': os.path.join(self.dir, 'compacted'), 'compaction_min_size': 0})
+        for visits in range(3):
+            storage.bulk_set('sessions', [({'chat_id': chat_id}, {'visits': visits}) for chat_id in range(100)])
+
+        iterated = []
+        abandoned = storage.iter_objects('sessions', {})
+        next(abandoned)
+
+        for obj in storage.iter_objects('sessions', {}, batch_size=10):
+            iterated.append(obj['chat_id'])
+
+            if len(iterated) == 20:
+                data_size = storage._collection('sessions').data_size
+                storage.set_field('sessions', 'visits', 2, chat_id=99)
+                storage.flush()
+
+                # not held up by the iterations in progress
+                self.assertLess(storage._collection('sessions').data_size, data_size)
+
+        self.assertEqual(sorted(iterated), list(range(100)))
+        self.assertEqual(storage.get_field('sessions', 'visits', chat_id=99), [2])
+        storage.close()
+
+    def test_empty_data_file_is_opened(self):
+        os.makedirs(os.path.join(self.dir, 'empty'))
+        open(os.path.join(self.dir, 'empty', 'sessions.data'), 'wb').close()
+
+        storage = PagedStorage({'path': os.path.join(self.dir, 'empty')})
+        storage.set_field('sessions', 'lang', 'en', chat_id=1)
+
+        self.assertEqual(storage.get_field('sessions', 'lang', chat_id=1), ['en'])
+        storage.close()
+
+    def test_index_grows_and_data_file_is_compacted(self):
+        storage = PagedStorage({'path': os.path.join(self.dir, 'compacted'), 'compaction_min_size': 0})
+
+        try:
+            for i in range(3):
+                storage.bulk_set('sessions', [({'chat_id': chat_id}, {'visits': i}) for chat_id in range(2000)])
+
+            collection = storage._collection('sessions')
+            data_size = collection.data_size
+
+            storage.flush()
+
+            self.assertLess(collection.data_size, data_size / 2)
+            self.assertEqual(collection.dead_bytes, 0)
+            self.assertEqual(storage.get_field('sessions', 'visits', chat_id=1999), [2])
+        finally:
+            storage.close()
+
+        storage = PagedStorage({'path': os.path.join(self.dir, 'compacted')})
+
+        self.assertEqual(len(list(storage.iter_field('sessions', 'visits'))), 2000)
+        storage.close()
+
+
+class TestSqliteStorage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = {'file_path': os.path.join(self.dir, 'storage.db')}
+        self.storage = SqliteStorage(self.config)
+        self.sessions = self.storage.collection('sessions')
+
+        self.storage.bulk_set('sessions', [({'chat_id': chat_id}, {'lang': 'en' if chat_id % 2 else 'ru'})
+                                           for chat_id in range(100)])
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.dir)
+
+    def test_objects_are_found_by_indexed_and_other_fields(self):
+        self.sessions.set_fields({'state': 'settings', 'flags': {'admin': True}}, chat_id=3)
+
+        self.assertEqual(self.sessions.get_object({'chat_id': 3}),
+                         {'chat_id': 3, 'lang': 'en', 'state': 'settings', 'flags': {'admin': True}})
+        self.assertEqual(self.sessions.get_field('chat_id', flags={'admin': True}), [3])
+        self.assertEqual(self.sessions.get_object({'chat_id': 3}, projection=['state']), {'state': 'settings'})
+        self.assertEqual(len(self.sessions.get_field('chat_id', lang='ru')), 50)
+        self.assertEqual(len(self.sessions.get_object({'state': None}, multi=True)), 99)
+
+        plan = self.storage._connection().execute('EXPLAIN QUERY PLAN SELECT id, doc FROM sessions '
+                                                  'WHERE field_chat_id = 3').fetchall()
+
+        self.assertIn('USING INDEX', plan[0][3])
+
+    def test_iter_field_sorted(self):
+        self.sessions.remove_object({'chat_id': 7})
+        self.sessions.set_field('lang', 'en', chat_id=7)
+
+        self.assertEqual(list(self.sessions.iter_field_sorted('chat_id', batch_size=10, lang='en')),
+                         list(range(1, 100, 2)))
+        self.assertEqual(list(self.sessions.iter_field_sorted('chat_id', after=90, batch_size=3, lang='en')),
+                         [91, 93, 95, 97, 99])
+        # not indexed
+        self.assertEqual(list(self.sessions.iter_field_sorted('lang', batch_size=1)), ['en', 'ru'])
+
+    def test_objects_survive_restart_and_are_shared_by_connections(self):
+        self.sessions.set_object({'chat_id': 4, 'lang': 'de'}, {'chat_id': 4})
+        self.sessions.remove_object({'chat_id': 5})
+
+        other = SqliteStorage(self.config)
+
+        try:
+            self.assertEqual(other.get_field('sessions', 'lang', chat_id=4), ['de'])
+            self.assertIsNone(other.get_object('sessions', {'chat_id': 5}))
+            self.assertEqual(len(list(other.iter_objects('sessions', {'lang': 'en'}, batch_size=7))), 49)
+        finally:
+            other.close()
+
+    def test_connection_per_thread(self):
+        connections = []
+
+        def work():
+            connections.append(self.storage._connection())
+            self.storage.set_field('sessions', 'state', 'settings', chat_id=6)
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(connections[0], self.storage._connection())
+        self.assertEqual(self.sessions.get_field('state', chat_id=6), ['settings'])
+        self.assertEqual(self.storage._connection().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
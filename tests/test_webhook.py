@@ -0,0 +1,115 @@
+import http.client
+import json
+import threading
+import unittest
+
+from botlab import BotLab
+from botlab.webhook import WebhookServer
+
+
+class TestWebhookServer(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.processed = threading.Event()
+
+        def process_updates(updates):
+            self.batches.append(updates)
+
+            if sum(len(batch) for batch in self.batches) >= 3:
+                self.processed.set()
+
+        self.server = WebhookServer(process_updates, {'host': '127.0.0.1', 'port': 0, 'path': '/secret',
+                                                      'secret_token': 'token'}, decode=None)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def request(self, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.port)
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        result = response.status, response.read()
+        connection.close()
+
+        return result
+
+    def post_update(self, update_id, path='/secret', secret_token='token'):
+        return self.request('POST', path, json.dumps({'update_id': update_id}),
+                            {'X-Telegram-Bot-Api-Secret-Token': secret_token})
+
+    def test_updates_are_acknowledged_and_processed(self):
+        for update_id in [1, 2, 3]:
+            self.assertEqual(self.post_update(update_id)[0], 200)
+
+        self.assertTrue(self.processed.wait(5))
+        self.assertEqual([update['update_id'] for batch in self.batches for update in batch], [1, 2, 3])
+
+        status, body = self.request('GET', '/health')
+        health = json.loads(body.decode('utf-8'))
+
+        self.assertEqual(status, 200)
+        self.assertEqual((health['status'], health['received'], health['processed']), ('ok', 3, 3))
+
+    def test_wrong_path_or_secret_is_rejected(self):
+        self.assertEqual(self.post_update(1, path='/')[0], 404)
+        self.assertEqual(self.post_update(1, secret_token='wrong')[0], 404)
+        self.assertEqual(self.request('GET', '/')[0], 404)
+
+        self.assertEqual(self.server.health()['rejected'], 2)
+        self.assertEqual(self.server.health()['received'], 0)
+
+    def announce_body(self, content_length, secret_token='token'):
+        # only the headers are sent: a server that reads the body waits for it
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        connection.putrequest('POST', '/secret')
+        connection.putheader('Content-Length', str(content_length))
+        connection.putheader('X-Telegram-Bot-Api-Secret-Token', secret_token)
+        connection.endheaders()
+        response = connection.getresponse()
+        connection.close()
+
+        return response.status
+
+    def test_big_bodies_are_rejected_unread(self):
+        self.assertEqual(self.announce_body(10 * 1024 ** 3), 413)
+        self.assertEqual(self.announce_body(10 * 1024 ** 3, secret_token='wrong'), 404)
+        self.assertEqual(self.announce_body(-1), 400)
+
+        self.assertEqual(self.server.health()['rejected'], 3)
+        self.assertEqual(self.post_update(1)[0], 200)
+
+
+class TestBotLabWebhook(unittest.TestCase):
+    def test_updates_from_webhook_are_dispatched(self):
+        bot = BotLab({
+            'config': {'sync_strategy': 'cold'},
+            'bot': {'token': '123:TEST', 'initial_state': 'main_menu', 'initial_inline_state': None,
+                    'suppress_exceptions': False},
+            'db_storage': {'type': 'inmemory', 'params': {}},
+            'l10n': {'default_lang': 'en', 'file_path': 'assets/l10n.json'},
+            'webhook': {'host': '127.0.0.1', 'port': 0, 'path': '/secret'}
+        }, threaded=False)
+        handled = []
+
+        @bot.message_handler(func=lambda message: True)
+        def echo(session, message):
+            handled.append(message.text)
+
+        server = bot.webhook_server()
+        server.start()
+
+        for update_id, text in [(1, 'hi'), (2, 'hi again')]:
+            connection = http.client.HTTPConnection('127.0.0.1', server.port)
+            connection.request('POST', '/secret', json.dumps({
+                'update_id': update_id,
+                'message': {'message_id': update_id, 'date': 0, 'text': text,
+                            'chat': {'id': 42, 'type': 'private'},
+                            'from': {'id': 42, 'is_bot': False, 'first_name': 'Max'}}
+            }))
+            self.assertEqual(connection.getresponse().status, 200)
+            connection.close()
+
+        server.stop()
+
+        self.assertEqual(handled, ['hi', 'hi again'])